@@ -0,0 +1,372 @@
+'时序分析算法集群模式，按关联键一致性哈希将Flag分区到多个分析节点'
+
+__author__ = 'Beta-TNT'
+
+import os, queue, socket, socketserver, struct, pickle, hashlib, bisect, threading, multiprocessing
+from AnalyseLib import AnalyseBase
+
+# 集群模式说明：
+# 1、每个节点进程持有一个AnalyseNode（AnalyseBase派生类）和完整的规则集，只保存属于自己的那部分Flag；
+# 2、客户端（ClusterClient）按事件的关联键（KeyField字段）计算一致性哈希，把事件转发给拥有该关联键的节点；
+#    同一条时序链上所有规则的Flag模板都应包含关联键字段，这样整条链的Flag都落在同一个节点上；
+# 3、转发按节点攒批，批量发送，不等待上一批结果即可继续发送（流水线），在途批次数量有上限；
+#    每个连接有一个读线程持续接收节点的回复，客户端阻塞在发送上时节点也能发出回复，两端不会因socket缓冲区写满而互相等待；
+# 4、新节点加入时，其他节点把哈希环上已经不属于自己的Flag导出，再导入到新的所有者节点；
+# 5、节点之间用TCP（(host, port)）或Unix socket（路径字符串）通讯，消息是4字节长度+pickle，只能用于受信任的网络。
+# 插件内部的状态（例如ThresholdLifetime的_cache）不参与迁移，只迁移基础算法的Flag
+
+_Header = struct.Struct('!I')
+
+def _SendMessage(InputSocket, InputMessage):
+    '发送一条消息，消息体为pickle序列化后的对象'
+    payload = pickle.dumps(InputMessage, pickle.HIGHEST_PROTOCOL)
+    InputSocket.sendall(_Header.pack(len(payload)) + payload)
+
+def _RecvMessage(InputFile, Closed=None):
+    '从socket文件对象读取一条消息，连接关闭时返回Closed'
+    header = InputFile.read(_Header.size)
+    if len(header) < _Header.size:
+        return Closed
+    return pickle.loads(InputFile.read(_Header.unpack(header)[0]))
+
+def _Connect(InputAddress):
+    '连接节点，地址是(host, port)时使用TCP，是字符串时使用Unix socket'
+    if type(InputAddress) == str:
+        rtn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        rtn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        rtn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    rtn.connect(InputAddress)
+    return rtn
+
+
+class HashRing(object):
+    '一致性哈希环，每个节点在环上有VirtualNodes个虚拟节点'
+
+    def __init__(self, VirtualNodes=64):
+        self.VirtualNodes = VirtualNodes
+        self._points = [] # 有序的哈希点
+        self._owners = [] # 与_points一一对应的节点ID
+        self.Nodes = set()
+
+    @staticmethod
+    def KeyHash(InputKey):
+        '关联键的哈希值，64位整数。不使用内置hash()，保证跨进程稳定'
+        return int.from_bytes(hashlib.md5(str(InputKey).encode()).digest()[:8], 'big')
+
+    def AddNode(self, NodeId):
+        if NodeId in self.Nodes:
+            return
+        self.Nodes.add(NodeId)
+        for i in range(self.VirtualNodes):
+            point = self.KeyHash('%s#%s' % (NodeId, i))
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, NodeId)
+
+    def RemoveNode(self, NodeId):
+        if NodeId not in self.Nodes:
+            return
+        self.Nodes.discard(NodeId)
+        keep = [i for i, owner in enumerate(self._owners) if owner != NodeId]
+        self._points = [self._points[i] for i in keep]
+        self._owners = [self._owners[i] for i in keep]
+
+    def GetNode(self, InputKey):
+        '返回关联键所属的节点ID，环为空时返回None'
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, self.KeyHash(InputKey)) % len(self._points)
+        return self._owners[index]
+
+
+class AnalyseNode(AnalyseBase):
+    '集群节点使用的分析算法类，额外记录每个Flag所属的关联键，用于重新分区时迁移Flag'
+
+    def __init__(self, InputRules, ActionFunc=None):
+        super().__init__()
+        self._flags = dict() # 节点独立的Flag存储，不与同进程内的其他分析对象共享
+        self._flagKeys = dict() # Flag-关联键映射
+        self._currentKey = None # 当前正在分析的事件的关联键
+        self.ActionFunc = ActionFunc
+        self.LoadRules(InputRules)
+
+    def AddFlag(self, InputFlag, InputItem, InputData=None, InputRule=None):
+        super().AddFlag(InputFlag, InputItem, InputData, InputRule)
+        self._flagKeys[InputFlag] = self._currentKey
+
+    def RemoveFlag(self, InputFlag):
+        super().RemoveFlag(InputFlag)
+        self._flagKeys.pop(InputFlag, None)
+
+    def AnalyseBatch(self, InputBatch):
+        '分析一批(序号, 关联键, 数据)，返回[(序号, 命中结果list)]，只包含有命中的事件'
+        rtn = []
+        for seq, key, inputData in InputBatch:
+            self._currentKey = key
+            hits = self.AnalyseMain(inputData, self.ActionFunc)
+            if hits:
+                rtn.append((seq, list(hits)))
+        self._currentKey = None
+        return rtn
+
+    def ExportFlags(self, InputRing, NodeId):
+        '导出并删除按新的哈希环已经不属于本节点的Flag，返回[(Flag, 关联键, 用户数据对象, 生成Flag的模板)]'
+        rtn = []
+        for flag, key in list(self._flagKeys.items()):
+            if InputRing.GetNode(key) != NodeId:
+                rtn.append((flag, key, self._flags.get(flag), self._flagTemplates.get(flag)))
+                self.RemoveFlag(flag)
+        return rtn
+
+    def ImportFlags(self, InputFlags):
+        '导入其他节点迁移过来的Flag'
+        for flag, key, item, template in InputFlags:
+            self._currentKey = key
+            self.AddFlag(flag, item, None, {'CurrentFlag': template} if template is not None else None)
+        self._currentKey = None
+
+
+class _NodeRequestHandler(socketserver.StreamRequestHandler):
+    '节点连接处理。同一连接上的请求按顺序处理并按顺序回复，因此客户端可以流水线发送'
+
+    def handle(self):
+        server = self.server
+        while True:
+            message = _RecvMessage(self.rfile)
+            if message is None:
+                break
+            command, payload = message
+            with server.AnalyseLock:
+                if command == 'batch':
+                    reply = server.Analyser.AnalyseBatch(payload)
+                elif command == 'export':
+                    reply = server.Analyser.ExportFlags(*payload)
+                elif command == 'import':
+                    reply = server.Analyser.ImportFlags(payload)
+                elif command == 'stats':
+                    reply = {'Flags': len(server.Analyser._flags), 'Pid': os.getpid()}
+                elif command == 'stop':
+                    reply = None
+                else:
+                    reply = None
+            _SendMessage(self.connection, reply)
+            if command == 'stop':
+                threading.Thread(target=server.shutdown).start()
+                break
+
+
+def _CreateServer(InputAddress):
+    if type(InputAddress) == str:
+        if os.path.exists(InputAddress):
+            os.remove(InputAddress)
+        return socketserver.ThreadingUnixStreamServer(InputAddress, _NodeRequestHandler)
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    return socketserver.ThreadingTCPServer(InputAddress, _NodeRequestHandler)
+
+def RunNode(InputAddress, InputRules, ActionFunc=None, ReadyEvent=None):
+    '在当前进程运行一个分析节点，直到收到stop命令'
+    server = _CreateServer(InputAddress)
+    server.daemon_threads = True
+    server.Analyser = AnalyseNode(InputRules, ActionFunc)
+    server.AnalyseLock = threading.Lock() # 分析算法对象不是线程安全的，多个连接串行访问
+    if ReadyEvent:
+        ReadyEvent.set()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if type(InputAddress) == str and os.path.exists(InputAddress):
+            os.remove(InputAddress)
+
+def StartLocalNode(InputAddress, InputRules, ActionFunc=None):
+    '以本机子进程方式启动一个分析节点，等待节点开始监听后返回进程对象。ActionFunc需要能被pickle（模块级函数）'
+    readyEvent = multiprocessing.Event()
+    rtn = multiprocessing.Process(
+        target=RunNode,
+        args=(InputAddress, InputRules, ActionFunc, readyEvent),
+        daemon=True
+    )
+    rtn.start()
+    readyEvent.wait()
+    return rtn
+
+
+class ClusterClient(object):
+    '集群客户端，按关联键把事件转发到对应节点，按节点攒批并流水线发送'
+
+    _Closed = object() # 读线程发现连接关闭时放入回复队列的标记
+
+    def __init__(self, KeyField, BatchSize=256, MaxInFlight=8, VirtualNodes=64):
+        self.KeyField = KeyField # 事件中作为关联键的字段名
+        self.BatchSize = BatchSize # 每批事件数量
+        self.MaxInFlight = MaxInFlight # 每个节点最多允许的未回复批次数
+        self._ring = HashRing(VirtualNodes)
+        self._connections = dict() # 节点ID-(socket, 读取用文件对象)
+        self._replies = dict() # 节点ID-读线程收到的回复队列，按请求顺序排列
+        self._readers = dict() # 节点ID-读线程
+        self._buffers = dict() # 节点ID-待发送的事件列表
+        self._inFlight = dict() # 节点ID-已发送未取走回复的批次数
+        self._results = [] # [(序号, 命中结果list)]
+        self._seq = 0
+
+    @staticmethod
+    def _ReadReplies(InputFile, OutputQueue):
+        '读线程：持续读取节点回复放入队列，连接关闭或出错时放入_Closed后退出'
+        try:
+            while True:
+                reply = _RecvMessage(InputFile, ClusterClient._Closed)
+                OutputQueue.put(reply)
+                if reply is ClusterClient._Closed:
+                    break
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+            OutputQueue.put(ClusterClient._Closed)
+
+    def _GetReply(self, NodeId):
+        reply = self._replies[NodeId].get()
+        if reply is ClusterClient._Closed:
+            self._replies[NodeId].put(reply) # 之后的读取同样报错
+            raise ConnectionError("Node '%s' closed the connection." % NodeId)
+        return reply
+
+    def _Request(self, NodeId, Command, Payload=None):
+        '同步请求，调用前应保证该节点没有在途批次'
+        _SendMessage(self._connections[NodeId][0], (Command, Payload))
+        return self._GetReply(NodeId)
+
+    def _SendBatch(self, NodeId):
+        batch = self._buffers[NodeId]
+        if not batch:
+            return
+        self._buffers[NodeId] = []
+        while self._inFlight[NodeId] >= self.MaxInFlight:
+            self._ReceiveOne(NodeId)
+        # 发送可能阻塞，读线程同时在接收回复，回复队列的长度不超过MaxInFlight
+        _SendMessage(self._connections[NodeId][0], ('batch', batch))
+        self._inFlight[NodeId] += 1
+
+    def _ReceiveOne(self, NodeId):
+        self._results.extend(self._GetReply(NodeId))
+        self._inFlight[NodeId] -= 1
+
+    def _Drain(self):
+        '发送所有节点的剩余事件，并等待所有在途批次返回'
+        for nodeId in self._connections:
+            self._SendBatch(nodeId)
+        for nodeId in self._connections:
+            while self._inFlight[nodeId]:
+                self._ReceiveOne(nodeId)
+
+    def _Connect(self, NodeId, InputAddress):
+        sock = _Connect(InputAddress)
+        rfile = sock.makefile('rb')
+        self._connections[NodeId] = (sock, rfile)
+        self._replies[NodeId] = queue.Queue()
+        self._readers[NodeId] = threading.Thread(target=self._ReadReplies, args=(rfile, self._replies[NodeId]), daemon=True)
+        self._readers[NodeId].start()
+
+    def _Disconnect(self, NodeId):
+        sock, rfile = self._connections.pop(NodeId)
+        try:
+            sock.shutdown(socket.SHUT_RDWR) # 唤醒阻塞在读取上的读线程
+        except OSError:
+            pass
+        self._readers.pop(NodeId).join()
+        self._replies.pop(NodeId)
+        rfile.close()
+        sock.close()
+
+    def AddNode(self, NodeId, InputAddress):
+        '加入节点。如果集群中已有节点，先排空在途数据，再把哈希环上划给新节点的Flag迁移过去'
+        self._Drain()
+        self._Connect(NodeId, InputAddress)
+        self._buffers[NodeId] = []
+        self._inFlight[NodeId] = 0
+        self._ring.AddNode(NodeId)
+        self._Rebalance()
+
+    def RemoveNode(self, NodeId):
+        '移除节点，将其所有Flag迁移到其他节点后断开连接'
+        self._Drain()
+        self._ring.RemoveNode(NodeId)
+        self._Rebalance()
+        self._Disconnect(NodeId)
+        self._buffers.pop(NodeId)
+        self._inFlight.pop(NodeId)
+
+    def _Rebalance(self):
+        '让每个节点按新的哈希环导出不属于自己的Flag，再按关联键导入到新的所有者'
+        moved = dict()
+        for nodeId in self._connections:
+            for flagItem in self._Request(nodeId, 'export', (self._ring, nodeId)):
+                moved.setdefault(self._ring.GetNode(flagItem[1]), []).append(flagItem)
+        for nodeId, flagItems in moved.items():
+            self._Request(nodeId, 'import', flagItems)
+
+    def Submit(self, InputData):
+        '提交一条事件，返回事件序号。事件进入对应节点的发送缓冲，缓冲满时整批发送'
+        key = InputData.get(self.KeyField)
+        nodeId = self._ring.GetNode(key)
+        if nodeId is None:
+            raise RuntimeError("No node in cluster.")
+        seq = self._seq
+        self._seq += 1
+        self._buffers[nodeId].append((seq, key, InputData))
+        if len(self._buffers[nodeId]) >= self.BatchSize:
+            self._SendBatch(nodeId)
+        return seq
+
+    def Flush(self):
+        '发送所有缓冲中的事件并等待结果，返回按事件序号排序的[(序号, 命中结果list)]，并清空已收集的结果'
+        self._Drain()
+        rtn = sorted(self._results, key=lambda x:x[0])
+        self._results = []
+        return rtn
+
+    def Stats(self):
+        '返回各节点的Flag数量等状态'
+        self._Drain()
+        return {nodeId: self._Request(nodeId, 'stats') for nodeId in self._connections}
+
+    def Close(self, StopNodes=False):
+        '断开所有节点连接，StopNodes为True时同时停止节点进程'
+        self._Drain()
+        for nodeId in list(self._connections):
+            if StopNodes:
+                self._Request(nodeId, 'stop')
+            self._Disconnect(nodeId)
+
+
+def _DemoActionFunc(InputData, InputRule, HitItem, CurrentFlag):
+    return CurrentFlag
+
+if __name__ == '__main__':
+    # 本机多进程演示：启动3个节点，先用2个节点分析，再加入第3个节点触发Flag迁移
+    import tempfile
+    rules = [
+        {
+            'Operator': 1, 'PrevFlag': '', 'CurrentFlag': 'login:{src_ip}',
+            'FieldCheckList': [{'FieldName': 'event', 'MatchContent': 'login', 'MatchCode': 1}]
+        },
+        {
+            'Operator': 1, 'PrevFlag': 'login:{src_ip}', 'CurrentFlag': 'download:{src_ip}',
+            'FieldCheckList': [{'FieldName': 'event', 'MatchContent': 'download', 'MatchCode': 1}]
+        }
+    ]
+    tempDir = tempfile.mkdtemp()
+    addresses = {'node%s' % i: os.path.join(tempDir, 'node%s.sock' % i) for i in range(3)}
+    processes = [StartLocalNode(address, rules, _DemoActionFunc) for address in addresses.values()]
+    client = ClusterClient('src_ip', BatchSize=64)
+    client.AddNode('node0', addresses['node0'])
+    client.AddNode('node1', addresses['node1'])
+    for i in range(1000):
+        client.Submit({'event': 'login', 'src_ip': '10.0.%s.%s' % (i // 256, i % 256)})
+    print(len(client.Flush()), client.Stats())
+    client.AddNode('node2', addresses['node2'])
+    print(client.Stats())
+    for i in range(1000):
+        client.Submit({'event': 'download', 'src_ip': '10.0.%s.%s' % (i // 256, i % 256)})
+    print(len(client.Flush()), client.Stats())
+    client.Close(StopNodes=True)
+    for process in processes:
+        process.join()
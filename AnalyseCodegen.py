@@ -0,0 +1,270 @@
+'时序分析算法代码生成后端，把整个受管规则集生成为一个专用的Python分析函数'
+
+__author__ = 'Beta-TNT'
+
+import time
+from AnalyseLib import AnalyseBase
+
+# 生成的分析函数和解释执行的_DefaultAnalyseMain()结果一致：
+# 1、规则用到的字段在函数开头一次性读取到局部变量；
+# 2、字段匹配按匹配内容的类型生成专用比较表达式，匹配内容作为常量写入代码，类型不符时回退到编译好的FieldMatcher；
+# 3、多条规则共用的相同字段匹配项（字段名、匹配代码、匹配内容都相同）每条数据只计算一次；
+# 4、前序Flag直接查询_flags；规则命中后的处理调用_RuleHit()，和解释执行共用同一套逻辑；
+# 5、带插件的规则调用_CompiledSingleRuleTest()执行插件流水线。
+# 6、启用过载保护时，入口点规则先调用ShouldShed()判断本次是否跳过；
+# 7、启用了匹配结果缓存的字段，字段匹配结果从该字段的结果位图中读取，位图每条数据只查询一次。
+# 8、声明了字段类型（见AnalyseBase.SetSchema()）的字段，按字段类型生成专用比较表达式，匹配内容是编译时转换好的常量；
+# 9、设置了抽样性能剖析器时，被抽中的数据改由_TracedAnalyseMain()解释执行并记录调用树。
+# 生成的代码不调用FieldCheck()和SingleRuleTest()，派生类重写这两个函数对生成的代码不生效，这一点和解释执行的受管规则集相同；
+# 需要自定义匹配逻辑时请写成插件，或者通过InputRules传入规则按原逻辑解释执行。重写的FlagGenerator()仍然生效，生成的代码改为调用它。
+# 插件和ActionFunc可能修改数据，因此调用它们之后会重新读取字段并作废已缓存的字段匹配结果。
+# 默认的Flag生成函数会把数据中的bytes字段就地解码成字符串，为保持一致，包含bytes字段的数据直接交给解释执行
+
+_Missing = object() # 字段不存在的标记
+
+class RuleSetCodeGenerator(object):
+    '规则集代码生成器，Source属性是生成的源代码，Namespace属性是代码引用的常量'
+
+    _LiteralTypes = (str, int, bool)
+
+    def __init__(self, InputRuleSet, InlineFlagFormat=True, CachedFields=(), LoadShedding=False):
+        self.InlineFlagFormat = InlineFlagFormat # 是否直接用str.format_map()生成Flag，仅在使用默认Flag生成函数时可用
+        self.LoadShedding = LoadShedding # 是否为入口点规则生成过载保护判断
+        self.CachedFields = frozenset(CachedFields) # 启用了匹配结果缓存的字段
+        self._ruleSet = InputRuleSet
+        self._bits = dict() # 字段名-结果位图变量名
+        self.Namespace = {'_Missing': _Missing}
+        self._fields = dict() # 字段名-局部变量名
+        self._checks = dict() # 字段匹配项特征-缓存变量名
+        self._lines = []
+        self._Generate(InputRuleSet)
+        self.Source = '\n'.join(self._lines) + '\n'
+
+    def _Const(self, Prefix, InputValue):
+        name = '%s%s' % (Prefix, len(self.Namespace))
+        self.Namespace[name] = InputValue
+        return name
+
+    def _Literal(self, InputValue):
+        if type(InputValue) in self._LiteralTypes:
+            return repr(InputValue)
+        return self._Const('K', InputValue)
+
+    def _Field(self, FieldName):
+        if FieldName not in self._fields:
+            self._fields[FieldName] = 'f%s' % len(self._fields)
+        return self._fields[FieldName]
+
+    def _CheckExpr(self, InputMatcher, FieldVar):
+        '单个字段匹配项的专用表达式'
+        matchContent = InputMatcher.MatchContent
+        mode = abs(InputMatcher.MatchCode)
+        # 专用表达式按正数匹配代码生成，最后统一取反，类型不符时回退用的FieldMatcher也使用正数匹配代码
+        matcher = self._Const('M', AnalyseBase.FieldMatcher({'FieldName': InputMatcher.FieldName, 'MatchContent': matchContent, 'MatchCode': mode}))
+        MatchMode = AnalyseBase.MatchMode
+        contentType = type(matchContent)
+        if InputMatcher._typed:
+            expr = self._TypedCheckExpr(InputMatcher, FieldVar, matcher)
+            if expr is None:
+                return '%s(%s)' % (self._Const('M', InputMatcher), FieldVar)
+        elif mode == MatchMode.Equal and contentType in self._LiteralTypes:
+            expr = '(%s == %s) if type(%s) is %s else %s(%s)' % (FieldVar, self._Literal(matchContent), FieldVar, contentType.__name__, matcher, FieldVar)
+        elif mode == MatchMode.TextMatching and contentType == str:
+            expr = '(%s in %s) if type(%s) is str else %s(%s)' % (self._Literal(matchContent), FieldVar, FieldVar, matcher, FieldVar)
+        elif mode == MatchMode.RegexMatching:
+            pattern = self._Const('P', AnalyseBase._RegexCompile(matchContent if contentType == str else str(matchContent)))
+            expr = '(%s.match(%s) is not None) if type(%s) is str else %s(%s)' % (pattern, FieldVar, FieldVar, matcher, FieldVar)
+        elif mode == MatchMode.GreaterThan and contentType in (int, float):
+            expr = '(%s > %s) if type(%s) is int or type(%s) is float else %s(%s)' % (self._Literal(matchContent), FieldVar, FieldVar, FieldVar, matcher, FieldVar)
+        else:
+            return '%s(%s)' % (self._Const('M', InputMatcher), FieldVar)
+        if InputMatcher.MatchCode < 0:
+            expr = 'not (%s)' % expr
+        return '(%s)' % expr
+
+    def _TypedCheckExpr(self, InputMatcher, FieldVar, FallbackMatcher):
+        '声明了字段类型的字段匹配项的专用表达式，匹配内容使用编译时转换好的值，字段值不是声明的类型时回退到通用比较'
+        MatchMode = AnalyseBase.MatchMode
+        mode = abs(InputMatcher.MatchCode)
+        content = self._Literal(InputMatcher._typedContent) if InputMatcher._typedContent is not None else None
+        if mode == MatchMode.Equal:
+            expr = '%s == %s' % (FieldVar, content)
+        elif mode == MatchMode.TextMatching:
+            expr = '%s in %s' % (content, FieldVar)
+        elif mode == MatchMode.RegexMatching:
+            expr = '%s.match(%s) is not None' % (self._Const('P', InputMatcher._pattern), FieldVar)
+        elif mode == MatchMode.GreaterThan:
+            expr = '%s > %s' % (content, FieldVar)
+        elif mode == MatchMode.ReversedTextMatching:
+            expr = '%s in %s' % (FieldVar, content)
+        elif mode == MatchMode.ReversedGreaterThan:
+            expr = '%s > %s' % (FieldVar, content)
+        else:
+            return None
+        return '(%s) if type(%s) is %s else %s(%s)' % (expr, FieldVar, InputMatcher.FieldType.__name__, FallbackMatcher, FieldVar)
+
+    def _SharedCheck(self, InputMatcher):
+        '返回带缓存的字段匹配表达式，相同的字段匹配项共用一个缓存变量'
+        fieldName = InputMatcher.FieldName
+        fieldVar = self._Field(fieldName)
+        if fieldName in self.CachedFields:
+            if fieldName not in self._bits:
+                self._bits[fieldName] = 'b%s' % len(self._bits)
+            bitsVar = self._bits[fieldName]
+            return fieldVar, '((%s if %s is not None else (%s := FieldCacheBits(%s, %s))) >> %s & 1 == 1)' % (
+                bitsVar, bitsVar, bitsVar, self._Literal(fieldName), fieldVar, self._ruleSet.MatcherBits[id(InputMatcher)]
+            )
+        key = InputMatcher.Key
+        if key not in self._checks:
+            self._checks[key] = ('c%s' % len(self._checks), self._CheckExpr(InputMatcher, fieldVar))
+        cacheVar, expr = self._checks[key]
+        return fieldVar, '(%s if %s is not None else (%s := %s))' % (cacheVar, cacheVar, cacheVar, expr)
+
+    def _RuleFieldCheckExpr(self, InputCompiledRule):
+        '规则字段匹配部分的表达式，逻辑同_CompiledRuleFieldCheck()'
+        if not InputCompiledRule.FieldMatchers:
+            return 'True'
+        checks = [self._SharedCheck(x) for x in InputCompiledRule.FieldMatchers]
+        anyPresent = '(%s)' % ' or '.join('%s is not _Missing' % fieldVar for fieldVar, _ in checks)
+        operator = InputCompiledRule.Operator
+        if abs(operator) == AnalyseBase.OperatorCode.OpAnd:
+            result = '(%s)' % ' and '.join('(%s is _Missing or %s)' % (fieldVar, expr) for fieldVar, expr in checks)
+        elif abs(operator) == AnalyseBase.OperatorCode.OpOr:
+            result = '(%s)' % ' or '.join('(%s is not _Missing and %s)' % (fieldVar, expr) for fieldVar, expr in checks)
+        else:
+            result = 'False'
+        if operator < 0:
+            result = 'not %s' % result
+        return '%s and %s' % (anyPresent, result)
+
+    def _FlagExpr(self, InputTemplate):
+        if self.InlineFlagFormat:
+            return '%s.format_map(InputData)' % self._Literal(InputTemplate)
+        return 'FlagGenerator(InputData, %s)' % self._Literal(InputTemplate)
+
+    def _Generate(self, InputRuleSet):
+        body = []
+        reload = '__RELOAD__' # 占位，所有字段确定之后再展开成重新读取字段、作废匹配缓存的代码
+        for index, compiledRule in enumerate(InputRuleSet.Rules):
+            rule = self._Const('R', compiledRule.Rule)
+            body.append('    # rule %s, RuleId: %r' % (index, compiledRule.RuleId))
+            shed = 'not ShouldShed(%s) and ' % self._Const('CR', compiledRule) if self.LoadShedding and compiledRule.Entry else ''
+            if compiledRule.PluginNames:
+                if shed:
+                    body.append('    if ShouldShed(%s):' % self._Const('CR', compiledRule))
+                    body.append('        hit = False')
+                    body.append('    else:')
+                    body.append('        hit, hitItem = RuleTest(InputData, %s)' % self._Const('CR', compiledRule))
+                    body.append('        ' + reload)
+                    body.append('    if hit:')
+                    body.append('        RuleHit(InputData, ActionFunc, %s, hitItem, rtn)' % rule)
+                    body.append('        ' + reload)
+                    continue
+                body.append('    hit, hitItem = RuleTest(InputData, %s)' % self._Const('CR', compiledRule))
+                body.append('    ' + reload)
+                body.append('    if hit:')
+                body.append('        RuleHit(InputData, ActionFunc, %s, hitItem, rtn)' % rule)
+                body.append('        ' + reload)
+                continue
+            body.append('    if %s%s:' % (shed, self._RuleFieldCheckExpr(compiledRule)))
+            if compiledRule.PrevFlag:
+                body.append('        hitItem = flags.get(%s, _Missing)' % self._FlagExpr(compiledRule.PrevFlag))
+                body.append('        if hitItem is not _Missing:')
+                body.append('            RuleHit(InputData, ActionFunc, %s, hitItem, rtn)' % rule)
+                body.append('            ' + reload)
+            else:
+                body.append('        RuleHit(InputData, ActionFunc, %s, None, rtn)' % rule)
+                body.append('        ' + reload)
+
+        fieldLines = ['%s = InputData.get(%s, _Missing)' % (var, self._Literal(name)) for name, var in self._fields.items()]
+        cacheVars = [x[0] for x in self._checks.values()] + list(self._bits.values())
+        cacheLine = ['%s = None' % ' = '.join(cacheVars)] if cacheVars else []
+
+        self._lines.append('def AnalyseMain(InputData, ActionFunc):')
+        self._lines.append('    if type(InputData) != dict:')
+        self._lines.append('        raise TypeError("Invalid InputData type, expecting dict()")')
+        if self.InlineFlagFormat:
+            self._lines.append('    for value in InputData.values():')
+            self._lines.append('        if type(value) is bytes or type(value) is bytearray:')
+            self._lines.append('            return Fallback(InputData, ActionFunc)')
+        self._lines.append('    flags = Engine._flags')
+        self._lines.append('    rtn = set()')
+        self._lines.extend('    ' + x for x in fieldLines + cacheLine)
+        for line in body:
+            if line.strip() == reload:
+                indent = line[:len(line) - len(reload)]
+                self._lines.extend(indent + x for x in fieldLines + cacheLine)
+                if not fieldLines + cacheLine:
+                    self._lines.append(indent + 'pass')
+            else:
+                self._lines.append(line)
+        self._lines.append('    return rtn')
+
+
+class CodegenAnalyse(AnalyseBase):
+    '''使用代码生成后端的分析算法类。受管规则集每次变更后重新生成分析函数，InputRules不为None时仍按原逻辑解释执行。
+    受管规则集的分析结果和AnalyseBase相同；派生类重写的FieldCheck()和SingleRuleTest()不会被生成的代码调用'''
+
+    def __init__(self):
+        super().__init__()
+        self._generatedMain = None
+        self.Source = None # 当前生成的源代码，可用DumpSource()导出查看
+
+    def _SwapRuleSet(self, OldRuleSet, NewRuleSet):
+        super()._SwapRuleSet(OldRuleSet, NewRuleSet)
+        self._GenerateMain(NewRuleSet)
+
+    def _GenerateMain(self, InputRuleSet):
+        '为规则集生成并编译分析函数'
+        inlineFlagFormat = type(self).FlagGenerator is AnalyseBase.FlagGenerator
+        shedder = self._shedder
+        generator = RuleSetCodeGenerator(InputRuleSet, inlineFlagFormat, InputRuleSet.FieldCaches, shedder is not None)
+        namespace = dict(generator.Namespace)
+        namespace.update({
+            'ShouldShed': shedder.ShouldShed if shedder is not None else None,
+            'FieldCacheBits': lambda FieldName, InputValue: self._FieldCacheBits(InputRuleSet, FieldName, InputValue),
+            'Engine': self,
+            'RuleHit': self._RuleHit,
+            'RuleTest': self._CompiledSingleRuleTest,
+            'FlagGenerator': self.FlagGenerator,
+            'Fallback': lambda InputData, ActionFunc: AnalyseBase._DefaultAnalyseMain(self, InputData, ActionFunc, None)
+        })
+        exec(compile(generator.Source, '<AnalyseCodegen>', 'exec'), namespace)
+        self.Source = generator.Source
+        self._generatedMain = namespace['AnalyseMain']
+
+    def EnableFieldCache(self, FieldName, MaxSize=4096):
+        super().EnableFieldCache(FieldName, MaxSize)
+        if self._ruleSet is not None:
+            self._GenerateMain(self._ruleSet)
+
+    def DisableFieldCache(self, FieldName):
+        super().DisableFieldCache(FieldName)
+        if self._ruleSet is not None:
+            self._GenerateMain(self._ruleSet)
+
+    def SetLoadShedding(self, LatencyBudget, MaxBacklog=0, Smoothing=0.05, Step=0.05):
+        super().SetLoadShedding(LatencyBudget, MaxBacklog, Smoothing, Step)
+        if self._ruleSet is not None:
+            self._GenerateMain(self._ruleSet)
+
+    def DumpSource(self, InputPath):
+        '把当前生成的源代码写入文件'
+        with open(InputPath, 'w', encoding='utf-8') as f:
+            f.write(self.Source or '')
+
+    def AnalyseMain(self, InputData, ActionFunc, InputRules=None):
+        generatedMain = self._generatedMain
+        if InputRules is None and generatedMain is not None:
+            profiler = self._profiler
+            if profiler is not None and profiler.Sample():
+                # 被抽中的数据按解释执行的逻辑记录调用树，生成的代码没有逐项计时的位置
+                return self._TracedAnalyseMain(InputData, ActionFunc, None, profiler)
+            shedder = self._shedder
+            if shedder is None:
+                return generatedMain(InputData, ActionFunc or self._DummyActionFunc)
+            startTime = time.perf_counter()
+            rtn = generatedMain(InputData, ActionFunc or self._DummyActionFunc)
+            shedder.Observe(time.perf_counter() - startTime)
+            return rtn
+        return super().AnalyseMain(InputData, ActionFunc, InputRules)
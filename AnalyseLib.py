@@ -3,7 +3,8 @@
 __author__ = 'Beta-TNT'
 __version__= '2.6.0'
 
-import re, os, base64
+import re, os, mmap, json, time, random, base64, bisect, pickle, string, hashlib, functools, threading
+from collections import OrderedDict, deque
 from enum import IntEnum
 from abc import ABCMeta, abstractmethod
 
@@ -16,6 +17,7 @@ class AnalyseBase(object):
     RemoveFlag  ：字段匹配规则和历史匹配Flag命中之后，需要删除的Flag。Flag不存在不会触发异常
     CurrentFlag ：时序分析算法本级规则命中后构造Flag的模板
     PluginNames ：需要调用的插件名列表，请将插件名列表以分号分隔写入这个字段，引擎将按列表顺序以串行执行运行插件函数。原PluginName字段废除
+    Priority    ：可选，规则优先级，整数，默认值0。过载时优先级低的入口点规则先被抽样跳过，见SetLoadShedding()
     FieldCheckList[]    ：字段匹配项列表
         字段匹配项结构（字典）：
         FieldName   ：要进行匹配的字段名
@@ -30,6 +32,12 @@ class AnalyseBase(object):
         OpOr = 2
         # 逻辑代码对应的负数代表结果取反，例如-1代表NotAnd，不再显式声明
 
+    class ConflictPolicyCode(IntEnum):
+        # 规则命中时本级Flag已经存在（Flag冲突）的处理方式
+        Always = 0 # 原逻辑：照常调用ActionFunc()，返回值丢弃
+        Skip = 1 # 不调用ActionFunc()
+        Update = 2 # 调用ActionFunc()，用返回值就地替换已存在Flag的用户数据对象
+        Hook = 3 # 不调用ActionFunc()，改为调用OnDuplicate()
 
     class MatchMode(IntEnum):
         Preserve = 0 # 为带字段比较功能插件预留
@@ -39,16 +47,16 @@ class AnalyseBase(object):
         GreaterThan = 4  # 大于（数字）
         LengthEqual = 5 # 元数据比较：数据长度等于（忽略数字类型数据）
         LengthGreaterThan = 6 # 元数据比较：数据长度大于（忽略数字类型数据）
+        ReversedTextMatching = 7 # 翻转文本匹配：字段内容是匹配内容的子串
+        ReversedRegexMatching = 8 # 翻转正则匹配：字段内容作为正则表达式，匹配规则的匹配内容
+        ReversedGreaterThan = 9 # 翻转大小比较：字段内容（数字）大于匹配内容
         # 匹配代码对应的负数代表结果取反，例如-1代表不等于（NotEqual），不再显式声明
 
-        # 原本考虑加入翻转比较运算（Reverse），交换比较运算的左值和右值，但考虑之后发现不具备实际意义：
-        # 1、翻转比较不影响相等比较的结果；
-        # 2、翻转比较用于多结果文本匹配的时候，完全可以用OpOr运算符并列多次比较代替；
-        # 3、翻转比较用于正则匹配（将输入数据而非规则作为正则表达式）时会导致完全无法预料的结果；
-        # 4、翻转比较用于数字大于比较的时候，和小于等于运算等价，可以用-4代替；
-        # 5、翻转比较无法用于元数据比较
-        # 综上，对于所有比较运算，翻转比较都不具备实际意义或者可用已有方式代替，因此不将其加入功能
-        # 翻转比较已通过插件实现，如有必要可通过插件调用
+        # 翻转比较运算（Reverse）交换比较运算的左值和右值：
+        # 1、翻转比较不影响相等比较的结果，因此没有对应的翻转匹配代码；
+        # 2、翻转比较无法用于元数据比较，同样没有对应的翻转匹配代码；
+        # 3、翻转正则匹配将输入数据作为正则表达式，编译结果由_RegexCompile()缓存，无效的正则表达式视为失配
+        # 翻转比较原先通过插件临时替换FieldCheck()实现，现在作为普通匹配代码直接写在字段匹配项里，可以多线程共享
         
     class PluginBase(object):
         '分析插件基类'
@@ -90,6 +98,32 @@ class AnalyseBase(object):
             # 该方法不做抽象方法，如果插件无需实现这部分分析逻辑，可不重写AnalyseSingleData()函数，默认执行原分析逻辑的单规则匹配函数
             return self._DefaultAnalyseSingleData(InputData, InputRule)
 
+        def AnalyseBatchData(self, InputBatch, InputRule):
+            '''批量版插件数据分析方法，由AnalyseMainBatch(Ordered=False)调用。InputBatch是按到达顺序逐条产出已通过该规则字段匹配的数据的迭代器，
+            本方法应是生成器，每条数据产出一个结果，定义同_DefaultSingleRuleTest()的返回值。
+            产出一条数据的结果之后，AnalyseMainBatch()先处理完这条数据的命中（生成、删除Flag，调用ActionFunc），再从InputBatch取出下一条数据，
+            因此每条数据看到的Flag和逐条调用AnalyseSingleData()时相同。插件不应预先取出后面的数据，也不应在产出结果之后再修改前面数据的状态。
+            插件可重写本方法，把规则字段解析、Flag模板处理等开销分摊到整批数据上。
+            没有重写本方法的插件，AnalyseMainBatch(Ordered=False)对每条数据调用AnalyseSingleData()'''
+            for inputData in InputBatch:
+                yield self.AnalyseSingleData(inputData, InputRule)
+
+        @staticmethod
+        def _RuleStateKey(InputRule):
+            '''按规则内容生成的键，供需要按规则保存状态（计数器等）的插件使用，状态表应有容量上限。
+            不以id(规则)为键：非受管规则不会触发OnRuleRemoved()，规则对象被回收后id还可能被其他规则复用。
+            内容相同的规则共用状态，重新构造的同样的规则dict沿用原来的状态，规则被就地修改后使用新的状态'''
+            return json.dumps(InputRule, sort_keys=True, default=repr)
+
+        def OnRuleRemoved(self, InputRule):
+            '规则从受管规则集中移除（或被替换）时调用，插件可在这里清理针对该规则编译或缓存的内容。默认不做任何处理'
+            pass
+
+        def OnFlagRemoved(self, InputFlag):
+            '''分析算法对象移除Flag时调用，自己维护Flag相关缓存的插件在这里删除对应的内容，使插件缓存和_flags保持一致。默认不做任何处理。
+            插件需要删除Flag时应调用分析算法对象的RemoveFlag()，由其统一通知所有插件'''
+            pass
+
         @property
         def PluginInstructions(self):
             '插件介绍文字'
@@ -100,14 +134,641 @@ class AnalyseBase(object):
             '插件独有的扩展规则字段，应返回一个dict()，其中key是字段名称，value是说明文字。无扩展字段可返回None'
             return self._ExtraRuleFields
 
+    class FieldMatcher(object):
+        '''编译后的字段匹配项。匹配内容的Base64解码、类型转换和正则编译在构造时一次完成，
+        匹配结果与_DefaultFieldCheck()相同。受管规则集（见LoadRules()）使用本类代替FieldCheck()'''
+
+        def __init__(self, InputFieldCheckRule, FieldType=None):
+            if type(InputFieldCheckRule) != dict:
+                raise TypeError("Invalid InputFieldCheckRule type, expecting dict")
+            self.FieldName = InputFieldCheckRule.get('FieldName')
+            self.MatchContent = InputFieldCheckRule["MatchContent"]
+            self.MatchCode = InputFieldCheckRule["MatchCode"]
+            self.FieldType = FieldType # 输入格式中声明的字段类型，见SetSchema()
+            self._Prepare()
+
+        def _Prepare(self):
+            matchContent = self.MatchContent
+            self._negative = self.MatchCode < 0
+            self._strContent = matchContent if type(matchContent) == str else str(matchContent)
+            try:
+                self._bytesContent = base64.b64decode(matchContent)
+            except Exception:
+                self._bytesContent = None # 无法解码，和二进制数据比较时按失配处理
+            try:
+                self._intContent = int(matchContent)
+            except Exception:
+                self._intContent = None
+            try:
+                self._lenContent = len(matchContent) if type(matchContent) not in (int, float, bool, complex) else None
+            except Exception:
+                self._lenContent = None
+            self._pattern = AnalyseBase._RegexCompile(self._strContent) if abs(self.MatchCode) == AnalyseBase.MatchMode.RegexMatching else None
+            self._typed, self._typedContent = self._TypedContent() if self.FieldType is not None else (False, None)
+            self._BindCheck()
+
+        def _BindCheck(self):
+            # 字段声明了类型时使用专用比较函数，字段值不是声明的类型时回退到通用比较函数
+            self._untypedCheck = AnalyseBase.FieldMatcher._Checkers.get(abs(self.MatchCode), AnalyseBase.FieldMatcher._CheckNone)
+            if getattr(self, '_typed', False) and self._untypedCheck is not AnalyseBase.FieldMatcher._CheckNone:
+                self._check = AnalyseBase.FieldMatcher._TypedCheckers[abs(self.MatchCode)]
+            else:
+                self._check = self._untypedCheck
+
+        def _TypedContent(self):
+            '''按字段类型检查匹配代码并转换匹配内容，返回(是否使用专用比较函数, 转换后的匹配内容)。
+            专用比较函数对声明类型的字段值给出和通用比较函数相同的结果：没有等价的转换结果时返回(False, None)，仍使用通用比较函数；
+            匹配代码和字段类型不相容，或者匹配内容不可能匹配该类型的任何值时抛出TypeError'''
+            fieldType, mode, matchContent = self.FieldType, abs(self.MatchCode), self.MatchContent
+            MatchMode = AnalyseBase.MatchMode
+            if mode not in AnalyseBase.FieldMatcher._Checkers:
+                return False, None
+            if mode not in AnalyseBase.FieldMatcher._TypedModes[fieldType]:
+                raise TypeError("Field '%s' (%s): MatchCode %s is not applicable" % (self.FieldName, fieldType.__name__, self.MatchCode))
+            if mode in (MatchMode.LengthEqual, MatchMode.LengthGreaterThan):
+                # 元数据比较用的是匹配内容的长度，通用比较函数把字段值截断取整
+                if self._lenContent is None:
+                    raise TypeError("Field '%s' (%s): MatchContent %r has no length" % (self.FieldName, fieldType.__name__, matchContent))
+                return fieldType == int, None
+            if mode == MatchMode.RegexMatching:
+                return True, None
+            if fieldType == str:
+                # 文本比较使用匹配内容的字符串形式
+                return True, self._strContent
+            if fieldType == bytes:
+                # 二进制比较使用Base64解码后的匹配内容
+                if self._bytesContent is not None:
+                    return True, self._bytesContent
+            elif mode == MatchMode.Equal:
+                # 类型不同时通用比较函数比较字符串形式，只有转换后字符串形式不变的数字才能匹配
+                if type(matchContent) == fieldType:
+                    return True, matchContent
+                try:
+                    typedContent = fieldType(self._strContent)
+                except ValueError:
+                    typedContent = None
+                if typedContent is not None and str(typedContent) == self._strContent:
+                    return True, typedContent
+            elif type(matchContent) in (int, float):
+                # 数字阈值原样比较，int字段的float阈值不取整
+                return True, matchContent
+            elif self._intContent is not None:
+                # 其他类型的阈值和字段值都按int比较，float字段值的截断取整没有等价的专用比较
+                return (True, self._intContent) if fieldType == int else (False, None)
+            raise TypeError("Field '%s' (%s): MatchContent %r never matches this type" % (self.FieldName, fieldType.__name__, matchContent))
+
+        @property
+        def Key(self):
+            '字段匹配项特征，字段名、匹配代码和匹配内容都相同的字段匹配项特征相同，匹配结果也相同'
+            key = (self.FieldName, self.MatchCode, type(self.MatchContent), self.MatchContent)
+            try:
+                hash(key)
+            except TypeError:
+                key = (self.FieldName, self.MatchCode, type(self.MatchContent), id(self.MatchContent))
+            return key
+
+        def __getstate__(self):
+            # 保存预处理结果，加载时不再做Base64解码和类型转换；匹配函数和正则表达式对象不能序列化，加载时重新绑定
+            state = dict(self.__dict__)
+            state.pop('_check', None)
+            state.pop('_untypedCheck', None)
+            state.pop('_pattern', None)
+            return state
+
+        def __setstate__(self, InputState):
+            self.FieldType = None
+            self.__dict__.update(InputState)
+            if '_strContent' not in InputState:
+                # 只包含字段名、匹配内容和匹配代码的旧格式
+                self._Prepare()
+                return
+            self._BindCheck()
+            self._pattern = AnalyseBase._RegexCompile(self._strContent) if abs(self.MatchCode) == AnalyseBase.MatchMode.RegexMatching else None
+
+        def __call__(self, TargetData):
+            return self._negative ^ self._check(self, TargetData) # 负数代码，结果取反
+
+        def _CheckNone(self, TargetData):
+            return False
+
+        def _CheckEqual(self, TargetData):
+            if type(TargetData) in (bytes, bytearray):
+                if self._bytesContent is None:
+                    return False
+                matchContent = self._bytesContent
+            else:
+                matchContent = self.MatchContent
+            if type(matchContent) == type(TargetData):
+                return matchContent == TargetData
+            try:
+                return (self._strContent if matchContent is self.MatchContent else str(matchContent)) == str(TargetData)
+            except Exception:
+                return False
+
+        def _CheckTextMatching(self, TargetData):
+            if type(TargetData) in (bytes, bytearray):
+                return self._bytesContent is not None and self._bytesContent in TargetData
+            try:
+                return self._strContent in (TargetData if type(TargetData) == str else str(TargetData))
+            except Exception:
+                return False
+
+        def _CheckRegexMatching(self, TargetData):
+            return bool(self._pattern.match(TargetData if type(TargetData) == str else str(TargetData)))
+
+        def _CheckGreaterThan(self, TargetData):
+            if type(self.MatchContent) in (int, float) and type(TargetData) in (int, float):
+                return self.MatchContent > TargetData
+            try:
+                return self._intContent is not None and self._intContent > int(TargetData)
+            except Exception:
+                return False
+
+        def _CheckLengthEqual(self, TargetData):
+            try:
+                return self._lenContent is not None and self._lenContent == int(TargetData)
+            except Exception:
+                return False
+
+        def _CheckLengthGreaterThan(self, TargetData):
+            try:
+                return self._lenContent is not None and self._lenContent > int(TargetData)
+            except Exception:
+                return False
+
+        def _CheckReversedTextMatching(self, TargetData):
+            if type(TargetData) in (bytes, bytearray):
+                return self._bytesContent is not None and TargetData in self._bytesContent
+            try:
+                return (TargetData if type(TargetData) == str else str(TargetData)) in self._strContent
+            except Exception:
+                return False
+
+        def _CheckReversedRegexMatching(self, TargetData):
+            try:
+                return bool(AnalyseBase._RegexCompile(TargetData if type(TargetData) == str else str(TargetData)).match(self._strContent))
+            except re.error:
+                return False
+
+        def _CheckReversedGreaterThan(self, TargetData):
+            if type(self.MatchContent) in (int, float) and type(TargetData) in (int, float):
+                return TargetData > self.MatchContent
+            try:
+                return self._intContent is not None and int(TargetData) > self._intContent
+            except Exception:
+                return False
+
+        # 字段声明了类型时使用的专用比较函数，匹配内容在编译时已转换成字段类型，比较时不再做类型转换
+
+        def _TypedCheckEqual(self, TargetData):
+            if type(TargetData) is self.FieldType:
+                return self._typedContent == TargetData
+            return self._untypedCheck(self, TargetData)
+
+        def _TypedCheckTextMatching(self, TargetData):
+            if type(TargetData) is self.FieldType:
+                return self._typedContent in TargetData
+            return self._untypedCheck(self, TargetData)
+
+        def _TypedCheckRegexMatching(self, TargetData):
+            if type(TargetData) is self.FieldType:
+                return self._pattern.match(TargetData) is not None
+            return self._untypedCheck(self, TargetData)
+
+        def _TypedCheckGreaterThan(self, TargetData):
+            if type(TargetData) is self.FieldType:
+                return self._typedContent > TargetData
+            return self._untypedCheck(self, TargetData)
+
+        def _TypedCheckLengthEqual(self, TargetData):
+            if type(TargetData) is self.FieldType:
+                return self._lenContent == TargetData
+            return self._untypedCheck(self, TargetData)
+
+        def _TypedCheckLengthGreaterThan(self, TargetData):
+            if type(TargetData) is self.FieldType:
+                return self._lenContent > TargetData
+            return self._untypedCheck(self, TargetData)
+
+        def _TypedCheckReversedTextMatching(self, TargetData):
+            if type(TargetData) is self.FieldType:
+                return TargetData in self._typedContent
+            return self._untypedCheck(self, TargetData)
+
+        def _TypedCheckReversedRegexMatching(self, TargetData):
+            if type(TargetData) is self.FieldType:
+                try:
+                    return AnalyseBase._RegexCompile(TargetData).match(self._typedContent) is not None
+                except re.error:
+                    return False
+            return self._untypedCheck(self, TargetData)
+
+        def _TypedCheckReversedGreaterThan(self, TargetData):
+            if type(TargetData) is self.FieldType:
+                return TargetData > self._typedContent
+            return self._untypedCheck(self, TargetData)
+
+    FieldMatcher._Checkers = {
+        MatchMode.Equal: FieldMatcher._CheckEqual,
+        MatchMode.TextMatching: FieldMatcher._CheckTextMatching,
+        MatchMode.RegexMatching: FieldMatcher._CheckRegexMatching,
+        MatchMode.GreaterThan: FieldMatcher._CheckGreaterThan,
+        MatchMode.LengthEqual: FieldMatcher._CheckLengthEqual,
+        MatchMode.LengthGreaterThan: FieldMatcher._CheckLengthGreaterThan,
+        MatchMode.ReversedTextMatching: FieldMatcher._CheckReversedTextMatching,
+        MatchMode.ReversedRegexMatching: FieldMatcher._CheckReversedRegexMatching,
+        MatchMode.ReversedGreaterThan: FieldMatcher._CheckReversedGreaterThan
+    }
+    FieldMatcher._TypedCheckers = {
+        MatchMode.Equal: FieldMatcher._TypedCheckEqual,
+        MatchMode.TextMatching: FieldMatcher._TypedCheckTextMatching,
+        MatchMode.RegexMatching: FieldMatcher._TypedCheckRegexMatching,
+        MatchMode.GreaterThan: FieldMatcher._TypedCheckGreaterThan,
+        MatchMode.LengthEqual: FieldMatcher._TypedCheckLengthEqual,
+        MatchMode.LengthGreaterThan: FieldMatcher._TypedCheckLengthGreaterThan,
+        MatchMode.ReversedTextMatching: FieldMatcher._TypedCheckReversedTextMatching,
+        MatchMode.ReversedRegexMatching: FieldMatcher._TypedCheckReversedRegexMatching,
+        MatchMode.ReversedGreaterThan: FieldMatcher._TypedCheckReversedGreaterThan
+    }
+    # 各字段类型可用的匹配代码，其他组合在编译时报错：
+    # 文本和正则匹配要求字段是字符串，数字字段的大小比较和元数据比较（字段值是长度）要求字段是数字，二进制字段只能做相等和包含比较
+    FieldMatcher._TypedModes = {
+        str: (MatchMode.Equal, MatchMode.TextMatching, MatchMode.RegexMatching, MatchMode.ReversedTextMatching, MatchMode.ReversedRegexMatching),
+        int: (MatchMode.Equal, MatchMode.GreaterThan, MatchMode.LengthEqual, MatchMode.LengthGreaterThan, MatchMode.ReversedGreaterThan),
+        float: (MatchMode.Equal, MatchMode.GreaterThan, MatchMode.LengthEqual, MatchMode.LengthGreaterThan, MatchMode.ReversedGreaterThan),
+        bytes: (MatchMode.Equal, MatchMode.TextMatching, MatchMode.ReversedTextMatching)
+    }
+
+    class CompiledRule(object):
+        '编译后的规则，受管规则集中的每条规则对应一个实例。原规则保存在Rule属性里，传给ActionFunc和插件，编译后应视为只读'
+
+        def __init__(self, RuleId, InputRule, InputPlugins, InputSchema=None):
+            if type(InputRule) != dict:
+                raise TypeError("Invalid InputRule type, expecting dict")
+            self.RuleId = RuleId
+            self.Rule = InputRule
+            self.Operator = InputRule.get('Operator', 0)
+            self.PrevFlag = InputRule.get('PrevFlag')
+            self.CurrentFlag = InputRule.get('CurrentFlag')
+            self.RemoveFlag = InputRule.get('RemoveFlag')
+            self.Priority = InputRule.get('Priority', 0)
+            # 入口点规则：没有前序Flag（包括多Flag插件的PrevFlags），过载时可以被跳过而不会打断已有的时序链
+            self.Entry = not self.PrevFlag and not InputRule.get('PrevFlags')
+            # 会读取或删除的Flag模板，用于维护Flag依赖图
+            consumedTemplates = dict()
+            for fieldName in AnalyseBase.RuleSet.FlagConsumerFields:
+                templates = InputRule.get(fieldName)
+                for template in ([templates] if type(templates) == str else templates or ()):
+                    if template and type(template) == str:
+                        consumedTemplates[template] = None
+            self.ConsumedTemplates = tuple(consumedTemplates)
+            fieldCheckList = InputRule.get('FieldCheckList')
+            fieldCheckList = fieldCheckList.values() if type(fieldCheckList) == dict else (fieldCheckList or ())
+            try:
+                self.FieldMatchers = tuple(
+                    AnalyseBase.FieldMatcher(x, InputSchema.get(x.get('FieldName')) if InputSchema and type(x) == dict else None) for x in fieldCheckList
+                )
+            except TypeError as e:
+                raise TypeError("Rule '%s': %s" % (RuleId, e))
+            self.PluginNames = tuple(filter(None, map(lambda str:str.strip(), InputRule.get('PluginNames', '').split(';'))))
+            # 插件流水线在编译时解析，不存在的插件和SingleRuleTest()一样直接略过
+            self.Plugins = tuple(filter(None, map(InputPlugins.get, self.PluginNames)))
+
+        def __getstate__(self):
+            # 原规则和插件对象不序列化，从编译缓存加载后由分析算法对象重新绑定，见_LoadRuleSetCache()
+            state = dict(self.__dict__)
+            state['Rule'] = None
+            state['Plugins'] = ()
+            return state
+
+    class RuleSet(object):
+        # 会读取或删除Flag的规则字段，PrevFlags和RemoveFlags来自多Flag插件
+        FlagConsumerFields = ('PrevFlag', 'PrevFlags', 'RemoveFlag', 'RemoveFlags')
+
+        '受管规则集快照。规则变更时构造新的快照整体替换，正在执行的AnalyseMain()继续使用旧快照'
+
+        def __init__(self, InputRules=(), BaseRuleSet=None):
+            self.Rules = tuple(InputRules) # 按执行顺序排列的CompiledRule
+            self.RuleMap = {x.RuleId: x for x in self.Rules} # 规则ID-CompiledRule映射
+            # 字段名-FieldResultCache。结果位图的布局属于本快照，缓存也随快照替换，由分析算法对象在启用快照时创建，见EnableFieldCache()
+            self.FieldCaches = dict()
+            self._BuildIndexes(BaseRuleSet)
+
+        def __getstate__(self):
+            state = dict(self.__dict__)
+            state.pop('MatcherBits') # 以id()为键，加载后重建
+            state.pop('FieldCaches')
+            state.pop('_ruleIds', None)
+            return state
+
+        def __setstate__(self, InputState):
+            self.__dict__.update(InputState)
+            self.FieldCaches = dict()
+            keyBits = {x.Key: i for fieldMatchers in self.FieldMatchers.values() for i, x in enumerate(fieldMatchers)}
+            self.MatcherBits = {id(x): keyBits[x.Key] for compiledRule in self.Rules for x in compiledRule.FieldMatchers}
+
+        def RuleIdOf(self, InputRule):
+            '按规则dict查找规则ID，不是本快照的规则时返回None。映射在首次调用时建立（缓存加载时规则dict会重新绑定）'
+            ruleIds = self.__dict__.get('_ruleIds')
+            if ruleIds is None:
+                ruleIds = self._ruleIds = {id(x.Rule): x.RuleId for x in self.Rules}
+            ruleId = ruleIds.get(id(InputRule))
+            if ruleId is None or self.RuleMap[ruleId].Rule is not InputRule:
+                return None
+            return ruleId
+
+        @property
+        def DeadTemplates(self):
+            '没有任何规则能用到的CurrentFlag模板'
+            return self.FlagGraph.DeadTemplates
+
+        def _BuildIndexes(self, BaseRuleSet=None):
+            # 字段索引：字段名-该字段上特征各不相同的FieldMatcher列表，列表下标即该字段匹配项在结果位图中的位置
+            self.FieldMatchers = dict()
+            self.MatcherBits = dict() # id(FieldMatcher)-在所属字段结果位图中的位置
+            keyBits = dict()
+            for compiledRule in self.Rules:
+                for matcher in compiledRule.FieldMatchers:
+                    key = matcher.Key
+                    if key not in keyBits:
+                        fieldMatchers = self.FieldMatchers.setdefault(matcher.FieldName, [])
+                        keyBits[key] = len(fieldMatchers)
+                        fieldMatchers.append(matcher)
+                    self.MatcherBits[id(matcher)] = keyBits[key]
+            # Flag依赖图：从基础快照复制，只按增删的规则增量更新
+            if BaseRuleSet is None:
+                self.FlagGraph = AnalyseBase.FlagGraph()
+                for compiledRule in self.Rules:
+                    self.FlagGraph.AddRule(compiledRule)
+            else:
+                self.FlagGraph = BaseRuleSet.FlagGraph.Copy()
+                for compiledRule in BaseRuleSet.Rules:
+                    if self.RuleMap.get(compiledRule.RuleId) is not compiledRule:
+                        self.FlagGraph.RemoveRule(compiledRule)
+                for compiledRule in self.Rules:
+                    if BaseRuleSet.RuleMap.get(compiledRule.RuleId) is not compiledRule:
+                        self.FlagGraph.AddRule(compiledRule)
+
+        @staticmethod
+        @functools.lru_cache(maxsize=4096)
+        def _TemplateParts(InputTemplate):
+            '把Flag模板拆分成(首个占位符之前的文本, 末个占位符之后的文本, 是否包含占位符)'
+            try:
+                parts = list(string.Formatter().parse(InputTemplate))
+            except ValueError:
+                return InputTemplate, InputTemplate, False
+            if not any(x[1] is not None for x in parts):
+                return InputTemplate, InputTemplate, False
+            prefix = parts[0][0]
+            suffix = parts[-1][0] if parts[-1][1] is None else ''
+            return prefix, suffix, True
+
+        @staticmethod
+        def TemplatesMayCollide(TemplateA, TemplateB):
+            '''两个Flag模板是否可能生成相同的Flag，保守判断：只比较首尾的固定文本，拿不准时视为可能相同。
+            两者都不含占位符时直接比较文本'''
+            if TemplateA == TemplateB:
+                return True
+            prefixA, suffixA, varA = AnalyseBase.RuleSet._TemplateParts(TemplateA)
+            prefixB, suffixB, varB = AnalyseBase.RuleSet._TemplateParts(TemplateB)
+            if not varA and not varB:
+                return TemplateA == TemplateB
+            if not varA or not varB:
+                # 一边是固定文本，只需要另一边的首尾文本能套得上
+                text, prefix, suffix = (TemplateA, prefixB, suffixB) if not varA else (TemplateB, prefixA, suffixA)
+                return text.startswith(prefix) and text.endswith(suffix) and len(text) >= len(prefix) + len(suffix)
+            return (prefixA.startswith(prefixB) or prefixB.startswith(prefixA)) and (suffixA.endswith(suffixB) or suffixB.endswith(suffixA))
+
+    class FlagGraph(object):
+        '''Flag依赖图：CurrentFlag模板-可能读取或删除该模板所生成Flag的规则ID集合，没有规则的模板即DeadTemplates。
+        生产者模板和消费者模板都按首个占位符之前的固定文本建索引，TemplatesMayCollide()只需比较固定文本互为前缀的模板，
+        增删一条规则的开销和相关模板的数量成正比。每个规则集快照持有自己的副本，修改前先Copy()，集合只整体替换不原地修改'''
+
+        def __init__(self):
+            self.Edges = dict() # CurrentFlag模板-消费者规则ID frozenset
+            self.DeadTemplates = set()
+            self._producerRefs = dict() # CurrentFlag模板-使用该模板的规则数量
+            self._consumerRules = dict() # 消费者模板-使用该模板的规则ID frozenset
+            self._producerPrefixes = dict() # 固定前缀-CurrentFlag模板frozenset
+            self._consumerPrefixes = dict() # 固定前缀-消费者模板frozenset
+            self._producerPrefixList = [] # 排序的固定前缀，用于查找以某个前缀开头的更长前缀
+            self._consumerPrefixList = []
+
+        def Copy(self):
+            rtn = AnalyseBase.FlagGraph.__new__(AnalyseBase.FlagGraph)
+            rtn.__dict__.update({k: type(v)(v) for k, v in self.__dict__.items()})
+            return rtn
+
+        @staticmethod
+        def _IndexAdd(PrefixMap, PrefixList, InputTemplate):
+            prefix = AnalyseBase.RuleSet._TemplateParts(InputTemplate)[0]
+            templates = PrefixMap.get(prefix)
+            if templates is None:
+                bisect.insort(PrefixList, prefix)
+                templates = frozenset()
+            PrefixMap[prefix] = templates | {InputTemplate}
+
+        @staticmethod
+        def _IndexRemove(PrefixMap, PrefixList, InputTemplate):
+            prefix = AnalyseBase.RuleSet._TemplateParts(InputTemplate)[0]
+            templates = PrefixMap[prefix] - {InputTemplate}
+            if templates:
+                PrefixMap[prefix] = templates
+            else:
+                del PrefixMap[prefix]
+                del PrefixList[bisect.bisect_left(PrefixList, prefix)]
+
+        @staticmethod
+        def _Colliding(PrefixMap, PrefixList, InputTemplate):
+            '索引中可能和InputTemplate生成相同Flag的模板：先按固定前缀互为前缀筛选，再逐个TemplatesMayCollide()'
+            prefix = AnalyseBase.RuleSet._TemplateParts(InputTemplate)[0]
+            candidates = []
+            for i in range(len(prefix) + 1):
+                candidates.extend(PrefixMap.get(prefix[:i], ()))
+            i = bisect.bisect_right(PrefixList, prefix)
+            while i < len(PrefixList) and PrefixList[i].startswith(prefix):
+                candidates.extend(PrefixMap[PrefixList[i]])
+                i += 1
+            return [x for x in candidates if AnalyseBase.RuleSet.TemplatesMayCollide(InputTemplate, x)]
+
+        def AddRule(self, InputCompiledRule):
+            ruleId = InputCompiledRule.RuleId
+            for template in InputCompiledRule.ConsumedTemplates:
+                ruleIds = self._consumerRules.get(template)
+                if ruleIds is None:
+                    AnalyseBase.FlagGraph._IndexAdd(self._consumerPrefixes, self._consumerPrefixList, template)
+                    ruleIds = frozenset()
+                self._consumerRules[template] = ruleIds | {ruleId}
+                for producer in AnalyseBase.FlagGraph._Colliding(self._producerPrefixes, self._producerPrefixList, template):
+                    self.Edges[producer] = self.Edges[producer] | {ruleId}
+                    self.DeadTemplates.discard(producer)
+            template = InputCompiledRule.CurrentFlag
+            if template and type(template) == str:
+                refs = self._producerRefs.get(template, 0)
+                self._producerRefs[template] = refs + 1
+                if not refs:
+                    AnalyseBase.FlagGraph._IndexAdd(self._producerPrefixes, self._producerPrefixList, template)
+                    self.Edges[template] = frozenset(
+                        x for consumer in AnalyseBase.FlagGraph._Colliding(self._consumerPrefixes, self._consumerPrefixList, template)
+                        for x in self._consumerRules[consumer]
+                    )
+                    if not self.Edges[template]:
+                        self.DeadTemplates.add(template)
+
+        def RemoveRule(self, InputCompiledRule):
+            '移除规则。规则ID在同一个快照中唯一，被移除规则的全部消费关系一并删除'
+            ruleId = InputCompiledRule.RuleId
+            for template in InputCompiledRule.ConsumedTemplates:
+                ruleIds = self._consumerRules[template] - {ruleId}
+                if ruleIds:
+                    self._consumerRules[template] = ruleIds
+                else:
+                    del self._consumerRules[template]
+                    AnalyseBase.FlagGraph._IndexRemove(self._consumerPrefixes, self._consumerPrefixList, template)
+                for producer in AnalyseBase.FlagGraph._Colliding(self._producerPrefixes, self._producerPrefixList, template):
+                    self.Edges[producer] = self.Edges[producer] - {ruleId}
+                    if not self.Edges[producer]:
+                        self.DeadTemplates.add(producer)
+            template = InputCompiledRule.CurrentFlag
+            if template and type(template) == str:
+                refs = self._producerRefs[template] - 1
+                if refs:
+                    self._producerRefs[template] = refs
+                else:
+                    del self._producerRefs[template]
+                    AnalyseBase.FlagGraph._IndexRemove(self._producerPrefixes, self._producerPrefixList, template)
+                    del self.Edges[template]
+                    self.DeadTemplates.discard(template)
+
+    class LoadShedder(object):
+        '''过载保护：按每条数据的平均分析耗时和外部报告的积压量计算负载，超出预算时从低优先级开始抽样跳过入口点规则。
+        入口点规则按优先级分档，Level是当前跳过的档数（浮点数）：整数部分以下的档全部跳过，所在的档按小数部分的比例抽样跳过。
+        负载超出预算时Level每条数据增加Step，否则减少Step，负载恢复后逐步回到0。后续规则不受影响，已有的时序链可以继续完成'''
+
+        def __init__(self, LatencyBudget, MaxBacklog=0, Smoothing=0.05, Step=0.05):
+            self.LatencyBudget = LatencyBudget # 每条数据的平均分析耗时预算，单位是秒
+            self.MaxBacklog = MaxBacklog # 积压量预算，0表示不按积压量判断
+            self.Smoothing = Smoothing # 平均耗时的指数滑动平均系数
+            self.Step = Step
+            self.Level = 0.0
+            self.EventTime = 0.0 # 每条数据分析耗时的滑动平均
+            self.Backlog = 0
+            self.Shed = 0
+            self.ShedByRule = dict() # 规则ID-被跳过次数
+            self._tiers = dict() # 入口点规则优先级-档位，优先级最低的是0档
+            self._tierCount = 0
+
+        def SetRuleSet(self, InputRuleSet):
+            priorities = sorted({x.Priority for x in InputRuleSet.Rules if x.Entry})
+            self._tiers = {x: i for i, x in enumerate(priorities)}
+            self._tierCount = len(priorities)
+            self.Level = min(self.Level, self._tierCount)
+
+        def Observe(self, Seconds):
+            '记录一条数据的分析耗时并调整Level'
+            self.EventTime += (Seconds - self.EventTime) * self.Smoothing
+            overloaded = self.EventTime > self.LatencyBudget or (self.MaxBacklog and self.Backlog > self.MaxBacklog)
+            if overloaded:
+                self.Level = min(self._tierCount, self.Level + self.Step)
+            elif self.Level:
+                self.Level = max(0.0, self.Level - self.Step)
+
+        def ShouldShed(self, InputCompiledRule):
+            '入口点规则本次是否跳过，跳过的计入统计'
+            level = self.Level
+            if not level or not InputCompiledRule.Entry:
+                return False
+            tier = self._tiers.get(InputCompiledRule.Priority, 0)
+            if tier >= level or (tier >= int(level) and random.random() >= level - tier):
+                return False
+            self.Shed += 1
+            self.ShedByRule[InputCompiledRule.RuleId] = self.ShedByRule.get(InputCompiledRule.RuleId, 0) + 1
+            return True
+
+        @property
+        def Stats(self):
+            return {
+                'Level': self.Level,
+                'EventTime': self.EventTime,
+                'Backlog': self.Backlog,
+                'Shed': self.Shed,
+                'ShedByRule': dict(self.ShedByRule)
+            }
+
+    class FieldResultCache(object):
+        '单个字段的匹配结果缓存（LRU），字段值-该字段上所有字段匹配项结果位图'
+
+        def __init__(self, MaxSize):
+            self.MaxSize = MaxSize
+            self.Hits = 0
+            self.Misses = 0
+            self._cache = OrderedDict()
+
+        def Get(self, InputValue, InputMatchers):
+            '返回字段值对应的结果位图，未命中时计算该字段上全部字段匹配项并缓存。不可哈希的值不缓存'
+            try:
+                key = (type(InputValue), InputValue)
+                rtn = self._cache.get(key)
+            except TypeError:
+                return AnalyseBase.FieldResultCache.Evaluate(InputValue, InputMatchers)
+            if rtn is not None:
+                self.Hits += 1
+                self._cache.move_to_end(key)
+                return rtn
+            self.Misses += 1
+            rtn = self._cache[key] = AnalyseBase.FieldResultCache.Evaluate(InputValue, InputMatchers)
+            if len(self._cache) > self.MaxSize:
+                self._cache.popitem(last=False)
+            return rtn
+
+        @staticmethod
+        def Evaluate(InputValue, InputMatchers):
+            rtn = 0
+            for i, matcher in enumerate(InputMatchers):
+                if matcher(InputValue):
+                    rtn |= 1 << i
+            return rtn
+
+        def Clear(self):
+            self._cache.clear()
+
+        @property
+        def Stats(self):
+            total = self.Hits + self.Misses
+            return {'Hits': self.Hits, 'Misses': self.Misses, 'HitRate': self.Hits / total if total else 0.0, 'Size': len(self._cache)}
+
     _flags = dict() # Flag-缓存对象字典
     _plugins = dict() # 插件名-插件对象实例字典
+    _FlagMissing = object() # Flag不存在的标记
     _pluginExtraRuleFields = dict() # 插件专属规则字段名-插件对象字典，暂无实际应用
 
     PluginDir = os.path.abspath(os.path.dirname(__file__)) + '/plugins/' # 插件存放路径
 
     def __init__(self):
+        self._ruleSet = None # 受管规则集快照，见LoadRules()
+        self._rulesLock = threading.Lock() # 规则变更互斥锁，只有修改规则集的操作需要加锁
+        self._templateRefs = dict() # CurrentFlag模板-引用该模板的受管规则数量
+        self._templateFlags = dict() # CurrentFlag模板-由该模板生成的存活Flag集合
+        self._flagTemplates = dict() # Flag-生成该Flag的CurrentFlag模板
+        self._fieldCacheSizes = dict() # 启用了匹配结果缓存的字段名-缓存大小，见EnableFieldCache()
+        self._flagIndexes = dict() # 占位符字段名-(字段值-Flag集合)二级索引，见EnableFlagIndex()
+        self._flagIndexKeys = dict() # Flag-该Flag所在的(占位符字段名, 字段值)集合，移除Flag时据此维护索引
+        self._deadFlags = OrderedDict() # 没有规则会用到的Flag-生成模板，按写入顺序排列，见_TrackDeadFlag()
+        self.DeadFlagLimit = 100000 # 没有规则会用到的Flag最多保留的数量
+        self.ConflictPolicy = AnalyseBase.ConflictPolicyCode.Skip # Flag冲突处理方式
+        self.ConflictStats = {'Conflicts': 0, 'Suppressed': 0} # Flag冲突次数、被抑制的命中次数
+        self._suppression = None # (是否受管规则, 规则ID或id(规则), Flag)-(最后一次触发时间, 非受管规则本身)，见SetSuppression()
+        self._suppressionInterval = 0
+        self._suppressionMaxSize = 0
+        self._suppressionTimeField = None
+        self._shedder = None # 过载保护，见SetLoadShedding()
+        self._profiler = None # 抽样性能剖析器，见SetProfiler()
+        self._schema = None # 输入格式，字段名-字段类型，见SetSchema()
         self.__LoadPlugins('AnalysePlugin')
+        # 重写了OnFlagRemoved()的插件，RemoveFlag()时逐个通知
+        self._flagRemovedHooks = tuple(
+            x.OnFlagRemoved for x in self._plugins.values() if type(x).OnFlagRemoved is not AnalyseBase.PluginBase.OnFlagRemoved
+        )
 
     def __getPlugin(self):
         return filter(
@@ -136,9 +797,454 @@ class AnalyseBase(object):
             print("{0} plugin(s) loaded.".format(len(self._plugins)))
 
 
+    def AddFlag(self, InputFlag, InputItem, InputData=None, InputRule=None):
+        '写入Flag及其对应的用户数据对象。InputData和InputRule是生成该Flag的数据和规则，供派生类记录Flag来源，可根据需要在派生类里重写'
+        self._flags[InputFlag] = InputItem
+        self._RecordFlag(InputFlag, InputData, InputRule)
+
+    def _RecordFlag(self, InputFlag, InputData, InputRule):
+        '记录已写入的Flag的来源模板和二级索引'
+        if self._ruleSet is not None and InputRule:
+            # 使用受管规则集时记录Flag由哪个模板生成，规则移除后据此回收孤立的Flag
+            template = InputRule.get('CurrentFlag')
+            self._flagTemplates[InputFlag] = template
+            self._templateFlags.setdefault(template, set()).add(InputFlag)
+        if self._flagIndexes and InputRule:
+            self._IndexFlag(InputFlag, InputData, InputRule.get('CurrentFlag'))
+
     def RemoveFlag(self, InputFlag):
-        '尝试移除指定的Flag'
+        '尝试移除指定的Flag，并通知各插件删除该Flag的相关缓存'
+        if not InputFlag:
+            return
         self._flags.pop(InputFlag, None)
+        self._deadFlags.pop(InputFlag, None)
+        template = self._flagTemplates.pop(InputFlag, None)
+        if template is not None:
+            self._templateFlags.get(template, set()).discard(InputFlag)
+        for fieldName, value in self._flagIndexKeys.pop(InputFlag, ()):
+            flags = self._flagIndexes.get(fieldName, {}).get(value)
+            if flags is not None:
+                flags.discard(InputFlag)
+                if not flags:
+                    self._flagIndexes[fieldName].pop(value, None)
+        for hook in self._flagRemovedHooks:
+            hook(InputFlag)
+
+    def EnableFlagIndex(self, FieldName):
+        '''为Flag模板中的占位符字段（例如{src_ip}）建立二级索引，之后可用FlagQuery()按字段值查询存活的Flag。
+        索引随Flag写入和移除增量维护；已存在的Flag按其生成模板从Flag内容中解析字段值补建索引'''
+        if FieldName in self._flagIndexes:
+            return
+        self._flagIndexes[FieldName] = dict()
+        for flag, template in list(self._flagTemplates.items()):
+            self._IndexFlag(flag, None, template, (FieldName,))
+
+    def DisableFlagIndex(self, FieldName):
+        self._flagIndexes.pop(FieldName, None)
+        for flag in list(self._flagIndexKeys):
+            indexKeys = self._flagIndexKeys.get(flag)
+            if indexKeys:
+                indexKeys.difference_update([x for x in indexKeys if x[0] == FieldName])
+
+    def FlagQuery(self, FieldName, InputValue):
+        '''查询模板占位符字段值为InputValue的存活Flag，返回[(Flag, 用户数据对象)]，耗时和结果数量成正比。
+        只读取索引的快照，不会阻塞分析过程，查询期间被移除的Flag不会出现在结果里。字段未建立索引时抛出KeyError'''
+        flags = tuple(self._flagIndexes[FieldName].get(str(InputValue), ()))
+        rtn = []
+        for flag in flags:
+            item = self._flags.get(flag, AnalyseBase._FlagMissing)
+            if item is not AnalyseBase._FlagMissing:
+                rtn.append((flag, item))
+        return rtn
+
+    def _IndexFlag(self, InputFlag, InputData, InputTemplate, FieldNames=None):
+        '把Flag加入各占位符字段的二级索引。有生成数据时从数据取字段值，否则按模板从Flag内容中解析'
+        if not InputTemplate or type(InputTemplate) != str:
+            return
+        templateFields, pattern = AnalyseBase._TemplateIndexInfo(InputTemplate)
+        fieldNames = [x for x in (FieldNames or self._flagIndexes) if x in templateFields]
+        if not fieldNames:
+            return
+        if InputData is None:
+            match = pattern.match(InputFlag) if pattern is not None else None
+            if match is None:
+                return
+            values = {x: match.group(templateFields[x]) for x in fieldNames}
+        else:
+            try:
+                values = {x: self.FlagGenerator(InputData, '{%s}' % x) for x in fieldNames}
+            except Exception:
+                return
+        indexKeys = self._flagIndexKeys.setdefault(InputFlag, set())
+        for fieldName in fieldNames:
+            value = values[fieldName]
+            self._flagIndexes[fieldName].setdefault(value, set()).add(InputFlag)
+            indexKeys.add((fieldName, value))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _TemplateIndexInfo(InputTemplate):
+        '''解析Flag模板，返回(占位符字段名-正则分组名dict, 从Flag内容反解字段值的正则表达式)。
+        同一字段出现多次时只取第一次；模板无法解析时正则表达式为None'''
+        fields = dict()
+        regex = []
+        try:
+            for literal, fieldName, formatSpec, conversion in string.Formatter().parse(InputTemplate):
+                regex.append(re.escape(literal))
+                if fieldName is None:
+                    continue
+                rootName = re.split(r'[.\[]', fieldName, 1)[0]
+                if rootName in fields or formatSpec or conversion or rootName != fieldName:
+                    regex.append('.*?')
+                else:
+                    fields[rootName] = 'g%s' % len(fields)
+                    regex.append('(?P<%s>.*?)' % fields[rootName])
+        except ValueError:
+            return dict(), None
+        return fields, re.compile(''.join(regex) + r'\Z', re.S)
+
+    def SetSuppression(self, Interval, MaxSize=100000, TimeField=None):
+        '''设置命中抑制：同一条规则生成的同一个Flag在Interval秒内只触发一次ActionFunc()，Interval为0时关闭。
+        最多记录MaxSize个(规则, Flag)，超过时淘汰最早的记录。TimeField是数据中的时间戳字段名（秒，数字或数字字符串），为空、数据中没有该字段或者无法转换成数字时使用本机单调时钟'''
+        self._suppressionInterval = Interval
+        self._suppressionMaxSize = MaxSize
+        self._suppressionTimeField = TimeField
+        self._suppression = OrderedDict() if Interval else None
+
+    def SetLoadShedding(self, LatencyBudget, MaxBacklog=0, Smoothing=0.05, Step=0.05):
+        '''启用受管规则集的过载保护。LatencyBudget是每条数据的平均分析耗时预算（秒），MaxBacklog是积压量预算，
+        积压量由调用方通过ReportBacklog()报告。LatencyBudget为None时关闭'''
+        if LatencyBudget is None:
+            self._shedder = None
+            return
+        shedder = AnalyseBase.LoadShedder(LatencyBudget, MaxBacklog, Smoothing, Step)
+        if self._ruleSet is not None:
+            shedder.SetRuleSet(self._ruleSet)
+        self._shedder = shedder
+
+    def ReportBacklog(self, InputBacklog):
+        '报告调用方输入队列当前的积压量'
+        if self._shedder is not None:
+            self._shedder.Backlog = InputBacklog
+
+    def LoadSheddingStats(self):
+        '过载保护的当前档位、平均耗时、积压量和各规则被跳过的次数，未启用时返回None'
+        return self._shedder.Stats if self._shedder is not None else None
+
+    def OnDuplicate(self, InputData, InputRule, HitItem, CurrentFlag, ExistingItem):
+        '''冲突处理方式为Hook时，规则命中但本级Flag已经存在时调用，ExistingItem是已存在Flag的用户数据对象。
+        返回值不为空时加入AnalyseMain()的返回值集合。可根据需要在派生类里重写，默认不做任何处理'''
+        return None
+
+    def _Suppressed(self, InputData, InputRule, CurrentFlag):
+        '''检查(规则, Flag)是否在抑制期内，不在抑制期内时记录本次触发时间。
+        受管规则按规则ID记录；非受管规则按id(规则)记录，并保存规则本身，id被其他规则复用时不继承原来的记录'''
+        suppression = self._suppression
+        now = None
+        if self._suppressionTimeField:
+            try:
+                now = float(InputData[self._suppressionTimeField])
+            except (KeyError, TypeError, ValueError):
+                pass
+            if now is not None and now != now:
+                now = None # NaN
+        if now is None:
+            # 没有时间戳字段或者时间戳无效时使用本机单调时钟
+            now = time.monotonic()
+        ruleSet = self._ruleSet
+        ruleId = ruleSet.RuleIdOf(InputRule) if ruleSet is not None else None
+        if ruleId is not None:
+            key, owner = (True, ruleId, CurrentFlag), None
+        else:
+            key, owner = (False, id(InputRule), CurrentFlag), InputRule
+        record = suppression.get(key)
+        if record is not None and record[1] is owner and now - record[0] < self._suppressionInterval:
+            return True
+        # 记录按触发时间排序，顺带回收最早的过期记录
+        suppression.pop(key, None)
+        suppression[key] = (now, owner)
+        while True:
+            oldestKey = next(iter(suppression))
+            if now - suppression[oldestKey][0] < self._suppressionInterval:
+                break
+            del suppression[oldestKey]
+        while len(suppression) > self._suppressionMaxSize:
+            suppression.popitem(last=False)
+        return False
+
+    def _TrackDeadFlag(self, InputFlag, InputTemplate):
+        '''记录没有规则会用到的Flag。这类Flag照常写入_flags，Flag冲突检查和FlagQuery()对它们同样有效，
+        但最多保留DeadFlagLimit个，超过时按写入顺序回收最早的，回收之后同样的数据会再次触发ActionFunc()'''
+        deadFlags = self._deadFlags
+        deadFlags.pop(InputFlag, None)
+        deadFlags[InputFlag] = InputTemplate
+        while len(deadFlags) > self.DeadFlagLimit:
+            flag, template = deadFlags.popitem(last=False)
+            # 规则变更后模板又被用到的Flag不回收
+            if self._flagTemplates.get(flag) == template and not self.FlagConsumable(template):
+                self.RemoveFlag(flag)
+
+    def FlagConsumable(self, InputTemplate):
+        '受管规则集中是否有规则可能用到该CurrentFlag模板生成的Flag。未加载受管规则集时总是返回True'
+        ruleSet = self._ruleSet
+        return ruleSet is None or InputTemplate not in ruleSet.DeadTemplates
+
+    def LoadRules(self, InputRules, CachePath=None):
+        '''加载受管规则集，替换当前的受管规则集。InputRules可以是规则ID-规则的dict，也可以是规则list，
+        list中的规则以RuleId字段作为规则ID，没有该字段时以下标作为规则ID。
+        加载之后调用AnalyseMain()时InputRules传None即使用受管规则集。受管规则在加载时编译，之后可用AddRule()、RemoveRule()、ReplaceRule()逐条变更。
+        指定CachePath时使用编译缓存文件：缓存键（规则内容、算法版本和插件集合的哈希）一致时直接加载编译结果，否则编译并重新写入缓存文件'''
+        if type(InputRules) == dict:
+            ruleItems = list(InputRules.items())
+        else:
+            ruleItems = [(x.get('RuleId', i) if type(x) == dict else i, x) for i, x in enumerate(InputRules)]
+        with self._rulesLock:
+            oldRuleSet = self._ruleSet or AnalyseBase.RuleSet()
+            newRuleSet = None
+            if CachePath:
+                cacheKey = self._RuleSetCacheKey(ruleItems)
+                newRuleSet = self._LoadRuleSetCache(CachePath, cacheKey, ruleItems)
+            if newRuleSet is None:
+                newRuleSet = AnalyseBase.RuleSet(self._CompileRules(ruleItems))
+                if len(newRuleSet.RuleMap) != len(newRuleSet.Rules):
+                    raise KeyError("Duplicated RuleId in InputRules.")
+                if CachePath:
+                    self._SaveRuleSetCache(CachePath, cacheKey, newRuleSet)
+            self._SwapRuleSet(oldRuleSet, newRuleSet)
+
+    # 编译缓存文件格式：魔数、格式版本、32字节缓存键，之后是pickle序列化的RuleSet
+    _RuleSetCacheMagic = b'AFRC'
+    _RuleSetCacheVersion = 4 # 编译结果的结构变化时递增
+
+    def _RuleSetCacheKey(self, InputRuleItems):
+        '缓存键：规则内容、缓存格式版本、算法源代码、输入格式以及各插件源代码的SHA-256'
+        digest = hashlib.sha256()
+        digest.update(json.dumps([[repr(ruleId), rule] for ruleId, rule in InputRuleItems], sort_keys=True, default=repr).encode('utf-8'))
+        digest.update(AnalyseBase._EngineFingerprint())
+        if self._schema:
+            digest.update(repr(sorted((k, v.__name__) for k, v in self._schema.items())).encode('utf-8'))
+        for pluginName in sorted(self._plugins):
+            digest.update(pluginName.encode('utf-8'))
+            digest.update(AnalyseBase._FileFingerprint(getattr(self._plugins[pluginName], '_PluginFilePath', None)))
+        return digest.digest()
+
+    @staticmethod
+    def _EngineFingerprint():
+        return str(AnalyseBase._RuleSetCacheVersion).encode() + AnalyseBase._FileFingerprint(os.path.abspath(__file__))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _FileFingerprint(InputPath):
+        if not InputPath:
+            return b''
+        try:
+            with open(InputPath, 'rb') as f:
+                return hashlib.sha256(f.read()).digest()
+        except OSError:
+            return b''
+
+    def _LoadRuleSetCache(self, InputPath, InputKey, InputRuleItems):
+        '读取编译缓存，缓存键不一致或文件无效时返回None。加载后把原规则和插件对象重新绑定到CompiledRule上'
+        header = AnalyseBase._RuleSetCacheMagic + AnalyseBase._RuleSetCacheVersion.to_bytes(4, 'little') + InputKey
+        try:
+            with open(InputPath, 'rb') as f:
+                if f.read(len(header)) != header:
+                    return None
+                try:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        ruleSet = pickle.loads(memoryview(mm)[len(header):])
+                except (ValueError, OSError):
+                    # 不支持mmap的文件系统
+                    ruleSet = pickle.loads(f.read())
+        except Exception:
+            return None
+        if type(ruleSet) != AnalyseBase.RuleSet or len(ruleSet.Rules) != len(InputRuleItems):
+            return None
+        for compiledRule, (ruleId, rule) in zip(ruleSet.Rules, InputRuleItems):
+            compiledRule.Rule = rule
+            compiledRule.Plugins = tuple(filter(None, map(self._plugins.get, compiledRule.PluginNames)))
+        return ruleSet
+
+    def _SaveRuleSetCache(self, InputPath, InputKey, InputRuleSet):
+        '写入编译缓存，先写临时文件再替换，写入失败不影响规则加载'
+        tempPath = '%s.%s.tmp' % (InputPath, os.getpid())
+        try:
+            with open(tempPath, 'wb') as f:
+                f.write(AnalyseBase._RuleSetCacheMagic + AnalyseBase._RuleSetCacheVersion.to_bytes(4, 'little') + InputKey)
+                pickle.dump(InputRuleSet, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tempPath, InputPath)
+        except Exception:
+            try:
+                os.remove(tempPath)
+            except OSError:
+                pass
+
+    def UpdateRules(self, InputRules=None, RemoveRuleIds=()):
+        '''受管规则集增量变更，作为一个整体原子生效。InputRules是规则ID-规则的dict，ID已存在的规则原位替换，不存在的追加到末尾；
+        RemoveRuleIds是需要移除的规则ID列表，不存在的ID会抛出KeyError。只有变更的规则会重新编译'''
+        InputRules = InputRules or dict()
+        with self._rulesLock:
+            oldRuleSet = self._ruleSet or AnalyseBase.RuleSet()
+            for ruleId in RemoveRuleIds:
+                if ruleId not in oldRuleSet.RuleMap:
+                    raise KeyError("Rule '%s' not found." % ruleId)
+            compiledRules = {x.RuleId: x for x in self._CompileRules(InputRules.items())}
+            removeRuleIds = set(RemoveRuleIds)
+            newRules = [
+                compiledRules.pop(x.RuleId, x)
+                for x in oldRuleSet.Rules if x.RuleId not in removeRuleIds
+            ]
+            newRules.extend(compiledRules.values())
+            self._SwapRuleSet(oldRuleSet, AnalyseBase.RuleSet(newRules, oldRuleSet))
+
+    def AddRule(self, RuleId, InputRule):
+        '向受管规则集末尾追加一条规则，规则ID已存在时抛出KeyError'
+        if self._ruleSet and RuleId in self._ruleSet.RuleMap:
+            raise KeyError("Rule '%s' already exists." % RuleId)
+        self.UpdateRules({RuleId: InputRule})
+
+    def RemoveRule(self, RuleId):
+        '从受管规则集中移除一条规则。不再被任何规则引用的CurrentFlag模板所生成的Flag会被一并回收'
+        self.UpdateRules(RemoveRuleIds=[RuleId])
+
+    def ReplaceRule(self, RuleId, InputRule):
+        '原位替换受管规则集中的一条规则，规则ID不存在时抛出KeyError'
+        if not self._ruleSet or RuleId not in self._ruleSet.RuleMap:
+            raise KeyError("Rule '%s' not found." % RuleId)
+        self.UpdateRules({RuleId: InputRule})
+
+    def EnableFieldCache(self, FieldName, MaxSize=4096):
+        '''为受管规则集的指定字段启用匹配结果缓存（LRU，最多MaxSize个字段值）。
+        适用于取值重复度高的字段（UA、主机名、URL等），相同的字段值只计算一次该字段上的全部字段匹配项。
+        缓存属于规则集快照，规则变更后新快照使用新的空缓存，仍在使用旧快照的AnalyseMain()继续读写旧缓存'''
+        with self._rulesLock:
+            self._fieldCacheSizes[FieldName] = MaxSize
+            ruleSet = self._ruleSet
+            if ruleSet is not None:
+                # 整体替换字典，不修改正在被读取的字典
+                fieldCaches = dict(ruleSet.FieldCaches)
+                fieldCaches[FieldName] = AnalyseBase.FieldResultCache(MaxSize)
+                ruleSet.FieldCaches = fieldCaches
+
+    def DisableFieldCache(self, FieldName):
+        with self._rulesLock:
+            self._fieldCacheSizes.pop(FieldName, None)
+            ruleSet = self._ruleSet
+            if ruleSet is not None and FieldName in ruleSet.FieldCaches:
+                ruleSet.FieldCaches = {k: v for k, v in ruleSet.FieldCaches.items() if k != FieldName}
+
+    def FieldCacheStats(self):
+        '当前规则集快照上各字段匹配结果缓存的命中次数、未命中次数、命中率和缓存大小，规则变更后从0开始统计'
+        ruleSet = self._ruleSet
+        return {fieldName: cache.Stats for fieldName, cache in ruleSet.FieldCaches.items()} if ruleSet is not None else dict()
+
+    def _FieldCacheBits(self, InputRuleSet, FieldName, InputValue):
+        '查询字段值在规则集快照上的结果位图，该字段的缓存已被停用时直接计算'
+        fieldCache = InputRuleSet.FieldCaches.get(FieldName)
+        fieldMatchers = InputRuleSet.FieldMatchers.get(FieldName, ())
+        if fieldCache is None:
+            return AnalyseBase.FieldResultCache.Evaluate(InputValue, fieldMatchers)
+        return fieldCache.Get(InputValue, fieldMatchers)
+
+    @property
+    def RuleIds(self):
+        '受管规则集中的规则ID，按执行顺序排列'
+        return [x.RuleId for x in self._ruleSet.Rules] if self._ruleSet else []
+
+    def _CompileRule(self, RuleId, InputRule):
+        '编译单条规则，可在派生类里重写以加入其他预处理'
+        return AnalyseBase.CompiledRule(RuleId, InputRule, self._plugins, self._schema)
+
+    def _CompileRules(self, InputRuleItems):
+        '编译[(规则ID, 规则)]，设置了输入格式时汇总所有规则的类型错误后一起抛出'
+        if self._schema is None:
+            return [self._CompileRule(ruleId, rule) for ruleId, rule in InputRuleItems]
+        compiledRules, errors = [], []
+        for ruleId, rule in InputRuleItems:
+            try:
+                compiledRules.append(self._CompileRule(ruleId, rule))
+            except TypeError as e:
+                errors.append(str(e))
+        if errors:
+            raise TypeError("%d rule(s) do not match the input schema:\n%s" % (len(errors), '\n'.join(errors)))
+        return compiledRules
+
+    def SetSchema(self, InputSchema):
+        '''设置输入格式，InputSchema是字段名-字段类型的dict，类型可以是str、int、float、bytes或者对应的类型名字符串，传None取消。
+        声明了类型的字段，匹配内容在规则编译时一次转换并使用专用比较函数，对该类型的字段值给出和不声明类型时相同的结果；数字阈值不转换成字段类型。
+        匹配代码和字段类型不相容，或者匹配内容不可能匹配该类型的任何值时编译报错（TypeError）。
+        数据中该字段的值不是声明的类型时，按原来的通用比较逻辑处理。已加载受管规则集时按新的输入格式重新编译，编译失败时保持原输入格式不变'''
+        schema = None
+        if InputSchema:
+            typeNames = {x.__name__: x for x in AnalyseBase.FieldMatcher._TypedModes}
+            schema = dict()
+            for fieldName, fieldType in InputSchema.items():
+                fieldType = typeNames.get(fieldType, fieldType) if type(fieldType) == str else fieldType
+                if fieldType not in AnalyseBase.FieldMatcher._TypedModes:
+                    raise TypeError("Unsupported type for field '%s': %s" % (fieldName, fieldType))
+                schema[fieldName] = fieldType
+        oldSchema, self._schema = self._schema, schema
+        if self._ruleSet is not None:
+            try:
+                self.LoadRules({x.RuleId: x.Rule for x in self._ruleSet.Rules})
+            except Exception:
+                self._schema = oldSchema
+                raise
+
+    def _SwapRuleSet(self, OldRuleSet, NewRuleSet):
+        '用新的规则集快照替换旧快照，增量维护模板引用计数，回收孤立的Flag，并通知插件被移除的规则。调用前需持有_rulesLock'
+        removedRules = [x for x in OldRuleSet.Rules if NewRuleSet.RuleMap.get(x.RuleId) is not x]
+        addedRules = [x for x in NewRuleSet.Rules if OldRuleSet.RuleMap.get(x.RuleId) is not x]
+        for compiledRule in addedRules:
+            self._templateRefs[compiledRule.CurrentFlag] = self._templateRefs.get(compiledRule.CurrentFlag, 0) + 1
+        orphanTemplates = set()
+        for compiledRule in removedRules:
+            self._templateRefs[compiledRule.CurrentFlag] -= 1
+            if not self._templateRefs[compiledRule.CurrentFlag]:
+                self._templateRefs.pop(compiledRule.CurrentFlag)
+                orphanTemplates.add(compiledRule.CurrentFlag)
+        # 位图布局随快照变化，新快照使用新的缓存
+        NewRuleSet.FieldCaches = {k: AnalyseBase.FieldResultCache(v) for k, v in self._fieldCacheSizes.items()}
+        self._ruleSet = NewRuleSet
+        if self._shedder is not None:
+            self._shedder.SetRuleSet(NewRuleSet)
+        for template in orphanTemplates:
+            for flag in list(self._templateFlags.pop(template, ())):
+                self.RemoveFlag(flag)
+        if self._suppression and removedRules:
+            # 受管规则的抑制记录以规则ID为键，丢弃已不在规则集中的规则的记录；替换后的同ID规则保留原来的记录
+            removedIds = {x.RuleId for x in removedRules if x.RuleId not in NewRuleSet.RuleMap}
+            self._suppression = OrderedDict((k, v) for k, v in self._suppression.items() if not (k[0] and k[1] in removedIds))
+        for compiledRule in removedRules:
+            for pluginObj in compiledRule.Plugins:
+                pluginObj.OnRuleRemoved(compiledRule.Rule)
+
+    def SetFlagStore(self, InputStore):
+        '''用其他Flag存储（例如AnalyseSharedFlags.SharedFlagStore）代替本对象的_flags，接口需要和dict相同，现有的Flag会复制过去。
+        Flag来源模板、二级索引等辅助记录仍在本进程内维护，只覆盖本进程写入的Flag。
+        注意SharedFlagStore按值保存：用户数据对象写入时pickle，每次读取得到新的副本，就地修改读到的对象不会写回存储，
+        插件和ActionFunc需要更新用户数据对象时应重新写入该Flag。
+        存储提供SetIfAbsent()时，规则命中后用它原子地写入本级Flag（不经过AddFlag()）：多个进程同时生成同一个Flag时只有一个写入成功，
+        其他进程按ConflictPolicy处理冲突，ActionFunc()的返回值不写入也不返回'''
+        for flag, item in list(self._flags.items()):
+            InputStore[flag] = item
+        self._flags = InputStore
+
+    def _FlagLookup(self, InputFlag):
+        '查询一次Flag，返回(是否存在, 用户数据对象)。只调用一次get()，使用共享存储时存在与否和用户数据对象来自同一次读取'
+        item = self._flags.get(InputFlag, AnalyseBase._FlagMissing)
+        return (False, None) if item is AnalyseBase._FlagMissing else (True, item)
+
+    def FlagBatchGet(self, InputFlags):
+        '批量查询Flag，输入Flag序列，按顺序返回每个Flag对应的用户数据对象列表，不存在的Flag对应None。需要一次查询多个Flag的插件应调用本函数，而不是逐个访问_flags'
+        flagsGet = self._flags.get
+        return [flagsGet(flag) for flag in InputFlags]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _RegexCompile(InputPattern):
+        '带缓存的正则表达式编译函数，正则匹配和翻转正则匹配共用。缓存有上限，翻转正则匹配的表达式来自输入数据，不会无限增长'
+        return re.compile(InputPattern)
 
     @staticmethod
     def _DefaultFieldCheck(TargetData, InputFieldCheckRule):
@@ -180,7 +1286,7 @@ class AnalyseBase(object):
                 matchContent = str(matchContent)
             if type(TargetData) != str:
                 TargetData = str(TargetData)
-            fieldCheckResult = bool(re.match(matchContent, TargetData))
+            fieldCheckResult = bool(AnalyseBase._RegexCompile(matchContent).match(TargetData))
         elif abs(matchCode) == AnalyseBase.MatchMode.GreaterThan:
             # 大小比较（数字，字符串尝试转换成数字，转换不成功略过该字段匹配）
             if type(matchContent) in (int, float) and type(TargetData) in (int, float):
@@ -208,6 +1314,36 @@ class AnalyseBase(object):
                     pass
             else:
                 pass
+        elif abs(matchCode) == AnalyseBase.MatchMode.ReversedTextMatching:
+            # 翻转文本匹配：字段内容是匹配内容的子串
+            try:
+                if type(TargetData) in {bytes, bytearray}:
+                    matchContent = base64.b64decode(matchContent)
+                else:
+                    matchContent = str(matchContent) if type(matchContent) != str else matchContent
+                    TargetData = str(TargetData) if type(TargetData) != str else TargetData
+                fieldCheckResult = (TargetData in matchContent)
+            except:
+                pass
+        elif abs(matchCode) == AnalyseBase.MatchMode.ReversedRegexMatching:
+            # 翻转正则匹配：字段内容作为正则表达式匹配规则的匹配内容
+            if type(matchContent) != str:
+                matchContent = str(matchContent)
+            if type(TargetData) != str:
+                TargetData = str(TargetData)
+            try:
+                fieldCheckResult = bool(AnalyseBase._RegexCompile(TargetData).match(matchContent))
+            except re.error:
+                pass
+        elif abs(matchCode) == AnalyseBase.MatchMode.ReversedGreaterThan:
+            # 翻转大小比较：字段内容大于匹配内容
+            if type(matchContent) in (int, float) and type(TargetData) in (int, float):
+                fieldCheckResult = (TargetData > matchContent)
+            else:
+                try:
+                    fieldCheckResult = (int(TargetData) > int(matchContent))
+                except:
+                    pass
         else:
             pass
         fieldCheckResult = ((matchCode < 0) ^ fieldCheckResult) # 负数代码，结果取反
@@ -247,11 +1383,36 @@ class AnalyseBase(object):
         if type(InputData) != dict or type(InputRule) != dict:
             raise TypeError("Invalid InputData or InputRule type, expecting dict")
 
+        if not self._DefaultRuleFieldCheck(InputData, InputRule):
+            return (False, None)
+        return self._DefaultPrevFlagCheck(InputData, InputRule)
+
+    def _DefaultPrevFlagCheck(self, InputData, InputRule):
+        '规则的前序Flag匹配部分，返回值定义同_DefaultSingleRuleTest()函数。不涉及字段匹配'
+        if bool(InputRule["PrevFlag"]):  # 判断前序flag是否为空
+            # 检查Flag缓存，如果成功，返回一个包含两个元素的Tuple，分别是命中结果（True/False）和命中的CacheItem对象
+            # Prevflag check succeed, return (True, Hit CacheItem)
+
+            # 20201218修改本函数返回值定义
+            # Before：返回CacheItem
+            # After：返回业务层定义数据（原CacheItem.ExtraData）
+            currentFlag = self.FlagGenerator(InputData, InputRule["PrevFlag"])
+            return self._FlagLookup(currentFlag)
+        else:
+            # 前序flag为空，入口点规则，Flag匹配过程直接命中，命中的CacheItem对象为None
+            # Prevflag is '' or None, it means this is a init rule. Return (True, None)
+            return (True, None)
+
+    def _DefaultRuleFieldCheck(self, InputData, InputRule, FieldCheckFunc=None):
+        '''规则的字段匹配部分，按规则的Operator汇总FieldCheckList里各字段匹配项的结果，返回True/False。不涉及Flag
+        FieldCheckFunc可替换单个字段匹配项使用的检查函数，参数定义同FieldCheck()，默认为FieldCheck()'''
+        if not FieldCheckFunc:
+            FieldCheckFunc = AnalyseBase.FieldCheck
         fieldCheckResult = False
         if type(InputRule["FieldCheckList"]) in (dict, list) and bool(InputRule["FieldCheckList"]):
             fieldCheckResults = list(
                 map(
-                    lambda y:AnalyseBase.FieldCheck(InputData[y['FieldName']], y),
+                    lambda y:FieldCheckFunc(InputData[y['FieldName']], y),
                     filter(
                         lambda x:x.get('FieldName') in InputData,
                         InputRule["FieldCheckList"]
@@ -268,28 +1429,86 @@ class AnalyseBase(object):
             # 字段匹配列表为空，直接判定字段匹配通过
             # Field check is None, ignore it.
             fieldCheckResult = True
-
-        if not fieldCheckResult:
-            return (False, None)
-
-        if bool(InputRule["PrevFlag"]):  # 判断前序flag是否为空
-            # 检查Flag缓存，如果成功，返回一个包含两个元素的Tuple，分别是命中结果（True/False）和命中的CacheItem对象
-            # Prevflag check succeed, return (True, Hit CacheItem)
-
-            # 20201218修改本函数返回值定义
-            # Before：返回CacheItem
-            # After：返回业务层定义数据（原CacheItem.ExtraData）
-            currentFlag = self.FlagGenerator(InputData, InputRule["PrevFlag"])
-            rtn, hitItem = currentFlag in self._flags, self._flags.get(currentFlag)
-            return rtn, hitItem
-        else:
-            # 前序flag为空，入口点规则，Flag匹配过程直接命中，命中的CacheItem对象为None
-            # Prevflag is '' or None, it means this is a init rule. Return (True, None)
-            return (True, None)
+        return fieldCheckResult
 
     def _DefaultClearCache(self):
         '默认的清除缓存函数，将_flags字典清空'
+        self._flagIndexKeys.clear()
+        for flagIndex in self._flagIndexes.values():
+            flagIndex.clear()
+        for hook in self._flagRemovedHooks:
+            for flag in self._flags:
+                hook(flag)
         self._flags.clear()
+        self._templateFlags.clear()
+        self._flagTemplates.clear()
+        self._deadFlags.clear()
+
+    def _CompiledRuleFieldCheck(self, InputData, InputCompiledRule, InputRuleSet=None, FieldBits=None, InputTrace=None):
+        '''受管规则的字段匹配部分，逻辑同_DefaultRuleFieldCheck()，使用编译后的FieldMatcher。
+        FieldBits是本条数据的字段名-结果位图字典，启用了匹配结果缓存的字段从位图中读取结果。
+        传入InputTrace时不使用位图，逐个字段匹配项记录调用区间'''
+        if not InputCompiledRule.FieldMatchers:
+            return True
+        if InputTrace is not None:
+            fieldCheckResults = []
+            for matcher in InputCompiledRule.FieldMatchers:
+                if matcher.FieldName in InputData:
+                    InputTrace.Begin('FieldCheck:%s' % matcher.FieldName, {'MatchCode': matcher.MatchCode})
+                    fieldCheckResults.append(matcher(InputData[matcher.FieldName]))
+                    InputTrace.End()
+        elif FieldBits is None:
+            fieldCheckResults = [x(InputData[x.FieldName]) for x in InputCompiledRule.FieldMatchers if x.FieldName in InputData]
+        else:
+            fieldCheckResults = []
+            for matcher in InputCompiledRule.FieldMatchers:
+                fieldName = matcher.FieldName
+                if fieldName not in InputData:
+                    continue
+                if fieldName in InputRuleSet.FieldCaches:
+                    bits = FieldBits.get(fieldName)
+                    if bits is None:
+                        bits = FieldBits[fieldName] = self._FieldCacheBits(InputRuleSet, fieldName, InputData[fieldName])
+                    fieldCheckResults.append(bool(bits >> InputRuleSet.MatcherBits[id(matcher)] & 1))
+                else:
+                    fieldCheckResults.append(matcher(InputData[fieldName]))
+        if abs(InputCompiledRule.Operator) == AnalyseBase.OperatorCode.OpOr:
+            fieldCheckResult = any(fieldCheckResults)
+        elif abs(InputCompiledRule.Operator) == AnalyseBase.OperatorCode.OpAnd:
+            fieldCheckResult = all(fieldCheckResults)
+        else:
+            fieldCheckResult = False
+        return bool(fieldCheckResults) and ((InputCompiledRule.Operator < 0) ^ fieldCheckResult)
+
+    def _CompiledSingleRuleTest(self, InputData, InputCompiledRule, InputRuleSet=None, FieldBits=None, InputTrace=None):
+        '''受管规则的单规则匹配函数，返回值定义同_DefaultSingleRuleTest()。带插件的规则按编译时解析的插件流水线执行，逻辑同SingleRuleTest()。
+        InputTrace是剖析器的调用树记录对象（见AnalyseProfiler），传入时记录各个插件、字段匹配、Flag生成和Flag查询的调用区间'''
+        if InputCompiledRule.PluginNames:
+            pluginResults = set()
+            for pluginObj in InputCompiledRule.Plugins:
+                if InputTrace is None:
+                    pluginResult = pluginObj.AnalyseSingleData(InputData, InputCompiledRule.Rule)
+                else:
+                    InputTrace.Begin('Plugin:%s' % getattr(pluginObj, '_CurrentPluginName', type(pluginObj).__module__))
+                    pluginResult = pluginObj.AnalyseSingleData(InputData, InputCompiledRule.Rule)
+                    InputTrace.End()
+                pluginResults.add(pluginResult)
+                if not pluginResult[0]:
+                    break
+            return (False, None) if len(pluginResults) != 1 else pluginResults.pop()
+        if not self._CompiledRuleFieldCheck(InputData, InputCompiledRule, InputRuleSet, FieldBits, InputTrace):
+            return (False, None)
+        if InputCompiledRule.PrevFlag:
+            if InputTrace is None:
+                return self._FlagLookup(self.FlagGenerator(InputData, InputCompiledRule.PrevFlag))
+            InputTrace.Begin('FlagGenerator')
+            prevFlag = self.FlagGenerator(InputData, InputCompiledRule.PrevFlag)
+            InputTrace.End()
+            InputTrace.Begin('FlagLookup')
+            rtn = self._FlagLookup(prevFlag)
+            InputTrace.End()
+            return rtn
+        return (True, None)
 
     @staticmethod
     def FieldCheck(TargetData, InputFieldCheckRule):
@@ -355,8 +1574,16 @@ class AnalyseBase(object):
         '清除缓存方法，重置缓存状态。可根据需要在派生类里重写'
         self._DefaultClearCache()
 
-    def AnalyseMain(self, InputData, ActionFunc, InputRules):
+    def AnalyseMain(self, InputData, ActionFunc, InputRules=None):
+        profiler = self._profiler
+        if profiler is not None and profiler.Sample():
+            return self._TracedAnalyseMain(InputData, ActionFunc, InputRules, profiler)
         return self._DefaultAnalyseMain(InputData, ActionFunc, InputRules)
+
+    def SetProfiler(self, InputProfiler):
+        '''设置抽样性能剖析器（见AnalyseProfiler.EventProfiler），传None关闭。
+        剖析器抽中的数据改由_TracedAnalyseMain()分析，记录字段匹配、Flag生成、Flag查询、各个插件和ActionFunc的调用树'''
+        self._profiler = InputProfiler
     
     def _DummyActionFunc(self, InputData, rule, hitItem, currentFlag):
         import uuid
@@ -368,16 +1595,25 @@ class AnalyseBase(object):
         基础分析算法判断是否匹配分为字段匹配和Flag匹配两部分，只有都匹配成功才算该条数据匹配成功。
         ActionFunc传入一个函数，该函数需要接收命中规则的数据inputData（dict）、对应命中的规则rule（dict）、命中的缓存对象hitItem(Obj)，生成的CurrentFlag（obj）作为参数,
         如果输入数据匹配成功，数据调用传入的ActionFunction()作为输出接口，并返回一个用户自定义数据对象。
-        每成功匹配一条规则，传入的ActionFunc()将被执行一次
+        每成功匹配一条规则，传入的ActionFunc()将被执行一次。本级Flag已经存在时按ConflictPolicy处理，默认不调用ActionFunc()；SetSuppression()设置的抑制期内也不调用
         返回值是set()类型，包含了该条数据命中的所有用户自定义数据对象。如果没有命中返回长度为0的空集合（不是None）
         由于提供了单条规则匹配的方法，用户也可参考本函数自行实现分析函数
 
         Main function. Analyzing key-value based data (dict) with given rule set.
         Each time the input data hits a rule, ActionFunc() will be called once and return a user-defined data object, use this as an output interface.
         Return a set() which includes all the user-defined data object that input data hits, return an empty set if input data hits nothing (not None).
+
+        InputRules为None时使用LoadRules()加载的受管规则集，未加载受管规则集时返回None
         '''
         if InputRules == None:
-            return None
+            ruleSet = self._ruleSet # 只读取一次快照，分析过程中规则变更不影响本条数据
+            if ruleSet is None:
+                return None
+            compiledRules = ruleSet.Rules
+            fieldBits = dict() if ruleSet.FieldCaches else None # 本条数据已查询过的字段结果位图
+            shedder = self._shedder
+        else:
+            compiledRules = fieldBits = shedder = None
 
         if type(InputData) != dict:
             raise TypeError("Invalid InputData type, expecting dict()")
@@ -386,12 +1622,20 @@ class AnalyseBase(object):
             ActionFunc = self._DummyActionFunc
             
         rtn = set()  # 该条数据命中的缓存对象集合
+        if shedder is not None:
+            startTime = time.perf_counter()
 
-        for rule in InputRules:  # 规则遍历主循环
+        for rule in (InputRules if compiledRules is None else compiledRules):  # 规则遍历主循环
             # 遍历检查单条规则
             # Tests every single rule on input data
             # 如果规则包含插件调用，将在单规则检查函数SingleRuleTest()中被调用
-            ruleCheckResult, hitItem = self.SingleRuleTest(InputData, rule)
+            if compiledRules is None:
+                ruleCheckResult, hitItem = self.SingleRuleTest(InputData, rule)
+            elif shedder is not None and rule.Entry and shedder.ShouldShed(rule):
+                continue
+            else:
+                ruleCheckResult, hitItem = self._CompiledSingleRuleTest(InputData, rule, ruleSet, fieldBits)
+                rule = rule.Rule
             # 20201218 修改
             # Before：SingleRuleTest返回CacheItem
             # After：SingleRuleTest返回ExtraData
@@ -401,28 +1645,228 @@ class AnalyseBase(object):
             # 将Threshold、Lifetime和Expire功能拆分成单独的插件，基础算法不再实现该功能
 
             if ruleCheckResult:  # 字段匹配和前序Flag匹配均命中（包括前序Flag为空的情况），规则命中
-                # 1、构造本级Flag；   Generate current flag;
-                # 2、调用ActionFunc()获得用户数据，构造CacheItem对象；  Call ActionFunc() to get a user defined data
-                # 3、以本级Flag作为Key，新的CacheItem作为Value，存入self._flags[]； Save cache item into self._flags[], with current flag as key
-                currentFlag = self.FlagGenerator(InputData, rule.get("CurrentFlag"))
-                removeFlag = self.FlagGenerator(InputData, rule.get("RemoveFlag"))
-                
-                # 将命中规则的数据、规则本身、命中的缓存对象以及命中的Flag传给用户函数，获得用户函数返回值
-                newDataItem = ActionFunc(InputData, rule, hitItem, currentFlag)
-                if currentFlag and currentFlag not in self._flags:
-                    # 如果是入口点规则，命中的缓存对象是None，用户函数可据此判断
-                    self.RemoveFlag(removeFlag)
-                    # Passing the key data, hit rule itself, hit cache item (None if the data hits a init rule) and flag to ActionFunc()
-                    if newDataItem:  # 用户层还可以再做一次判断，如果用户认为已经满足字段匹配和前序FLAG匹配的数据仍不符合分析条件，可返回None，缓存数据将不会被记录
-                        # 20201222修改
-                        # 返回值由CacheItem改为业务层ActionFunc()函数的返回值
-                        # 原Flag的Threshold和Lifetime功能拆分成插件实现
-                        self._flags[currentFlag] = newDataItem
-                        rtn.add(newDataItem)
-                        # 20201222修改
-                        # Expire和Delay功能单独拆分成插件
+                self._RuleHit(InputData, ActionFunc, rule, hitItem, rtn)
+            if fieldBits and (ruleCheckResult or rule.get('PluginNames')):
+                # 插件、Flag生成和ActionFunc都可能修改数据，已查询的结果位图作废
+                fieldBits.clear()
+        if shedder is not None:
+            shedder.Observe(time.perf_counter() - startTime)
+        return rtn
+
+    def _TracedAnalyseMain(self, InputData, ActionFunc, InputRules, InputProfiler):
+        '''记录调用树的_DefaultAnalyseMain()，分析结果相同。被抽中的数据不经过匹配结果缓存，逐个字段匹配项计时；
+        过载保护仍然生效，但本条数据的耗时不计入负载'''
+        if type(InputData) != dict:
+            raise TypeError("Invalid InputData type, expecting dict()")
+        if InputRules == None:
+            ruleSet = self._ruleSet
+            if ruleSet is None:
+                return None
+        if not ActionFunc:
+            ActionFunc = self._DummyActionFunc
+        trace = InputProfiler.StartTrace()
+
+        def tracedActionFunc(InputData, InputRule, HitItem, CurrentFlag):
+            trace.Begin('ActionFunc')
+            try:
+                return ActionFunc(InputData, InputRule, HitItem, CurrentFlag)
+            finally:
+                trace.End()
+
+        rtn = set()
+        shedder = self._shedder if InputRules == None else None
+        try:
+            for rule in (InputRules if InputRules != None else ruleSet.Rules):
+                if InputRules != None:
+                    trace.Begin('Rule')
+                    ruleCheckResult, hitItem = self.SingleRuleTest(InputData, rule)
                 else:
-                    # Flag冲突
-                    # 忽略
-                    pass
-        return rtn
\ No newline at end of file
+                    trace.Begin('Rule:%s' % (rule.RuleId,))
+                    if shedder is not None and rule.Entry and shedder.ShouldShed(rule):
+                        trace.End()
+                        continue
+                    ruleCheckResult, hitItem = self._CompiledSingleRuleTest(InputData, rule, InputTrace=trace)
+                    rule = rule.Rule
+                if ruleCheckResult:
+                    trace.Begin('RuleHit')
+                    self._RuleHit(InputData, tracedActionFunc, rule, hitItem, rtn, trace)
+                    trace.End()
+                trace.End()
+        finally:
+            InputProfiler.FinishTrace(trace)
+        return rtn
+
+    def AnalyseMainBatch(self, InputBatch, ActionFunc, Ordered=True):
+        '''受管规则集的批量分析函数，返回和InputBatch等长的list，每项是对应数据的命中结果集合，定义同AnalyseMain()的返回值。未加载受管规则集时返回None。
+        Ordered为True（默认）时按到达顺序逐条分析，结果和逐条调用AnalyseMain()完全相同。
+        Ordered为False时把一批数据看作同一时刻到达：规则按顺序逐条作用于整批数据，同一条规则内数据按到达顺序处理，
+        带插件的规则逐条数据经过插件流水线，重写了AnalyseBatchData()的插件以生成器方式批量处理，其他插件逐条调用AnalyseSingleData()。
+        同一条规则内每条数据的命中（生成Flag、调用ActionFunc）处理完之后才匹配下一条数据。
+        注意这时分析结果可能和逐条分析不同：批内较早的数据也能接续批内较晚的数据在排序靠前的规则上生成的Flag（或者看不到被其删除的Flag），
+        批量大小决定了这个时间误差，只有能接受批内乱序的场景才应使用'''
+        ruleSet = self._ruleSet
+        if ruleSet is None:
+            return None
+        for inputData in InputBatch:
+            if type(inputData) != dict:
+                raise TypeError("Invalid InputData type, expecting dict()")
+        if Ordered:
+            return [self.AnalyseMain(inputData, ActionFunc) for inputData in InputBatch]
+        if not ActionFunc:
+            ActionFunc = self._DummyActionFunc
+        shedder = self._shedder
+        if shedder is not None:
+            startTime = time.perf_counter()
+
+        rtn = [set() for _ in InputBatch]
+        for compiledRule in ruleSet.Rules:
+            indexes = range(len(InputBatch))
+            if shedder is not None and compiledRule.Entry:
+                indexes = [i for i in indexes if not shedder.ShouldShed(compiledRule)]
+            if compiledRule.PluginNames:
+                # 生成器逐条产出命中，命中后立即处理
+                for i, hitItem in self._BatchPluginTest(InputBatch, indexes, compiledRule):
+                    self._RuleHit(InputBatch[i], ActionFunc, compiledRule.Rule, hitItem, rtn[i])
+            else:
+                for i in indexes:
+                    ruleCheckResult, hitItem = self._CompiledSingleRuleTest(InputBatch[i], compiledRule)
+                    if ruleCheckResult:
+                        # 命中后立即处理，同一条规则内后面的数据能看到前面数据生成和删除的Flag
+                        self._RuleHit(InputBatch[i], ActionFunc, compiledRule.Rule, hitItem, rtn[i])
+
+        if shedder is not None and InputBatch:
+            elapsed = (time.perf_counter() - startTime) / len(InputBatch)
+            for _ in InputBatch:
+                shedder.Observe(elapsed)
+        return rtn
+
+    @staticmethod
+    def _PluginHasBatch(InputPlugin):
+        return type(InputPlugin).AnalyseBatchData is not AnalyseBase.PluginBase.AnalyseBatchData
+
+    def _BatchPluginTest(self, InputBatch, InputIndexes, InputCompiledRule):
+        '''带插件规则的批量匹配，逻辑同_CompiledSingleRuleTest()的插件流水线。生成器，按到达顺序逐条产出命中的(数据下标, 命中的数据对象)。
+        流水线的每一级都是生成器，调用方处理完一条命中之后，各级插件才会继续处理下一条数据'''
+        rule = InputCompiledRule.Rule
+        stage = ((i, set()) for i in InputIndexes) # (数据下标, 各插件结果集合)
+        fieldChecked = False
+        for pluginObj in InputCompiledRule.Plugins:
+            if AnalyseBase._PluginHasBatch(pluginObj):
+                if not fieldChecked:
+                    # 批量插件只接收通过字段匹配的数据，没通过的数据结果和逐条调用时相同
+                    stage = self._FieldCheckStage(stage, InputBatch, InputCompiledRule)
+                    fieldChecked = True
+                stage = AnalyseBase._BatchPluginStage(stage, InputBatch, pluginObj, rule)
+            else:
+                stage = AnalyseBase._SinglePluginStage(stage, InputBatch, pluginObj, rule)
+        for i, results in stage:
+            if len(results) == 1:
+                yield i, next(iter(results))[1]
+
+    def _FieldCheckStage(self, InputStage, InputBatch, InputCompiledRule):
+        for i, results in InputStage:
+            if self._CompiledRuleFieldCheck(InputBatch[i], InputCompiledRule):
+                yield i, results
+
+    @staticmethod
+    def _SinglePluginStage(InputStage, InputBatch, InputPlugin, InputRule):
+        for i, results in InputStage:
+            result = InputPlugin.AnalyseSingleData(InputBatch[i], InputRule)
+            results.add(result)
+            if result[0]:
+                yield i, results
+
+    @staticmethod
+    def _BatchPluginStage(InputStage, InputBatch, InputPlugin, InputRule):
+        pending = deque() # 已交给插件、还没有产出结果的数据
+
+        def Feed():
+            for i, results in InputStage:
+                pending.append((i, results))
+                yield InputBatch[i]
+
+        for result in InputPlugin.AnalyseBatchData(Feed(), InputRule):
+            i, results = pending.popleft()
+            results.add(result)
+            if result[0]:
+                yield i, results
+
+    def _SharedConflict(self, InputData, InputRule, HitItem, CurrentFlag, NewItem, ExistingItem, Rtn):
+        '写入共享存储时发现其他进程已写入同一个Flag，按ConflictPolicy处理，ActionFunc()已经调用过'
+        self.ConflictStats['Conflicts'] += 1
+        policy = self.ConflictPolicy
+        if policy == AnalyseBase.ConflictPolicyCode.Update:
+            self._flags[CurrentFlag] = NewItem
+            Rtn.add(NewItem)
+        elif policy == AnalyseBase.ConflictPolicyCode.Hook:
+            duplicateItem = self.OnDuplicate(InputData, InputRule, HitItem, CurrentFlag, ExistingItem)
+            if duplicateItem:
+                Rtn.add(duplicateItem)
+
+    def _RuleHit(self, InputData, ActionFunc, InputRule, HitItem, Rtn, Trace=None):
+        '规则命中后的处理：构造本级Flag，调用ActionFunc()，写入Flag，并把用户数据对象加入返回值集合Rtn。Trace是被抽样剖析的数据的调用树'
+        # 1、构造本级Flag；   Generate current flag;
+        # 2、调用ActionFunc()获得用户数据，构造CacheItem对象；  Call ActionFunc() to get a user defined data
+        # 3、以本级Flag作为Key，新的CacheItem作为Value，存入self._flags[]； Save cache item into self._flags[], with current flag as key
+        if Trace is not None:
+            Trace.Begin('FlagGenerator')
+        currentFlag = self.FlagGenerator(InputData, InputRule.get("CurrentFlag"))
+        removeFlag = self.FlagGenerator(InputData, InputRule.get("RemoveFlag"))
+        if Trace is not None:
+            Trace.End()
+
+        # 先检查Flag冲突和命中抑制，再调用ActionFunc()，避免用户函数的返回值被丢弃
+        if currentFlag and self._suppression is not None and self._Suppressed(InputData, InputRule, currentFlag):
+            self.ConflictStats['Suppressed'] += 1
+            return
+        existingItem = self._flags.get(currentFlag, AnalyseBase._FlagMissing) if currentFlag else AnalyseBase._FlagMissing
+        conflict = existingItem is not AnalyseBase._FlagMissing
+        if conflict:
+            # Flag冲突
+            self.ConflictStats['Conflicts'] += 1
+            policy = self.ConflictPolicy
+            if policy == AnalyseBase.ConflictPolicyCode.Skip:
+                return
+            if policy == AnalyseBase.ConflictPolicyCode.Hook:
+                duplicateItem = self.OnDuplicate(InputData, InputRule, HitItem, currentFlag, existingItem)
+                if duplicateItem:
+                    Rtn.add(duplicateItem)
+                return
+
+        # 将命中规则的数据、规则本身、命中的缓存对象以及命中的Flag传给用户函数，获得用户函数返回值
+        newDataItem = ActionFunc(InputData, InputRule, HitItem, currentFlag)
+        if conflict:
+            if newDataItem and self.ConflictPolicy == AnalyseBase.ConflictPolicyCode.Update and currentFlag in self._flags:
+                # 就地替换用户数据对象，Flag的来源记录和索引不变
+                self._flags[currentFlag] = newDataItem
+                Rtn.add(newDataItem)
+            # 冲突处理方式为Always时返回值丢弃
+        elif currentFlag:
+            # 如果是入口点规则，命中的缓存对象是None，用户函数可据此判断
+            self.RemoveFlag(removeFlag)
+            # Passing the key data, hit rule itself, hit cache item (None if the data hits a init rule) and flag to ActionFunc()
+            if newDataItem:  # 用户层还可以再做一次判断，如果用户认为已经满足字段匹配和前序FLAG匹配的数据仍不符合分析条件，可返回None，缓存数据将不会被记录
+                # 20201222修改
+                # 返回值由CacheItem改为业务层ActionFunc()函数的返回值
+                # 原Flag的Threshold和Lifetime功能拆分成插件实现
+                if Trace is not None:
+                    Trace.Begin('FlagStore')
+                setIfAbsent = getattr(self._flags, 'SetIfAbsent', None)
+                if setIfAbsent is None:
+                    self.AddFlag(currentFlag, newDataItem, InputData, InputRule)
+                else:
+                    # 共享存储：检查和写入一次完成，其他进程在ActionFunc()期间写入了同一个Flag时按冲突处理
+                    stored, existingItem = setIfAbsent(currentFlag, newDataItem)
+                    if not stored:
+                        if Trace is not None:
+                            Trace.End()
+                        self._SharedConflict(InputData, InputRule, HitItem, currentFlag, newDataItem, existingItem, Rtn)
+                        return
+                    self._RecordFlag(currentFlag, InputData, InputRule)
+                if not self.FlagConsumable(InputRule.get("CurrentFlag")):
+                    self._TrackDeadFlag(currentFlag, InputRule.get("CurrentFlag"))
+                if Trace is not None:
+                    Trace.End()
+                Rtn.add(newDataItem)
+                # 20201222修改
+                # Expire和Delay功能单独拆分成插件
\ No newline at end of file
@@ -0,0 +1,185 @@
+'时序分析算法抽样性能剖析，记录被抽中数据的分析过程调用树，导出火焰图折叠栈和JSON调用轨迹'
+
+__author__ = 'Beta-TNT'
+
+import json, math, time, random, threading
+from collections import Counter, deque
+
+# 用法：
+# profiler = EventProfiler(SampleRate=0.001)
+# analyser.SetProfiler(profiler)
+# ...
+# profiler.WriteCollapsed('stacks.txt') # flamegraph.pl stacks.txt > flame.svg，或导入speedscope
+# profiler.WriteTrace('trace.json') # chrome://tracing、Perfetto或speedscope打开
+# 1、每条数据到达时按SampleRate抽样，抽样用倒计数实现，未抽中的数据只有一次计数器递减的开销；
+# 2、抽中的数据由分析算法的_TracedAnalyseMain()分析，逐层记录调用区间（Span）：
+#    AnalyseMain > Rule:<规则ID> > FieldCheck:<字段名> / FlagGenerator / FlagLookup / Plugin:<插件名> / RuleHit > FlagGenerator / ActionFunc / FlagStore
+# 3、折叠栈按调用路径累计自身耗时（纳秒），统计全部抽中的数据；调用树只保留最近MaxTraces条，
+#    保存时转换成只含不可变对象的扁平tuple，不增加垃圾回收的扫描负担；
+# 4、被抽中数据的分析耗时之和超过启动以来时间的MaxOverhead时，跳过本次抽样，保证整体开销不超过预算。
+#    代码生成后端的单条数据耗时很短，记录调用树的相对开销更大，这时实际抽样率会低于SampleRate
+# 被抽中的数据分析结果和未被抽中时相同
+
+class EventTrace(object):
+    '单条数据的调用树，每个区间是[名称, 开始时间, 结束时间, 子区间list, 附加信息]，时间单位是纳秒'
+
+    def __init__(self, Name, Args=None):
+        self.Root = [Name, time.perf_counter_ns(), None, [], Args]
+        self._stack = [self.Root]
+
+    def Begin(self, Name, Args=None):
+        span = [Name, time.perf_counter_ns(), None, [], Args]
+        self._stack[-1][3].append(span)
+        self._stack.append(span)
+
+    def End(self):
+        self._stack.pop()[2] = time.perf_counter_ns()
+
+    def Finish(self):
+        # 异常中断时把未结束的区间一并结束
+        while self._stack:
+            self.End()
+
+    @property
+    def Duration(self):
+        return (self.Root[2] or time.perf_counter_ns()) - self.Root[1]
+
+    def Flatten(self, InputSpan=None, Depth=0, Output=None):
+        '按先序遍历转换成((深度, 名称, 开始时间, 结束时间, 附加信息items), ...)'
+        if InputSpan is None:
+            InputSpan, Output = self.Root, []
+        Output.append((Depth, InputSpan[0], InputSpan[1], InputSpan[2], tuple(InputSpan[4].items()) if InputSpan[4] else ()))
+        for child in InputSpan[3]:
+            self.Flatten(child, Depth + 1, Output)
+        return tuple(Output)
+
+    @staticmethod
+    def ToDict(InputFlatSpans):
+        '扁平格式转换成嵌套dict，时间单位是微秒，开始时间相对于根区间'
+        rootStart = InputFlatSpans[0][2]
+        stack = []
+        for depth, name, start, end, args in InputFlatSpans:
+            span = {'Name': name, 'Start': (start - rootStart) / 1000, 'Duration': (end - start) / 1000}
+            if args:
+                span['Args'] = dict(args)
+            del stack[depth:]
+            if stack:
+                stack[-1].setdefault('Children', []).append(span)
+            stack.append(span)
+        return stack[0]
+
+
+class EventProfiler(object):
+    '抽样性能剖析器，一个剖析器可以同时给多个分析算法对象使用'
+
+    def __init__(self, SampleRate=0.001, MaxTraces=1000, MaxOverhead=0.02, Seed=None):
+        if not 0 <= SampleRate <= 1:
+            raise ValueError('SampleRate should be between 0 and 1')
+        self.SampleRate = SampleRate
+        self.MaxTraces = MaxTraces
+        self.MaxOverhead = MaxOverhead # 被抽中数据的耗时占启动以来时间的比例上限，None表示不限制
+        self._random = random.Random(Seed)
+        self._lock = threading.Lock()
+        self._countdown = self._NextCountdown()
+        self._traces = deque(maxlen=MaxTraces) # (抽样序号, 扁平格式的调用树)
+        self._stacks = Counter() # 折叠栈-自身耗时累计
+        self._epoch = time.perf_counter_ns()
+        self._seen = 0 # 经过剖析器的数据，多线程下是近似值
+        self._stats = {
+            'Sampled': 0, # 被抽中的数据
+            'Skipped': 0, # 超出开销预算而跳过的抽样
+            'TracedNanoseconds': 0 # 被抽中数据的分析耗时之和
+        }
+
+    def _NextCountdown(self):
+        # 几何分布的抽样间隔，等价于每条数据独立按SampleRate抽样
+        if self.SampleRate <= 0:
+            return math.inf
+        if self.SampleRate >= 1:
+            return 1
+        return int(math.log(1 - self._random.random()) / math.log(1 - self.SampleRate)) + 1
+
+    def Sample(self):
+        '分析算法每条数据调用一次，返回本条数据是否记录调用树'
+        self._seen += 1
+        self._countdown -= 1
+        if self._countdown > 0:
+            return False
+        with self._lock:
+            self._countdown = self._NextCountdown()
+            if self.MaxOverhead is not None and self._stats['TracedNanoseconds'] > self.MaxOverhead * (time.perf_counter_ns() - self._epoch):
+                self._stats['Skipped'] += 1
+                return False
+        return True
+
+    def StartTrace(self):
+        return EventTrace('AnalyseMain')
+
+    def FinishTrace(self, InputTrace):
+        '汇总一条数据的调用树：累计折叠栈，保存调用树'
+        InputTrace.Finish()
+        stacks = Counter()
+        self._Collapse(InputTrace.Root, '', stacks)
+        flatSpans = InputTrace.Flatten()
+        with self._lock:
+            self._stats['Sampled'] += 1
+            self._stats['TracedNanoseconds'] += InputTrace.Duration
+            self._stacks.update(stacks)
+            self._traces.append((self._stats['Sampled'], flatSpans))
+
+    def _Collapse(self, InputSpan, Prefix, Stacks):
+        # 折叠栈格式中分号是层级分隔符，名称中的分号和换行替换掉
+        path = Prefix + InputSpan[0].replace(';', ':').replace('\n', ' ')
+        selfTime = (InputSpan[2] - InputSpan[1]) - sum(x[2] - x[1] for x in InputSpan[3])
+        Stacks[path] += max(selfTime, 0)
+        for child in InputSpan[3]:
+            self._Collapse(child, path + ';', Stacks)
+
+    def Stats(self):
+        rtn = dict(self._stats)
+        rtn['Seen'] = self._seen
+        rtn['SampleRate'] = self.SampleRate
+        rtn['Traces'] = len(self._traces)
+        rtn['AverageTraceMicroseconds'] = rtn['TracedNanoseconds'] / rtn['Sampled'] / 1000 if rtn['Sampled'] else 0
+        return rtn
+
+    def Clear(self):
+        with self._lock:
+            self._traces.clear()
+            self._stacks.clear()
+            self._seen = 0
+            self._stats.update({'Sampled': 0, 'Skipped': 0, 'TracedNanoseconds': 0})
+            self._epoch = time.perf_counter_ns()
+
+    def Traces(self):
+        '最近MaxTraces条数据的调用树，嵌套dict格式'
+        with self._lock:
+            traces = list(self._traces)
+        return [dict(EventTrace.ToDict(x), Sequence=seq) for seq, x in traces]
+
+    def CollapsedStacks(self):
+        '折叠栈文本，每行是“调用路径 自身耗时纳秒”，可直接交给flamegraph.pl、inferno或speedscope'
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+        return ''.join('%s %d\n' % (path, value) for path, value in stacks if value > 0)
+
+    def TraceEvents(self):
+        '最近MaxTraces条数据的调用树，转换为Trace Event格式（chrome://tracing、Perfetto可直接打开），每条数据单独占一行（tid）'
+        with self._lock:
+            traces = list(self._traces)
+        events = []
+        for seq, flatSpans in traces:
+            for depth, name, start, end, args in flatSpans:
+                event = {'name': name, 'ph': 'X', 'ts': (start - self._epoch) / 1000, 'dur': (end - start) / 1000, 'pid': 0, 'tid': seq}
+                if args:
+                    event['args'] = dict(args)
+                events.append(event)
+        return {'traceEvents': events, 'displayTimeUnit': 'ns'}
+
+    def WriteCollapsed(self, InputPath):
+        with open(InputPath, 'w', encoding='utf-8') as f:
+            f.write(self.CollapsedStacks())
+
+    def WriteTrace(self, InputPath):
+        with open(InputPath, 'w', encoding='utf-8') as f:
+            json.dump(self.TraceEvents(), f, default=str)
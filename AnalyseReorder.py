@@ -0,0 +1,144 @@
+'时序分析算法乱序重排缓冲区，按事件时间顺序把数据送入分析算法'
+
+__author__ = 'Beta-TNT'
+
+import heapq, threading
+from enum import IntEnum
+
+# 采集端发来的数据可能乱序到达，按到达顺序分析会导致后序数据先于前序数据到达时时序链断开。
+# 重排缓冲区放在分析算法前面：
+# 1、数据按时间戳字段进入最小堆；
+# 2、水位线 = 已见到的最大事件时间 - 最大允许延迟（MaxLateness），事件时间不晚于水位线的数据按事件时间顺序出堆并送入分析算法；
+# 3、缓冲数量超过MaxBuffered时强制释放最早的数据并把水位线推进到它的事件时间，内存占用有上限；
+# 4、事件时间早于水位线的迟到数据按LatePolicy处理；
+# 5、数据流空闲时可调用AdvanceWatermark()用处理时间推进水位线，结束时调用Flush()释放全部数据。
+# 事件时间相同的数据按到达顺序释放
+
+class ReorderBuffer(object):
+    '乱序重排缓冲区'
+
+    class LatePolicyCode(IntEnum):
+        Drop = 1 # 丢弃迟到数据
+        Process = 2 # 立即送入分析算法（不保证顺序）
+        Callback = 3 # 交给LateHandler(InputData, Lateness)处理
+
+    def __init__(self, InputAnalyser, ActionFunc, TimeField, MaxLateness, MaxBuffered=100000, LatePolicy=LatePolicyCode.Process, LateHandler=None):
+        if LatePolicy == ReorderBuffer.LatePolicyCode.Callback and not callable(LateHandler):
+            raise ValueError('LateHandler is required for LatePolicy.Callback')
+        self.Analyser = InputAnalyser
+        self.ActionFunc = ActionFunc
+        self.TimeField = TimeField
+        self.MaxLateness = MaxLateness
+        self.MaxBuffered = MaxBuffered
+        self.LatePolicy = LatePolicy
+        self.LateHandler = LateHandler
+        self._heap = [] # (事件时间, 到达序号, 数据)
+        self._seq = 0
+        self._maxEventTime = None
+        self._watermark = None
+        self._lock = threading.Lock()
+        self._stats = {
+            'Received': 0, # 收到的数据
+            'Released': 0, # 按顺序送入分析算法的数据
+            'ForcedReleases': 0, # 因缓冲区满被提前释放的数据
+            'OutOfOrder': 0, # 事件时间早于已见最大事件时间、但仍在允许延迟内被重排的数据
+            'Late': 0, # 事件时间早于水位线的迟到数据
+            'LateDropped': 0,
+            'Untimed': 0, # 没有时间戳字段或时间戳无效，直接送入分析算法的数据
+            'MaxDepth': 0, # 缓冲区最大深度
+            'MaxLateness': 0, # 观察到的最大延迟（已见最大事件时间 - 事件时间）
+            'TotalLateness': 0 # 乱序数据延迟之和，用于计算平均延迟
+        }
+
+    @property
+    def Watermark(self):
+        return self._watermark
+
+    @property
+    def Depth(self):
+        return len(self._heap)
+
+    def Stats(self):
+        '缓冲区深度和延迟统计'
+        rtn = dict(self._stats)
+        rtn['Depth'] = len(self._heap)
+        rtn['Watermark'] = self._watermark
+        disordered = rtn['OutOfOrder'] + rtn['Late']
+        rtn['AverageLateness'] = rtn['TotalLateness'] / disordered if disordered else 0
+        return rtn
+
+    def Push(self, InputData):
+        '送入一条数据，返回本次释放并分析的[(数据, 命中结果)]'
+        with self._lock:
+            self._stats['Received'] += 1
+            eventTime = InputData.get(self.TimeField) if type(InputData) == dict else None
+            if type(eventTime) not in (int, float):
+                self._stats['Untimed'] += 1
+                return [(InputData, self._Analyse(InputData))]
+
+            if self._maxEventTime is not None and eventTime < self._maxEventTime:
+                lateness = self._maxEventTime - eventTime
+                self._stats['TotalLateness'] += lateness
+                if lateness > self._stats['MaxLateness']:
+                    self._stats['MaxLateness'] = lateness
+                if self._watermark is not None and eventTime < self._watermark:
+                    return self._HandleLate(InputData, lateness)
+                self._stats['OutOfOrder'] += 1
+
+            heapq.heappush(self._heap, (eventTime, self._seq, InputData))
+            self._seq += 1
+            if len(self._heap) > self._stats['MaxDepth']:
+                self._stats['MaxDepth'] = len(self._heap)
+            if self._maxEventTime is None or eventTime > self._maxEventTime:
+                self._maxEventTime = eventTime
+                self._SetWatermark(eventTime - self.MaxLateness)
+
+            rtn = self._Release()
+            while len(self._heap) > self.MaxBuffered:
+                # 缓冲区满，强制释放最早的数据，水位线随之推进，之后更早的数据按迟到处理
+                eventTime, _, inputData = heapq.heappop(self._heap)
+                self._SetWatermark(eventTime)
+                self._stats['ForcedReleases'] += 1
+                self._stats['Released'] += 1
+                rtn.append((inputData, self._Analyse(inputData)))
+            return rtn
+
+    def AdvanceWatermark(self, InputTime):
+        '数据流空闲时用处理时间推进水位线，释放事件时间不晚于InputTime - MaxLateness的数据'
+        with self._lock:
+            self._SetWatermark(InputTime - self.MaxLateness)
+            return self._Release()
+
+    def Flush(self):
+        '按事件时间顺序释放缓冲区内全部数据'
+        with self._lock:
+            if self._heap:
+                self._SetWatermark(max(x[0] for x in self._heap))
+            return self._Release()
+
+    def _SetWatermark(self, InputWatermark):
+        # 水位线只前进不后退
+        if self._watermark is None or InputWatermark > self._watermark:
+            self._watermark = InputWatermark
+
+    def _Release(self):
+        rtn = []
+        heap = self._heap
+        while heap and heap[0][0] <= self._watermark:
+            inputData = heapq.heappop(heap)[2]
+            self._stats['Released'] += 1
+            rtn.append((inputData, self._Analyse(inputData)))
+        return rtn
+
+    def _HandleLate(self, InputData, Lateness):
+        self._stats['Late'] += 1
+        if self.LatePolicy == ReorderBuffer.LatePolicyCode.Drop:
+            self._stats['LateDropped'] += 1
+            return []
+        if self.LatePolicy == ReorderBuffer.LatePolicyCode.Callback:
+            self.LateHandler(InputData, Lateness)
+            return []
+        return [(InputData, self._Analyse(InputData))]
+
+    def _Analyse(self, InputData):
+        return self.Analyser.AnalyseMain(InputData, self.ActionFunc)
@@ -0,0 +1,254 @@
+'时序分析算法日志回放工具，用于用历史日志回测规则'
+
+__author__ = 'Beta-TNT'
+
+import io, os, sys, csv, json, mmap, time, argparse, resource, itertools, multiprocessing
+from collections import Counter, deque
+from AnalyseLib import AnalyseBase
+
+# 用法：
+# python AnalyseReplay.py rules.json events.jsonl -o hits.jsonl -w 4
+# 1、输入文件用mmap映射，按块大小切分，切分点对齐到行尾；
+# 2、各块由工作进程解析（JSON Lines或CSV），主进程按块顺序把解析好的事件送入分析算法，解析和分析并行进行；
+#    正在解析和已解析待分析的块最多MaxPendingChunks个（默认工作进程数的2倍），分析慢于解析时工作进程等待，主进程内存占用有上限；
+# 3、每次规则命中写一行JSON到输出文件；
+# 4、结束时输出吞吐量、各规则命中次数和峰值内存。
+# 指定了重排时间戳字段时，事件先经过乱序重排缓冲区（见AnalyseReorder.py），按事件时间顺序送入分析算法，输出中的Event仍是事件在文件中的序号
+# 指定了抽样率时按抽样率记录调用树，结束时输出火焰图折叠栈和Trace Event格式的JSON，见AnalyseProfiler.py
+# 指定了编译缓存文件时，规则、算法和插件都没有变化则直接加载上次的编译结果，见AnalyseBase.LoadRules()
+# 只按\n分行（行尾的\r一并去掉），字段值里的U+2028等其他换行字符原样保留；
+# CSV块的切分点避开引号内的换行，字段内可以含换行，标题行不能含换行；CSV字段值都是字符串
+
+def SplitChunks(InputPath, ChunkSize, StartOffset=0, QuoteChar=None):
+    '''把文件从StartOffset开始按ChunkSize切分成若干块，切分点对齐到换行符之后，返回[(起始偏移, 结束偏移)]。
+    指定QuoteChar时（CSV）跳过引号内的换行，引号按出现次数的奇偶判断，转义的双写引号不影响结果'''
+    rtn = []
+    fileSize = os.path.getsize(InputPath)
+    if fileSize <= StartOffset:
+        return rtn
+    with open(InputPath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = StartOffset
+        inQuote = False # 已扫描部分结束时是否在引号内
+        scanned = start
+        while start < fileSize:
+            end = mm.find(b'\n', min(start + ChunkSize, fileSize) - 1)
+            while QuoteChar is not None and end != -1:
+                inQuote ^= mm[scanned:end].count(QuoteChar) % 2 == 1
+                scanned = end
+                if not inQuote:
+                    break
+                end = mm.find(b'\n', end + 1)
+            end = fileSize if end == -1 else end + 1
+            rtn.append((start, end))
+            start = scanned = end
+            inQuote = False
+    return rtn
+
+def ParseChunk(InputTask):
+    '工作进程函数：解析文件的一个块，返回(事件列表, 解析失败行数)'
+    inputPath, start, end, inputFormat, csvHeader = InputTask
+    events = []
+    errors = 0
+    with open(inputPath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        data = mm[start:end]
+    if inputFormat == 'csv':
+        # 整块作为一个流交给csv.reader，引号内的换行由csv模块处理
+        for row in csv.reader(io.StringIO(data.decode('utf-8', errors='replace'), newline='')):
+            if not row:
+                continue
+            if len(row) != len(csvHeader):
+                errors += 1
+                continue
+            events.append(dict(zip(csvHeader, row)))
+    else:
+        for line in data.split(b'\n'):
+            if line.endswith(b'\r'):
+                line = line[:-1]
+            if not line.strip():
+                continue
+            try:
+                event = json.loads(line.decode('utf-8', errors='replace'))
+            except ValueError:
+                errors += 1
+                continue
+            if type(event) == dict:
+                events.append(event)
+            else:
+                errors += 1
+    return events, errors
+
+def ParseChunks(InputPool, InputTasks, MaxPending):
+    '按块顺序返回解析结果。InputPool为None时在本进程内逐块解析，否则提交给进程池，提交后未取走结果的块最多MaxPending个'
+    if InputPool is None:
+        yield from map(ParseChunk, InputTasks)
+        return
+    taskIter = iter(InputTasks)
+    pending = deque(InputPool.apply_async(ParseChunk, (x,)) for x in itertools.islice(taskIter, max(1, MaxPending)))
+    while pending:
+        rtn = pending.popleft().get()
+        for task in itertools.islice(taskIter, 1):
+            pending.append(InputPool.apply_async(ParseChunk, (task,)))
+        yield rtn
+
+def LoadRuleFile(InputPath):
+    '读取JSON格式的规则文件，内容可以是规则list，也可以是规则ID-规则的dict'
+    with open(InputPath, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def Replay(InputRules, InputPath, OutputPath=None, Workers=None, ChunkSize=4 << 20, InputFormat=None, UseCodegen=False, ReorderField=None, MaxLateness=0, RuleCachePath=None, ProfileRate=0, ProfilePrefix='profile', MaxPendingChunks=None, LatePolicy=None, LateHandler=None):
+    '回放日志文件，返回统计信息dict。LatePolicy和LateHandler是重排缓冲区对迟到数据的处理方式，见ReorderBuffer，默认立即分析'
+    if InputFormat is None:
+        InputFormat = 'csv' if InputPath.lower().endswith('.csv') else 'jsonl'
+    if UseCodegen:
+        from AnalyseCodegen import CodegenAnalyse
+        analyser = CodegenAnalyse()
+    else:
+        analyser = AnalyseBase()
+    analyser.LoadRules(InputRules, RuleCachePath)
+    ruleIds = {id(x.Rule): x.RuleId for x in analyser._ruleSet.Rules}
+    profiler = None
+    if ProfileRate:
+        from AnalyseProfiler import EventProfiler
+        profiler = EventProfiler(ProfileRate)
+        analyser.SetProfiler(profiler)
+
+    csvHeader, startOffset = None, 0
+    if InputFormat == 'csv':
+        with open(InputPath, 'rb') as f:
+            headerLine = f.readline()
+        csvHeader = next(csv.reader([headerLine.decode('utf-8', errors='replace').rstrip('\r\n')]), None)
+        if not csvHeader:
+            raise ValueError("CSV input '%s' has no header line" % InputPath)
+        startOffset = len(headerLine)
+    tasks = [
+        (InputPath, start, end, InputFormat, csvHeader)
+        for start, end in SplitChunks(InputPath, ChunkSize, startOffset, b'"' if InputFormat == 'csv' else None)
+    ]
+
+    hitCounts = Counter()
+    outputFile = open(OutputPath, 'w', encoding='utf-8') if OutputPath else None
+    eventIndex = 0
+
+    eventIndexes = dict() # id(重排缓冲区中的事件)-事件序号，只包含还在缓冲区里的事件
+    def actionFunc(InputData, InputRule, HitItem, CurrentFlag):
+        ruleId = ruleIds.get(id(InputRule))
+        index = eventIndexes.get(id(InputData), eventIndex)
+        hitCounts[ruleId] += 1
+        if outputFile:
+            outputFile.write(json.dumps({'Event': index, 'RuleId': ruleId, 'CurrentFlag': CurrentFlag}, default=str) + '\n')
+        return (ruleId, index)
+
+    reorderBuffer = None
+    if ReorderField:
+        from AnalyseReorder import ReorderBuffer
+        reorderBuffer = ReorderBuffer(analyser, actionFunc, ReorderField, MaxLateness, LatePolicy=LatePolicy or ReorderBuffer.LatePolicyCode.Process, LateHandler=LateHandler)
+
+    startTime = time.perf_counter()
+    events = errors = 0
+    pool = multiprocessing.Pool(Workers) if Workers != 0 else None
+    if MaxPendingChunks is None:
+        MaxPendingChunks = 2 * (Workers or os.cpu_count() or 1)
+    try:
+        # 按块顺序取结果，后续的块在工作进程中继续解析，和主进程的分析过程重叠
+        for chunkEvents, chunkErrors in ParseChunks(pool, tasks, MaxPendingChunks):
+            errors += chunkErrors
+            for inputData in chunkEvents:
+                if reorderBuffer is None:
+                    analyser.AnalyseMain(inputData, actionFunc)
+                else:
+                    eventIndexes[id(inputData)] = eventIndex
+                    for releasedData, _ in reorderBuffer.Push(inputData):
+                        eventIndexes.pop(id(releasedData), None)
+                    if len(eventIndexes) > reorderBuffer.Depth:
+                        # 本条数据既没有留在缓冲区也没有被释放，即迟到后被丢弃或交给了LateHandler
+                        eventIndexes.pop(id(inputData), None)
+                eventIndex += 1
+            events += len(chunkEvents)
+        if reorderBuffer is not None:
+            reorderBuffer.Flush()
+            eventIndexes.clear()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        if outputFile:
+            outputFile.close()
+    elapsed = time.perf_counter() - startTime
+    if profiler is not None:
+        profiler.WriteCollapsed(ProfilePrefix + '.folded')
+        profiler.WriteTrace(ProfilePrefix + '.trace.json')
+
+    return {
+        'Events': events,
+        'ParseErrors': errors,
+        'Seconds': elapsed,
+        'EventsPerSecond': events / elapsed if elapsed else 0,
+        'MBPerSecond': os.path.getsize(InputPath) / elapsed / (1 << 20) if elapsed else 0,
+        'HitCounts': dict(hitCounts),
+        # Linux下ru_maxrss单位是KB
+        'PeakMemoryMB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'PeakWorkerMemoryMB': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        'Flags': len(analyser._flags),
+        'Reorder': reorderBuffer.Stats() if reorderBuffer is not None else None,
+        'Profile': profiler.Stats() if profiler is not None else None
+    }
+
+def Main(InputArgs=None):
+    parser = argparse.ArgumentParser(description='Replay archived JSON-lines/CSV logs through AnalyseBase.')
+    parser.add_argument('rules', help='rule file (JSON list, or dict of RuleId -> rule)')
+    parser.add_argument('input', help='input log file, JSON lines or CSV with header')
+    parser.add_argument('-o', '--output', help='write hits to this file as JSON lines')
+    parser.add_argument('-f', '--format', choices=['jsonl', 'csv'], help='input format, guessed from file extension by default')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='parser worker processes, 0 parses in the main process (default: CPU count)')
+    parser.add_argument('-c', '--chunk-size', type=int, default=4 << 20, help='bytes per parse chunk (default: 4MB)')
+    parser.add_argument('--codegen', action='store_true', help='use the code generation backend')
+    parser.add_argument('--reorder-field', help='reorder events by this timestamp field before analysis')
+    parser.add_argument('--max-lateness', type=float, default=0, help='how far behind the newest event time an event may arrive and still be reordered (default: 0)')
+    parser.add_argument('--drop-late', action='store_true', help='drop events that arrive later than --max-lateness instead of analysing them out of order')
+    parser.add_argument('--max-pending-chunks', type=int, default=None, help='chunks being parsed or waiting for analysis at once (default: 2 x workers)')
+    parser.add_argument('--rule-cache', help='compiled rule set cache file, reused when rules, engine and plugins are unchanged')
+    parser.add_argument('--profile-rate', type=float, default=0, help='fraction of events to trace, writes <prefix>.folded and <prefix>.trace.json (default: 0, off)')
+    parser.add_argument('--profile-prefix', default='profile', help='output path prefix for profiling results (default: profile)')
+    args = parser.parse_args(InputArgs)
+    latePolicy = None
+    if args.drop_late:
+        from AnalyseReorder import ReorderBuffer
+        latePolicy = ReorderBuffer.LatePolicyCode.Drop
+
+    stats = Replay(
+        LoadRuleFile(args.rules),
+        args.input,
+        args.output,
+        args.workers,
+        args.chunk_size,
+        args.format,
+        args.codegen,
+        args.reorder_field,
+        args.max_lateness,
+        args.rule_cache,
+        args.profile_rate,
+        args.profile_prefix,
+        args.max_pending_chunks,
+        latePolicy
+    )
+    print('events: %d, parse errors: %d, %.2fs, %.0f events/s, %.2f MB/s' % (
+        stats['Events'], stats['ParseErrors'], stats['Seconds'], stats['EventsPerSecond'], stats['MBPerSecond']
+    ))
+    print('peak memory: %.1f MB (main), %.1f MB (largest worker), live flags: %d' % (
+        stats['PeakMemoryMB'], stats['PeakWorkerMemoryMB'], stats['Flags']
+    ))
+    if stats['Reorder']:
+        print('reorder: max depth %d, out of order %d, late %d (dropped %d), forced releases %d, max lateness %s' % (
+            stats['Reorder']['MaxDepth'], stats['Reorder']['OutOfOrder'], stats['Reorder']['Late'], stats['Reorder']['LateDropped'], stats['Reorder']['ForcedReleases'], stats['Reorder']['MaxLateness']
+        ))
+    if stats['Profile']:
+        print('profile: %d events traced, %d skipped over budget, written to %s.folded and %s.trace.json' % (
+            stats['Profile']['Sampled'], stats['Profile']['Skipped'], args.profile_prefix, args.profile_prefix
+        ))
+    print('hits per rule:')
+    for ruleId, count in sorted(stats['HitCounts'].items(), key=lambda x:-x[1]):
+        print('  %s\t%d' % (ruleId, count))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(Main())
@@ -0,0 +1,423 @@
+'时序分析算法共享内存Flag存储，同一台主机上的多个工作进程共用一份_flags'
+
+__author__ = 'Beta-TNT'
+
+import time, struct, pickle, hashlib, multiprocessing
+from multiprocessing import shared_memory
+
+# 共享内存布局：
+# 1、全局头：魔数、版本、分片数量、每分片槽位数、每分片数据区字节数；
+# 2、分片头（每分片一个）：代数、存活数量、数据区已用字节数、墓碑数量；
+# 3、槽位表：每分片固定数量的定长槽位，开放寻址（线性探测，只在本分片内探测），
+#    槽位内容为版本号、状态、Flag哈希、数据区偏移、Flag长度、数据长度、过期时间；
+# 4、数据区：每分片一段，Flag（UTF-8）和pickle序列化的用户数据对象首尾相接追加写入，写入后不再修改。
+# 写操作按分片加锁（multiprocessing.Lock），不同分片的写入互不影响。
+# 读操作不加锁：槽位使用seqlock，写入前后各把版本号加1，读取时版本号为奇数或前后不一致就重试；
+# 数据区整理（回收被覆盖、删除的数据）会改变偏移，整理期间分片代数为奇数，读取时一并检查。
+# 重试时先让出CPU再逐步延长等待，多次重试仍不一致时加锁读取，读取不会因为写入方繁忙而失败。
+# 锁对象只能在创建子进程时随存储对象一起传递（作为Process或Pool的参数），其他进程按名字打开时只能读
+# SetIfAbsent()和setdefault()在分片锁内完成检查和写入，多个进程同时写入同一个Flag时只有一个成功，分析算法据此处理跨进程的Flag冲突；
+# 用户数据对象需要可以pickle，按值保存：每次读取得到新的副本，就地修改读到的对象不会写回，需要重新写入；
+# Flag来源模板等辅助记录仍保存在各进程本地
+
+class SharedFlagStore(object):
+    '基于multiprocessing.shared_memory的Flag存储，接口和dict相同，可作为分析算法对象的_flags使用，见AnalyseBase.SetFlagStore()'
+
+    _Magic = 0x47464c41 # 'ALFG'
+    _Version = 1
+    _Header = struct.Struct('<IIIIQ') # 魔数、版本、分片数、每分片槽位数、每分片数据区字节数
+    _ShardHeader = struct.Struct('<QQQQ') # 代数、存活数量、数据区已用字节数、墓碑数量
+    _Slot = struct.Struct('<IIQQIId') # 版本号、状态、哈希、偏移、Flag长度、数据长度、过期时间
+    _Seq = struct.Struct('<I')
+    _Gen = struct.Struct('<Q')
+
+    _Empty = 0
+    _Used = 1
+    _Deleted = 2 # 墓碑
+
+    _SpinRetry = 100 # 读取重试时只让出CPU的次数，之后按指数增长的间隔等待
+    _MaxRetry = 1000 # 无锁读取的重试次数，超过时加锁读取
+    _MaxBackoff = 0.001 # 读取重试的最长等待间隔（秒）
+    _MaxLoad = 0.85 # 分片内存活Flag和墓碑占槽位的比例上限，超过时整理分片，保证探测总能遇到空槽位
+
+    def __init__(self, Name=None, Slots=1 << 16, ArenaBytes=64 << 20, Shards=64, DefaultTTL=0, Create=True):
+        '''Slots和ArenaBytes是总槽位数和数据区总字节数，平均分给各分片；DefaultTTL是写入Flag的默认有效期（秒），0表示不过期。
+        Create为False时按Name打开已有的存储，只能读'''
+        self.DefaultTTL = DefaultTTL
+        if Create:
+            self._shardCount = Shards
+            self._shardSlots = max(1, Slots // Shards)
+            self._shardArena = max(1, ArenaBytes // Shards)
+            self._shm = shared_memory.SharedMemory(name=Name, create=True, size=self._TotalSize())
+            self._Header.pack_into(self._shm.buf, 0, self._Magic, self._Version, self._shardCount, self._shardSlots, self._shardArena)
+            self._locks = tuple(multiprocessing.Lock() for _ in range(Shards))
+        else:
+            self._shm = SharedFlagStore._Attach(Name)
+            self._ReadHeader()
+            self._locks = None
+        self._Layout()
+
+    @staticmethod
+    def _Attach(InputName):
+        try:
+            return shared_memory.SharedMemory(name=InputName, track=False)
+        except TypeError:
+            # 3.13之前打开的共享内存会被resource_tracker在进程退出时删除，需要注销
+            shm = shared_memory.SharedMemory(name=InputName)
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            except Exception:
+                pass
+            return shm
+
+    def _ReadHeader(self):
+        magic, version, self._shardCount, self._shardSlots, self._shardArena = self._Header.unpack_from(self._shm.buf, 0)
+        if magic != self._Magic or version != self._Version:
+            raise ValueError('not a SharedFlagStore: %s' % self._shm.name)
+
+    def _TotalSize(self):
+        return self._Header.size + self._shardCount * (self._ShardHeader.size + self._shardSlots * self._Slot.size + self._shardArena)
+
+    def _Layout(self):
+        self._buf = self._shm.buf
+        self._shardLimit = max(1, int(self._shardSlots * self._MaxLoad))
+        self._shardHeaderBase = self._Header.size
+        self._slotBase = self._shardHeaderBase + self._shardCount * self._ShardHeader.size
+        self._arenaBase = self._slotBase + self._shardCount * self._shardSlots * self._Slot.size
+
+    def __getstate__(self):
+        # 只在创建子进程时传递，锁对象随之传递，子进程可以写入
+        return {
+            'Name': self._shm.name,
+            'DefaultTTL': self.DefaultTTL,
+            'Locks': self._locks
+        }
+
+    def __setstate__(self, InputState):
+        self.DefaultTTL = InputState['DefaultTTL']
+        self._shm = SharedFlagStore._Attach(InputState['Name'])
+        self._ReadHeader()
+        self._locks = InputState['Locks']
+        self._Layout()
+
+    @property
+    def Name(self):
+        return self._shm.name
+
+    def Close(self):
+        '关闭本进程的映射'
+        self._buf = None
+        self._shm.close()
+
+    def Unlink(self):
+        '删除共享内存，通常由创建方在所有进程退出后调用'
+        self._shm.unlink()
+
+    @staticmethod
+    def _Hash(InputKey):
+        # 各进程的hash()随机化种子不同，用稳定哈希
+        return int.from_bytes(hashlib.blake2b(InputKey, digest_size=8).digest(), 'little') or 1
+
+    def _Locate(self, InputHash):
+        '返回(分片号, 分片内起始槽位)'
+        return (InputHash >> 32) % self._shardCount, InputHash % self._shardSlots
+
+    def _SlotOffset(self, Shard, Index):
+        return self._slotBase + (Shard * self._shardSlots + Index) * self._Slot.size
+
+    def _ShardOffset(self, Shard):
+        return self._shardHeaderBase + Shard * self._ShardHeader.size
+
+    def _ArenaOffset(self, Shard):
+        return self._arenaBase + Shard * self._shardArena
+
+    def _Lookup(self, InputKey):
+        '''无锁读取，返回(是否存在, 数据bytes)。分片整理或槽位写入期间重试，先让出CPU，再按指数增长的间隔等待；
+        重试_MaxRetry次仍读不到一致的结果时，持有锁的进程加锁读取一次，按名字打开的只读进程继续等待'''
+        keyBytes = InputKey.encode('utf-8') if type(InputKey) == str else None
+        if keyBytes is None:
+            return False, None
+        keyHash = self._Hash(keyBytes)
+        shard, start = self._Locate(keyHash)
+        buf = self._buf
+        shardOffset = self._ShardOffset(shard)
+        attempt = 0
+        while True:
+            gen = self._Gen.unpack_from(buf, shardOffset)[0]
+            if not gen & 1:
+                found, value, consistent = self._Probe(shard, start, keyHash, keyBytes)
+                if consistent and self._Gen.unpack_from(buf, shardOffset)[0] == gen:
+                    return found, value
+            attempt += 1
+            if attempt >= self._MaxRetry and self._locks is not None:
+                with self._locks[shard]:
+                    return self._Probe(shard, start, keyHash, keyBytes)[:2]
+            time.sleep(0 if attempt < self._SpinRetry else min(self._MaxBackoff, 1e-6 * (1 << min(attempt - self._SpinRetry, 20))))
+
+    def _Probe(self, Shard, Start, KeyHash, KeyBytes):
+        '在分片内探测Flag，返回(是否存在, 数据bytes, 读取期间槽位是否一致)'
+        buf = self._buf
+        arenaOffset = self._ArenaOffset(Shard)
+        index = Start
+        for _ in range(self._shardSlots):
+            slotOffset = self._SlotOffset(Shard, index)
+            seq, state, slotHash, offset, keyLen, valueLen, expiry = self._Slot.unpack_from(buf, slotOffset)
+            if seq & 1:
+                return False, None, False
+            if state == self._Empty:
+                break
+            if state == self._Used and slotHash == KeyHash and keyLen == len(KeyBytes):
+                recordOffset = arenaOffset + offset
+                if bytes(buf[recordOffset:recordOffset + keyLen]) == KeyBytes:
+                    found, value = False, None
+                    if not expiry or expiry > time.time():
+                        found, value = True, bytes(buf[recordOffset + keyLen:recordOffset + keyLen + valueLen])
+                    return found, value, self._Seq.unpack_from(buf, slotOffset)[0] == seq
+            index = (index + 1) % self._shardSlots
+        return False, None, True
+
+    def _WriteSlot(self, SlotOffset, State, KeyHash, Offset, KeyLen, ValueLen, Expiry):
+        buf = self._buf
+        seq = self._Seq.unpack_from(buf, SlotOffset)[0]
+        self._Seq.pack_into(buf, SlotOffset, (seq + 1) & 0xffffffff)
+        self._Slot.pack_into(buf, SlotOffset, (seq + 1) & 0xffffffff, State, KeyHash, Offset, KeyLen, ValueLen, Expiry)
+        self._Seq.pack_into(buf, SlotOffset, (seq + 2) & 0xffffffff)
+
+    def _Lock(self, Shard):
+        if self._locks is None:
+            raise PermissionError('SharedFlagStore opened by name is read-only')
+        return self._locks[Shard]
+
+    def Set(self, InputKey, InputValue, TTL=None):
+        '写入Flag，TTL为有效期（秒），None表示使用DefaultTTL'
+        self._Store(InputKey, InputValue, TTL, False)
+
+    def SetIfAbsent(self, InputKey, InputValue, TTL=None):
+        '''Flag不存在（或已过期）时写入，检查和写入在分片锁内完成。
+        返回(是否写入, 已存在的用户数据对象)，写入成功时第二项为None'''
+        stored, value = self._Store(InputKey, InputValue, TTL, True)
+        return (True, None) if stored else (False, pickle.loads(value))
+
+    def setdefault(self, InputKey, Default=None):
+        stored, value = self._Store(InputKey, Default, None, True)
+        return Default if stored else pickle.loads(value)
+
+    def _Store(self, InputKey, InputValue, TTL, IfAbsent):
+        '写入Flag，返回(是否写入, 已存在的数据bytes)。IfAbsent为True时Flag已存在则不写入'
+        keyBytes = InputKey.encode('utf-8')
+        valueBytes = pickle.dumps(InputValue, pickle.HIGHEST_PROTOCOL)
+        ttl = self.DefaultTTL if TTL is None else TTL
+        expiry = time.time() + ttl if ttl else 0.0
+        keyHash = self._Hash(keyBytes)
+        shard, start = self._Locate(keyHash)
+        recordSize = len(keyBytes) + len(valueBytes)
+        if recordSize > self._shardArena:
+            raise MemoryError('flag record larger than shard arena')
+        with self._Lock(shard):
+            shardOffset = self._ShardOffset(shard)
+            gen, count, arenaUsed, tombstones = self._ShardHeader.unpack_from(self._buf, shardOffset)
+            if arenaUsed + recordSize > self._shardArena or count + tombstones >= self._shardLimit:
+                self._Compact(shard)
+                gen, count, arenaUsed, tombstones = self._ShardHeader.unpack_from(self._buf, shardOffset)
+                if arenaUsed + recordSize > self._shardArena or count >= self._shardLimit:
+                    raise MemoryError('SharedFlagStore shard %s is full' % shard)
+            slotOffset, existing = self._FindSlot(shard, start, keyHash, keyBytes)
+            if slotOffset is None:
+                raise MemoryError('SharedFlagStore shard %s is full' % shard)
+            if existing and IfAbsent:
+                seq, state, slotHash, offset, keyLen, valueLen, slotExpiry = self._Slot.unpack_from(self._buf, slotOffset)
+                if not slotExpiry or slotExpiry > time.time():
+                    recordOffset = self._ArenaOffset(shard) + offset
+                    return False, bytes(self._buf[recordOffset + keyLen:recordOffset + keyLen + valueLen])
+            # _FindSlot()可能把过期的Flag转为墓碑，重新读取分片头
+            gen, count, arenaUsed, tombstones = self._ShardHeader.unpack_from(self._buf, shardOffset)
+            # 先写数据区，再发布槽位
+            recordOffset = self._ArenaOffset(shard) + arenaUsed
+            self._buf[recordOffset:recordOffset + recordSize] = keyBytes + valueBytes
+            state = self._Slot.unpack_from(self._buf, slotOffset)[1]
+            self._WriteSlot(slotOffset, self._Used, keyHash, arenaUsed, len(keyBytes), len(valueBytes), expiry)
+            if not existing:
+                count += 1
+                if state == self._Deleted:
+                    tombstones -= 1
+            self._ShardHeader.pack_into(self._buf, shardOffset, gen, count, arenaUsed + recordSize, tombstones)
+        return True, None
+
+    def _FindSlot(self, Shard, Start, KeyHash, KeyBytes):
+        '持有分片锁时调用，返回(槽位偏移, 是否是已存在的同一个Flag)。已过期的Flag视为墓碑'
+        buf = self._buf
+        arenaOffset = self._ArenaOffset(Shard)
+        now = time.time()
+        reuse = None
+        index = Start
+        for _ in range(self._shardSlots):
+            slotOffset = self._SlotOffset(Shard, index)
+            seq, state, slotHash, offset, keyLen, valueLen, expiry = self._Slot.unpack_from(buf, slotOffset)
+            if state == self._Empty:
+                return (reuse if reuse is not None else slotOffset), False
+            if state == self._Used:
+                if slotHash == KeyHash and keyLen == len(KeyBytes) and bytes(buf[arenaOffset + offset:arenaOffset + offset + keyLen]) == KeyBytes:
+                    return slotOffset, True
+                if expiry and expiry <= now:
+                    # 过期的Flag就地转为墓碑，不影响其他Flag的探测
+                    self._WriteSlot(slotOffset, self._Deleted, 0, 0, 0, 0, 0.0)
+                    self._AdjustCount(Shard, -1, 1)
+                    state = self._Deleted
+            if state == self._Deleted and reuse is None:
+                reuse = slotOffset
+            index = (index + 1) % self._shardSlots
+        return reuse, False
+
+    def _AdjustCount(self, Shard, CountDelta, TombstoneDelta):
+        shardOffset = self._ShardOffset(Shard)
+        gen, count, arenaUsed, tombstones = self._ShardHeader.unpack_from(self._buf, shardOffset)
+        self._ShardHeader.pack_into(self._buf, shardOffset, gen, count + CountDelta, arenaUsed, tombstones + TombstoneDelta)
+
+    def _Compact(self, Shard):
+        '持有分片锁时调用：重建分片的槽位表和数据区，回收墓碑、过期的Flag和被覆盖的数据'
+        buf = self._buf
+        shardOffset = self._ShardOffset(Shard)
+        arenaOffset = self._ArenaOffset(Shard)
+        gen = self._ShardHeader.unpack_from(buf, shardOffset)[0]
+        now = time.time()
+        records = []
+        for index in range(self._shardSlots):
+            seq, state, slotHash, offset, keyLen, valueLen, expiry = self._Slot.unpack_from(buf, self._SlotOffset(Shard, index))
+            if state == self._Used and (not expiry or expiry > now):
+                records.append((slotHash, bytes(buf[arenaOffset + offset:arenaOffset + offset + keyLen + valueLen]), keyLen, valueLen, expiry))
+        # 代数置为奇数，读取方在整理完成前不会采用读到的结果
+        self._Gen.pack_into(buf, shardOffset, gen + 1)
+        slotStart = self._SlotOffset(Shard, 0)
+        seqs = [self._Seq.unpack_from(buf, self._SlotOffset(Shard, i))[0] for i in range(self._shardSlots)]
+        buf[slotStart:slotStart + self._shardSlots * self._Slot.size] = bytes(self._shardSlots * self._Slot.size)
+        for i, seq in enumerate(seqs):
+            # 保留版本号，整理前开始的读取在槽位版本号检查时也能发现变化
+            self._Seq.pack_into(buf, self._SlotOffset(Shard, i), (seq + 2) & 0xffffffff)
+        arenaUsed = 0
+        for slotHash, record, keyLen, valueLen, expiry in records:
+            buf[arenaOffset + arenaUsed:arenaOffset + arenaUsed + len(record)] = record
+            index = slotHash % self._shardSlots
+            while self._Slot.unpack_from(buf, self._SlotOffset(Shard, index))[1] != self._Empty:
+                index = (index + 1) % self._shardSlots
+            slotOffset = self._SlotOffset(Shard, index)
+            self._Slot.pack_into(buf, slotOffset, self._Seq.unpack_from(buf, slotOffset)[0], self._Used, slotHash, arenaUsed, keyLen, valueLen, expiry)
+            arenaUsed += len(record)
+        self._ShardHeader.pack_into(buf, shardOffset, gen + 2, len(records), arenaUsed, 0)
+
+    def _Delete(self, InputKey):
+        '删除Flag，返回(是否存在, 数据bytes)'
+        if type(InputKey) != str:
+            return False, None
+        keyBytes = InputKey.encode('utf-8')
+        keyHash = self._Hash(keyBytes)
+        shard, start = self._Locate(keyHash)
+        with self._Lock(shard):
+            buf = self._buf
+            arenaOffset = self._ArenaOffset(shard)
+            index = start
+            for _ in range(self._shardSlots):
+                slotOffset = self._SlotOffset(shard, index)
+                seq, state, slotHash, offset, keyLen, valueLen, expiry = self._Slot.unpack_from(buf, slotOffset)
+                if state == self._Empty:
+                    break
+                if state == self._Used and slotHash == keyHash and keyLen == len(keyBytes):
+                    recordOffset = arenaOffset + offset
+                    if bytes(buf[recordOffset:recordOffset + keyLen]) == keyBytes:
+                        value = bytes(buf[recordOffset + keyLen:recordOffset + keyLen + valueLen])
+                        self._WriteSlot(slotOffset, self._Deleted, 0, 0, 0, 0, 0.0)
+                        self._AdjustCount(shard, -1, 1)
+                        if expiry and expiry <= time.time():
+                            return False, None
+                        return True, value
+                index = (index + 1) % self._shardSlots
+        return False, None
+
+    # dict接口
+
+    def __contains__(self, InputKey):
+        return self._Lookup(InputKey)[0]
+
+    def __getitem__(self, InputKey):
+        found, value = self._Lookup(InputKey)
+        if not found:
+            raise KeyError(InputKey)
+        return pickle.loads(value)
+
+    def get(self, InputKey, Default=None):
+        found, value = self._Lookup(InputKey)
+        return pickle.loads(value) if found else Default
+
+    def __setitem__(self, InputKey, InputValue):
+        self.Set(InputKey, InputValue)
+
+    def __delitem__(self, InputKey):
+        if not self._Delete(InputKey)[0]:
+            raise KeyError(InputKey)
+
+    _NoDefault = object()
+
+    def pop(self, InputKey, Default=_NoDefault):
+        found, value = self._Delete(InputKey)
+        if found:
+            return pickle.loads(value)
+        if Default is SharedFlagStore._NoDefault:
+            raise KeyError(InputKey)
+        return Default
+
+    def clear(self):
+        for shard in range(self._shardCount):
+            with self._Lock(shard):
+                gen = self._Gen.unpack_from(self._buf, self._ShardOffset(shard))[0]
+                self._Gen.pack_into(self._buf, self._ShardOffset(shard), gen + 1)
+                for index in range(self._shardSlots):
+                    slotOffset = self._SlotOffset(shard, index)
+                    if self._Slot.unpack_from(self._buf, slotOffset)[1] != self._Empty:
+                        self._WriteSlot(slotOffset, self._Empty, 0, 0, 0, 0, 0.0)
+                self._ShardHeader.pack_into(self._buf, self._ShardOffset(shard), gen + 2, 0, 0, 0)
+
+    def __len__(self):
+        return sum(self._ShardHeader.unpack_from(self._buf, self._ShardOffset(x))[1] for x in range(self._shardCount))
+
+    def keys(self):
+        '遍历时逐个槽位无锁读取，得到的是近似快照，包含遍历期间仍存活的Flag'
+        buf = self._buf
+        now = time.time()
+        for shard in range(self._shardCount):
+            arenaOffset = self._ArenaOffset(shard)
+            for index in range(self._shardSlots):
+                slotOffset = self._SlotOffset(shard, index)
+                seq, state, slotHash, offset, keyLen, valueLen, expiry = self._Slot.unpack_from(buf, slotOffset)
+                if seq & 1 or state != self._Used or (expiry and expiry <= now):
+                    continue
+                key = bytes(buf[arenaOffset + offset:arenaOffset + offset + keyLen])
+                if self._Seq.unpack_from(buf, slotOffset)[0] == seq:
+                    yield key.decode('utf-8')
+
+    __iter__ = keys
+
+    def items(self):
+        for key in self.keys():
+            found, value = self._Lookup(key)
+            if found:
+                yield key, pickle.loads(value)
+
+    def values(self):
+        for _, value in self.items():
+            yield value
+
+    def Stats(self):
+        '各分片合计的存活数量、墓碑数量和数据区占用'
+        count = tombstones = arenaUsed = 0
+        for shard in range(self._shardCount):
+            gen, shardCount, shardArena, shardTombstones = self._ShardHeader.unpack_from(self._buf, self._ShardOffset(shard))
+            count += shardCount
+            tombstones += shardTombstones
+            arenaUsed += shardArena
+        return {
+            'Flags': count,
+            'Tombstones': tombstones,
+            'Slots': self._shardCount * self._shardSlots,
+            'ArenaUsed': arenaUsed,
+            'ArenaBytes': self._shardCount * self._shardArena
+        }
@@ -17,6 +17,12 @@ class AnalysePlugin(AnalyseBase.PluginBase):
             int,
             lambda x:x in (-2, -1, 1, 2),
             'invalid MultiFlagOperator Code: %s, see OperatorCode defination for field check rule.'
+        ),
+        "MultiFlagThreshold": (
+            '至少命中多少个前序Flag才算命中（k-of-N）。大于0时代替MultiFlagOperator的AND/OR语义，MultiFlagOperator为负数时结果仍然取反。默认值0即不启用',
+            int,
+            lambda x:x >= 0,
+            'invalid MultiFlagThreshold: %s, expecting non-negative int.'
         )
     }
     _PluginFilePath = os.path.abspath(__file__)
@@ -28,103 +34,75 @@ class AnalysePlugin(AnalyseBase.PluginBase):
     def AnalyseSingleData(self, InputData, InputRule):
         return self._AnalyseSingleData(InputData, InputRule)
 
+    @staticmethod
+    def _FlagTemplates(InputRule, ListFieldName, SingleFieldName):
+        '合并规则的Flag模板列表字段和单Flag模板字段，去重并保持顺序。不修改规则本身'
+        templates = list(InputRule.get(ListFieldName) or ())
+        templates.append(InputRule.get(SingleFieldName))
+        return tuple(dict.fromkeys(filter(None, templates)))
+
     def _AnalyseSingleData(self, InputData, InputRule):
-        '数据分析方法接口，接收被分析的dict()类型数据和规则作为参考数据，应返回True/False'
+        '数据分析方法接口，接收被分析的dict()类型数据和规则作为参考数据，返回值定义同_DefaultSingleRuleTest()函数'
         # 由于一次构造多个CurrentFlag需要修改算法底层逻辑
         # 退而求其次，用原规则逻辑构造1个CurrentFlag
-        prevFlagsList   = InputRule.get('PrevFlags', list())
-        removeFlagsList = InputRule.get('RemoveFlags', list())
-
-        prevFlagsList.append(InputRule.get('PrevFlag'))
-        removeFlagsList.append(InputRule.get('RemoveFlag'))
-
-        rtn = (False, None)
-        if len(set(prevFlagsList)) <= 1:
-            InputRule['PrevFlag'] = list(set(prevFlagsList))[0]
-            rtn = self._DefaultAnalyseSingleData(InputData, InputRule)
-        else:            
-            fieldCheckResult = False
-            if type(InputRule["FieldCheckList"]) in (dict, list):
-                fieldCheckResults = map(
-                    lambda y:self._AnalyseBase.FieldCheck(InputData[y['FieldName']], y),
-                    filter(
-                        lambda x:x.get('FieldName') in InputData,
-                        InputRule["FieldCheckList"]
-                    )
-                )
-                if abs(InputRule["Operator"]) == self._AnalyseBase.OperatorCode.OpOr:
-                    fieldCheckResult = any(fieldCheckResults)
-                elif abs(InputRule["Operator"]) == self._AnalyseBase.OperatorCode.OpAnd:
-                    fieldCheckResult = all(fieldCheckResults)
-
-                fieldCheckResult = ((InputRule["Operator"] < 0) ^ fieldCheckResult) # 负数匹配代码结果取反
-            else:
-                # 字段匹配列表为空，直接判定字段匹配通过
-                # Field check is None, ignore it.
-                fieldCheckResult = True
+        # 规则只读，PrevFlags/RemoveFlags每次调用时临时合并，不再往规则自身的列表里追加内容
+        if not self._AnalyseBase._DefaultRuleFieldCheck(InputData, InputRule):
+            return (False, None)
 
-            if not fieldCheckResult:
-                rtn = (False, None)
-            else:
-                rtn = self.MultiPrevFlagCheck(
-                    set(
-                        map(
-                            lambda x:self._AnalyseBase.FlagGenerator(
-                                InputData,
-                                x
-                            ),
-                            filter(
-                                None,
-                                prevFlagsList
-                            )
-                        )
-                    ),
-                    InputRule['MultiFlagOperator']
-                )
-        if rtn[0]:
-            list(
-                map(
-                    self._AnalyseBase.RemoveFlag, 
-                    set(
-                        map(
-                            lambda x:self._AnalyseBase.FlagGenerator(
-                                InputData,
-                                x
-                            ),
-                            filter(
-                                None,
-                                removeFlagsList
-                            )
-                        )
-                    )
-                )
+        prevFlagTemplates = self._FlagTemplates(InputRule, 'PrevFlags', 'PrevFlag')
+        if not prevFlagTemplates:
+            # 没有任何前序Flag，入口点规则
+            rtn = (True, None)
+        else:
+            rtn = self.MultiPrevFlagCheck(
+                [self._AnalyseBase.FlagGenerator(InputData, x) for x in prevFlagTemplates],
+                InputRule.get('MultiFlagOperator', self._AnalyseBase.OperatorCode.OpAnd),
+                InputRule.get('MultiFlagThreshold', 0)
             )
+        if rtn[0]:
+            for removeFlag in {self._AnalyseBase.FlagGenerator(InputData, x) for x in self._FlagTemplates(InputRule, 'RemoveFlags', 'RemoveFlag')}:
+                self._AnalyseBase.RemoveFlag(removeFlag)
         return rtn
 
-    def MultiPrevFlagCheck(self, InputPrevFlags, InputOperator):
-        '多PrevFlag版FlagCheck函数，如果输入的多个PrevFlag按Operator，命中且仅命中了1个数据对象，则返回True, 命中的数据对象，否则返回False, None'
-        flagCheckResults = list(map(self._AnalyseBase._DefaultFlagCheck, InputPrevFlags))
-        hitResults = map(lambda x:x[0], flagCheckResults)
-        # EventItem会命中多个
-        hitEventItems = set(filter(None, map(lambda x:x[1], flagCheckResults)))
-        if abs(InputOperator) == 1:
-            hitResult = all(hitResults)
-        elif abs(InputOperator) == 2:
-            hitResult = any(hitResults)
-        hitResult = ((InputOperator < 0) ^ hitResult)
-        if hitResult:
-            if InputOperator < 0:
-                # 匹配代码为负数（取反），只要命中，无论命中了多少缓存，都返回True, None
-                return (True, None)
-            if len(hitEventItems) == 1:
-                return (True, hitEventItems.pop())
-                # 成功命中，返回命中的EventItem
+    def AnalyseBatchData(self, InputBatch, InputRule):
+        '批量版_AnalyseSingleData()，生成器，InputBatch中的数据已通过字段匹配。Flag模板列表和匹配参数只合并、解析一次，逐条数据检查、删除Flag并产出结果'
+        flagGenerator = self._AnalyseBase.FlagGenerator
+        prevFlagTemplates = self._FlagTemplates(InputRule, 'PrevFlags', 'PrevFlag')
+        removeFlagTemplates = self._FlagTemplates(InputRule, 'RemoveFlags', 'RemoveFlag')
+        operator = InputRule.get('MultiFlagOperator', self._AnalyseBase.OperatorCode.OpAnd)
+        threshold = InputRule.get('MultiFlagThreshold', 0)
+        for inputData in InputBatch:
+            if not prevFlagTemplates:
+                result = (True, None)
             else:
-                # 没有命中或者命中多个，返回False, None
-                return (False, None)
+                result = self.MultiPrevFlagCheck([flagGenerator(inputData, x) for x in prevFlagTemplates], operator, threshold)
+            if result[0]:
+                for removeFlag in {flagGenerator(inputData, x) for x in removeFlagTemplates}:
+                    self._AnalyseBase.RemoveFlag(removeFlag)
+            yield result
+
+    def MultiPrevFlagCheck(self, InputPrevFlags, InputOperator, InputThreshold=0):
+        '''多PrevFlag版Flag检查函数。InputPrevFlags中命中的Flag数量达到门槛即为命中：
+        OpAnd要求全部命中，OpOr要求至少命中1个，InputThreshold大于0时要求至少命中InputThreshold个（k-of-N），负数运算符结果取反。
+        所有Flag通过一次FlagBatchGet()批量查询，开销只和Flag数量有关。
+        命中时，如果命中的数据对象只有1个，返回(True, 数据对象)；命中多个不同的数据对象，按Flag顺序返回(True, 数据对象tuple)；
+        取反命中返回(True, None)；失配返回(False, None)'''
+        hitItems = [x for x in self._AnalyseBase.FlagBatchGet(InputPrevFlags) if x is not None]
+        if InputThreshold > 0:
+            requiredCount = InputThreshold
+        elif abs(InputOperator) == self._AnalyseBase.OperatorCode.OpOr:
+            requiredCount = 1
         else:
+            requiredCount = len(InputPrevFlags)
+        hitResult = ((InputOperator < 0) ^ (len(hitItems) >= requiredCount))
+        if not hitResult:
             # 匹配失配，返回False, None
             return (False, None)
+        if InputOperator < 0:
+            # 匹配代码为负数（取反），只要命中，无论命中了多少缓存，都返回True, None
+            return (True, None)
+        hitItems = tuple(dict.fromkeys(hitItems))
+        return (True, hitItems[0] if len(hitItems) == 1 else hitItems)
 
     @property
     def PluginInstructions(self):
@@ -0,0 +1,238 @@
+import sys, os, time, math, hashlib
+from collections import OrderedDict
+from enum import IntEnum
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import AnalyseLib
+
+class AnalysePlugin(AnalyseLib.AnalyseBase.PluginBase):
+    '概率数据结构计数插件，用Count-Min Sketch实现频次门槛，用HyperLogLog实现去重计数门槛，内存有上限'
+    # 规则命中基础算法检查之后，按SketchMode计数：
+    # Frequency：SketchKey对应的频次估计值达到SketchThreshold时规则命中，例如“同一个/24网段命中超过10000次”
+    # Distinct ：SketchKey下不同SketchItem的数量估计值达到SketchThreshold时规则命中，例如“同一个源地址访问了超过500个不同目的地址”
+    # 规则命中之后照常生成CurrentFlag，后续规则可以通过PrevFlag接续，和普通规则的时序链用法相同
+    # Frequency模式整条规则共用一个Count-Min Sketch；Distinct模式每个SketchKey一个HyperLogLog，键数量超过SketchMaxKeys时淘汰最久未命中的键
+    # 内存占用（每条规则）：
+    # Frequency：Depth*Width个计数，默认SketchError 0.01、SketchConfidence 0.99时是5*272个
+    # Distinct ：HyperLogLog按稀疏表示起步，每个键约几百字节；所有键都转换成稠密表示时最多SketchMaxKeys*2^p字节，
+    #            p=ceil(log2((1.04/SketchError)^2))，默认SketchError 0.01时p=14、每个键16KB，默认SketchMaxKeys 10000时最多约164MB。
+    #            需要限制最坏情况时调大SketchError或调小SketchMaxKeys，例如SketchError 0.05时p=9、每个键512字节
+    # 计数状态按规则内容保存（见PluginBase._RuleStateKey()），最多保留_MaxRules条规则的状态，超过时淘汰最久未命中的规则
+
+    class SketchModeCode(IntEnum):
+        Frequency = 1 # 频次，Count-Min Sketch
+        Distinct = 2 # 去重计数，HyperLogLog
+
+    @staticmethod
+    def _Hash64(InputKey):
+        '64位稳定哈希'
+        return int.from_bytes(hashlib.blake2b(str(InputKey).encode(), digest_size=8).digest(), 'big')
+
+    class CountMinSketch(object):
+        '保守更新的Count-Min Sketch。宽度ceil(e/Error)，深度ceil(ln(1/(1-Confidence)))，估计值偏大不超过Error*总计数的概率为Confidence'
+
+        def __init__(self, Error, Confidence):
+            self.Width = max(1, math.ceil(math.e / Error))
+            self.Depth = max(1, math.ceil(math.log(1 / (1 - Confidence))))
+            self.Rows = [[0] * self.Width for _ in range(self.Depth)]
+
+        def _Indexes(self, InputKey):
+            h = AnalysePlugin._Hash64(InputKey)
+            h1, h2 = h >> 32, (h & 0xffffffff) | 1
+            return [(h1 + i * h2) % self.Width for i in range(self.Depth)]
+
+        def Add(self, InputKey):
+            '计数1次，返回新的估计值'
+            indexes = self._Indexes(InputKey)
+            rows = self.Rows
+            estimate = min(rows[i][x] for i, x in enumerate(indexes)) + 1
+            for i, x in enumerate(indexes):
+                if rows[i][x] < estimate:
+                    rows[i][x] = estimate
+            return estimate
+
+        def Estimate(self, InputKey):
+            return min(self.Rows[i][x] for i, x in enumerate(self._Indexes(InputKey)))
+
+        def Decay(self, Factor):
+            '所有计数乘以Factor，Factor为0即清零'
+            if not Factor:
+                self.Rows = [[0] * self.Width for _ in range(self.Depth)]
+            else:
+                self.Rows = [[int(x * Factor) for x in row] for row in self.Rows]
+
+    class HyperLogLog(object):
+        '''HyperLogLog去重计数器，寄存器数量2^Precision，相对标准误差约1.04/sqrt(2^Precision)。增量维护调和和，估计值O(1)。
+        寄存器先用稀疏表示（只保存非零寄存器的dict），非零寄存器超过2^Precision/64个时转换成每个寄存器1字节的稠密表示，
+        两种表示的寄存器值和估计值完全相同。见过的不同对象很少的计数键只占用几百字节'''
+
+        def __init__(self, Precision):
+            self.Precision = Precision
+            self.Registers = dict() # 稀疏表示：寄存器编号-寄存器值；转换后是bytearray
+            self._sparseLimit = (1 << Precision) >> 6
+            self._harmonicSum = float(1 << Precision) # sum(2^-register)
+            self._zeros = 1 << Precision
+
+        @property
+        def Sparse(self):
+            return type(self.Registers) is dict
+
+        def Add(self, InputItem):
+            h = AnalysePlugin._Hash64(InputItem)
+            restBits = 64 - self.Precision
+            index = h >> restBits
+            rho = restBits - (h & ((1 << restBits) - 1)).bit_length() + 1
+            registers = self.Registers
+            old = registers.get(index, 0) if type(registers) is dict else registers[index]
+            if rho > old:
+                registers[index] = rho
+                self._harmonicSum += 2.0 ** -rho - 2.0 ** -old
+                if not old:
+                    self._zeros -= 1
+                    if type(registers) is dict and len(registers) > self._sparseLimit:
+                        self._ToDense()
+
+        def _ToDense(self):
+            registers = bytearray(1 << self.Precision)
+            for index, value in self.Registers.items():
+                registers[index] = value
+            self.Registers = registers
+
+        def Estimate(self):
+            m = 1 << self.Precision
+            alpha = 0.7213 / (1 + 1.079 / m) if m >= 128 else {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+            estimate = alpha * m * m / self._harmonicSum
+            if estimate <= 2.5 * m and self._zeros:
+                # 小基数区间用线性计数修正
+                estimate = m * math.log(m / self._zeros)
+            return estimate
+
+    class SketchState(object):
+        '单条规则的计数状态'
+
+        def __init__(self, InputRule, InputTime):
+            self.Mode = InputRule.get('SketchMode', AnalysePlugin.SketchModeCode.Frequency)
+            check, message = AnalysePlugin._ExtraRuleFields['SketchMode'][2:]
+            if not check(self.Mode):
+                raise ValueError(message % self.Mode)
+            self.Error = InputRule.get('SketchError') or 0.01
+            self.WindowStart = InputTime
+            if self.Mode == AnalysePlugin.SketchModeCode.Frequency:
+                self.Sketch = AnalysePlugin.CountMinSketch(self.Error, InputRule.get('SketchConfidence') or 0.99)
+            else:
+                # 2^p >= (1.04/Error)^2，p限制在4~16之间
+                self.Precision = min(16, max(4, math.ceil(math.log2((1.04 / self.Error) ** 2))))
+                self.MaxKeys = InputRule.get('SketchMaxKeys') or 10000
+                self.Sketch = OrderedDict() # SketchKey-HyperLogLog
+
+        def Reset(self, InputDecay, InputTime):
+            '窗口到期，Frequency模式按衰减系数衰减，Distinct模式清零'
+            self.WindowStart = InputTime
+            if self.Mode == AnalysePlugin.SketchModeCode.Frequency:
+                self.Sketch.Decay(InputDecay)
+            else:
+                self.Sketch.clear()
+
+        def Add(self, InputKey, InputItem):
+            '计数并返回当前估计值'
+            if self.Mode == AnalysePlugin.SketchModeCode.Frequency:
+                return self.Sketch.Add(InputKey)
+            hll = self.Sketch.get(InputKey)
+            if hll is None:
+                if len(self.Sketch) >= self.MaxKeys:
+                    self.Sketch.popitem(last=False)
+                hll = self.Sketch[InputKey] = AnalysePlugin.HyperLogLog(self.Precision)
+            else:
+                self.Sketch.move_to_end(InputKey)
+            hll.Add(InputItem)
+            return hll.Estimate()
+
+    _ExtraRuleFields = {
+        "SketchMode": (
+            "计数方式，1：频次（Count-Min Sketch），2：去重计数（HyperLogLog）。默认值1",
+            int,
+            lambda x:x in (1, 2),
+            'invalid SketchMode: %s, expecting 1 or 2.'
+        ),
+        "SketchKey": (
+            "计数键的Flag模板，为空时使用规则的CurrentFlag",
+            str
+        ),
+        "SketchItem": (
+            "去重计数模式下被计数对象的Flag模板，例如'{dst_ip}'",
+            str
+        ),
+        "SketchThreshold": (
+            "估计值达到多少时规则命中",
+            int
+        ),
+        "SketchError": (
+            "允许的相对误差，决定Sketch大小。默认值0.01",
+            float
+        ),
+        "SketchConfidence": (
+            "频次模式下误差不超过SketchError的置信度，决定Count-Min Sketch深度。默认值0.99",
+            float
+        ),
+        "SketchMaxKeys": (
+            "去重计数模式下最多保留的计数键数量，超过时淘汰最久未命中的键。默认值10000。最坏情况下每条规则占用SketchMaxKeys*2^p字节，见插件说明",
+            int
+        ),
+        "SketchWindow": (
+            "计数窗口，单位是秒，到期后按SketchDecay衰减或清零。默认值0即不重置",
+            float
+        ),
+        "SketchDecay": (
+            "频次模式下窗口到期时计数的衰减系数，0~1，默认值0即清零。去重计数模式总是清零",
+            float
+        ),
+        "SketchTimeField": (
+            "数据中的时间戳字段名（秒，数字），为空时使用本机单调时钟",
+            str
+        )
+    }
+
+    _PluginFilePath = os.path.abspath(__file__)
+    _CurrentPluginName = os.path.splitext(os.path.basename(_PluginFilePath))[0]
+    _sketches = OrderedDict() # 规则内容键-SketchState映射，按规则最后命中时间排序
+    _MaxRules = 1024
+
+    def LoadSetting(self):
+        pass
+
+    def AnalyseSingleData(self, InputData, InputRule):
+        return self._AnalyseSingleData(InputData, InputRule)
+
+    def _AnalyseSingleData(self, InputData, InputRule):
+        '插件数据分析方法用户函数，接收被分析的dict()类型数据和规则作为参考数据，由用户函数判定是否满足规则。返回值定义同_DefaultSingleRuleTest()函数'
+        hitResult, hitItem = self._DefaultAnalyseSingleData(InputData, InputRule)
+        if not hitResult:
+            return False, None
+        timeField = InputRule.get('SketchTimeField')
+        now = InputData.get(timeField, 0) if timeField else time.monotonic()
+        ruleKey = self._RuleStateKey(InputRule)
+        state = self._sketches.get(ruleKey)
+        if state is None:
+            state = self._sketches[ruleKey] = self.SketchState(InputRule, now)
+            while len(self._sketches) > self._MaxRules:
+                self._sketches.popitem(last=False)
+        else:
+            self._sketches.move_to_end(ruleKey)
+        window = InputRule.get('SketchWindow', 0)
+        if window and now - state.WindowStart >= window:
+            state.Reset(InputRule.get('SketchDecay', 0), now)
+
+        key = self._AnalyseBase.FlagGenerator(InputData, InputRule.get('SketchKey') or InputRule.get('CurrentFlag'))
+        item = self._AnalyseBase.FlagGenerator(InputData, InputRule.get('SketchItem')) if state.Mode == self.SketchModeCode.Distinct else None
+        if state.Add(key, item) >= InputRule.get('SketchThreshold', 1):
+            return True, hitItem
+        return False, None
+
+    @property
+    def PluginInstructions(self):
+        '插件介绍文字'
+        return "概率计数插件，用Count-Min Sketch和HyperLogLog实现频次门槛和去重计数门槛，内存有上限。"
+
+    @property
+    def ExtraRuleFields(self):
+        '插件独有的扩展规则字段，应返回一个dict()，其中key是字段名称，value是说明文字。无扩展字段可返回None'
+        return self._ExtraRuleFields
\ No newline at end of file
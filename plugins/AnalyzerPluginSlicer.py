@@ -1,18 +1,124 @@
-import sys, os, base64
+import sys, os, re, base64, functools
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import AnalyseLib
 
 class AnalysePlugin(AnalyseLib.AnalyseBase.PluginBase):
     '切片比较插件'
 
+    class SliceMatcher(object):
+        '编译后的切片匹配器。匹配内容的解码、正则编译在构造时一次完成，匹配时不修改规则和数据，二进制数据通过memoryview切片，不复制'
+        # 切片语义同Python切片操作data[SliceFrom:SliceTo]，负数下标从末尾计算，SliceTo为None时切到末尾
+        # 各匹配方式在切片上的含义：
+        # Equal                 ：切片内容等于匹配内容
+        # TextMatching          ：匹配内容是切片的子串
+        # RegexMatching         ：正则从切片起始位置匹配。二进制数据的正则表达式按UTF-8编码成bytes后匹配
+        # GreaterThan           ：匹配内容（数字）大于切片内容转换成的数字
+        # LengthEqual           ：切片长度等于匹配内容（数字）
+        # LengthGreaterThan     ：切片长度大于匹配内容（数字）
+        # ReversedTextMatching  ：切片内容是匹配内容的子串
+        # ReversedRegexMatching ：切片内容作为正则表达式，从匹配内容起始位置匹配，无效的正则表达式视为失配。二进制数据的匹配内容按UTF-8编码成bytes
+        # ReversedGreaterThan   ：切片内容转换成的数字大于匹配内容（数字）
+        # 二进制数据的Equal、TextMatching和ReversedTextMatching比较内容需要写成Base64串
+
+        def __init__(self, InputFieldCheckRule):
+            self.FieldName = InputFieldCheckRule['FieldName']
+            self.MatchCode = InputFieldCheckRule['MatchCode']
+            self._sliceFrom = InputFieldCheckRule['SliceFrom']
+            self._sliceTo = InputFieldCheckRule.get('SliceTo')
+            self._mode = abs(self.MatchCode)
+            matchContent = InputFieldCheckRule['MatchContent']
+            self._text = None # 文本数据使用的匹配内容
+            self._binary = None # 二进制数据使用的匹配内容
+            self._textPattern = None
+            self._binaryPattern = None
+            self._number = None
+            MatchMode = AnalyseLib.AnalyseBase.MatchMode
+            if self._mode in (MatchMode.Equal, MatchMode.TextMatching, MatchMode.ReversedTextMatching):
+                self._text = matchContent if type(matchContent) == str else str(matchContent)
+                try:
+                    self._binary = base64.b64decode(matchContent)
+                except Exception:
+                    pass
+                if self._mode == MatchMode.TextMatching and self._binary is not None:
+                    # memoryview没有find()方法，二进制子串查找用转义后的正则代替，同样不复制数据
+                    self._binaryPattern = re.compile(re.escape(self._binary))
+            elif self._mode == MatchMode.RegexMatching:
+                self._text = matchContent if type(matchContent) == str else str(matchContent)
+                self._textPattern = re.compile(self._text)
+                self._binaryPattern = re.compile(self._text.encode())
+            elif self._mode == MatchMode.ReversedRegexMatching:
+                self._text = matchContent if type(matchContent) == str else str(matchContent)
+                self._binary = self._text.encode()
+            elif self._mode in (MatchMode.GreaterThan, MatchMode.LengthEqual, MatchMode.LengthGreaterThan, MatchMode.ReversedGreaterThan):
+                try:
+                    self._number = matchContent if type(matchContent) in (int, float) else int(matchContent)
+                except Exception:
+                    pass
+
+        def __call__(self, TargetData):
+            '对字段内容的切片进行匹配，返回True/False'
+            start, stop, _ = slice(self._sliceFrom, self._sliceTo).indices(len(TargetData))
+            stop = max(start, stop)
+            MatchMode = AnalyseLib.AnalyseBase.MatchMode
+            matchResult = False
+            if type(TargetData) == str:
+                if self._mode == MatchMode.Equal:
+                    matchResult = (stop - start == len(self._text)) and TargetData.startswith(self._text, start, stop)
+                elif self._mode == MatchMode.TextMatching:
+                    matchResult = TargetData.find(self._text, start, stop) != -1
+                elif self._mode == MatchMode.RegexMatching:
+                    # str没有零拷贝切片，正则匹配时^需要对齐切片起点，只能复制切片
+                    matchResult = bool(self._textPattern.match(TargetData[start:stop]))
+                elif self._mode == MatchMode.ReversedTextMatching:
+                    matchResult = TargetData[start:stop] in self._text
+                elif self._mode == MatchMode.ReversedRegexMatching:
+                    try:
+                        matchResult = bool(AnalyseLib.AnalyseBase._RegexCompile(TargetData[start:stop]).match(self._text))
+                    except re.error:
+                        pass
+                elif self._mode in (MatchMode.GreaterThan, MatchMode.ReversedGreaterThan) and self._number is not None:
+                    try:
+                        sliceNumber = int(TargetData[start:stop])
+                        matchResult = self._number > sliceNumber if self._mode == MatchMode.GreaterThan else sliceNumber > self._number
+                    except Exception:
+                        pass
+            else:
+                targetView = memoryview(TargetData)[start:stop]
+                if self._mode == MatchMode.Equal:
+                    matchResult = self._binary is not None and targetView == self._binary
+                elif self._mode in (MatchMode.TextMatching, MatchMode.RegexMatching):
+                    matchResult = self._binaryPattern is not None and bool(
+                        (self._binaryPattern.search if self._mode == MatchMode.TextMatching else self._binaryPattern.match)(targetView)
+                    )
+                elif self._mode == MatchMode.ReversedTextMatching:
+                    matchResult = self._binary is not None and targetView in self._binary
+                elif self._mode == MatchMode.ReversedRegexMatching:
+                    # 正则表达式需要编译，切片复制一次
+                    try:
+                        matchResult = bool(AnalyseLib.AnalyseBase._RegexCompile(targetView.tobytes()).match(self._binary))
+                    except re.error:
+                        pass
+                elif self._mode in (MatchMode.GreaterThan, MatchMode.ReversedGreaterThan) and self._number is not None:
+                    try:
+                        sliceNumber = int(targetView.tobytes())
+                        matchResult = self._number > sliceNumber if self._mode == MatchMode.GreaterThan else sliceNumber > self._number
+                    except Exception:
+                        pass
+            if self._number is not None:
+                if self._mode == MatchMode.LengthEqual:
+                    matchResult = (stop - start == self._number)
+                elif self._mode == MatchMode.LengthGreaterThan:
+                    matchResult = (stop - start > self._number)
+            return ((self.MatchCode < 0) ^ matchResult) # 负数代码，结果取反
+
     _ExtraRuleFields = {}
     _ExtraFieldMatchingRuleFields = {
         "SliceFrom": (
-            "切片起始", 
+            "切片起始",
             int
         ),
         "SliceTo": (
-            "切片截止", 
+            "切片截止",
             int
         )
     }
@@ -26,13 +132,38 @@ class AnalysePlugin(AnalyseLib.AnalyseBase.PluginBase):
     def AnalyseSingleData(self, InputData, InputRule):
         return self._AnalyseSingleData(InputData, InputRule)
 
+    def GetSliceMatcher(self, InputFieldCheckRule):
+        '''获取字段匹配项对应的切片匹配器。匹配器按字段匹配项的内容缓存，内容相同的字段匹配项共用一个匹配器，
+        规则dict重建或被丢弃都不会使缓存无限增长；匹配内容不可哈希时每次重新编译'''
+        key = (
+            InputFieldCheckRule['FieldName'], InputFieldCheckRule['MatchCode'], InputFieldCheckRule['MatchContent'],
+            InputFieldCheckRule['SliceFrom'], InputFieldCheckRule.get('SliceTo')
+        )
+        try:
+            hash(key)
+        except TypeError:
+            return self.SliceMatcher(InputFieldCheckRule)
+        return self._CompileSliceMatcher(*key)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096, typed=True)
+    def _CompileSliceMatcher(FieldName, MatchCode, MatchContent, SliceFrom, SliceTo):
+        # typed=True，1、1.0和True等相等但类型不同的匹配内容分别编译
+        return AnalysePlugin.SliceMatcher({
+            'FieldName': FieldName, 'MatchCode': MatchCode, 'MatchContent': MatchContent, 'SliceFrom': SliceFrom, 'SliceTo': SliceTo
+        })
+
+    def SliceFieldCheck(self, TargetData, InputFieldCheckRule):
+        '字段检查函数，带SliceFrom字段的字段匹配项对字段内容切片进行匹配，其他字段匹配项按原字段检查函数处理'
+        if 'SliceFrom' in InputFieldCheckRule and type(TargetData) in (str, bytes, bytearray):
+            return self.GetSliceMatcher(InputFieldCheckRule)(TargetData)
+        return self._AnalyseBase.FieldCheck(TargetData, InputFieldCheckRule)
+
     def _AnalyseSingleData(self, InputData, InputRule):
         '插件数据分析方法用户函数，接收被分析的dict()类型数据和规则作为参考数据，由用户函数判定是否满足规则。返回值定义同_DefaultSingleRuleTest()函数'
         # 切片比较插件
         # 在字段比较子规则里加入SliceFrom和SliceTo两个字段，整数，可为负,后者可以为None，实际上就是Python切片操作的前后两个参数
-        # 由于内容性质，仅支持Equal/NotEqual和TextMatching/NotTextMatching两种比较运算
-        # 运算结果会动态修改已输入的规则和数据。例如：
-        # 输入字段切片比较规则（判断name字段内容最后3个字符是不是‘Doe’）：
+        # 例如判断name字段内容最后3个字符是不是‘Doe’：
         # {
         #    'FieldName': 'name',
         #    'MatchContent': 'Doe',
@@ -40,62 +171,17 @@ class AnalysePlugin(AnalyseLib.AnalyseBase.PluginBase):
         #    'SliceFrom': -3,
         #    'SliceTo': None
         # }
-        # 输入数据：
-        # {'name': 'John Doe'}
-        # 实际匹配运算内容：(InputData['name'][-3,] == 'Doe')
-        # 在本例中，匹配结果是命中，于是在原数据中追加字段保存匹配结果：
-        # {'name': 'John Doe', 'AnalyzerPluginSlicer_Result_0': True}
-        # 最后改写当前切片匹配规则，使其变成原分析引擎可处理的普通规则：
-        # {
-        #    'FieldName': 'AnalyzerPluginSlicer_Result_0',
-        #    'MatchContent': True,
-        #    'MatchCode': 1
-        # }
-        # 这个机制可以推广到其他字段匹配插件
-
-        fieldCheckList = InputRule.get('FieldCheckList')
-        if fieldCheckList:
-            i = 0
-            for fieldCheckRule in filter(lambda x:'SliceFrom'in x and type(InputData.get(x['FieldName'])) in (str, bytes, bytearray), fieldCheckList):
-                try:
-                    targetData = InputData[fieldCheckRule['FieldName']][fieldCheckRule['SliceFrom']:fieldCheckRule.get('SliceTo')]
-                    matchContent = fieldCheckRule['MatchContent']
-                    matchResult = False
-                    matchResultFieldName = '%s_Result_%s' % (self._CurrentPluginName, i)
-                    if type(InputData[fieldCheckRule['FieldName']]) in (bytes, bytearray):
-                        # 二进制
-                        matchContent = base64.b64decode(matchContent)
-                    
-                    if abs(fieldCheckRule['MatchCode']) == AnalyseLib.AnalyseBase.MatchMode.Equal:
-                        matchResult = (matchContent == targetData)
-                    elif abs(fieldCheckRule['MatchCode']) == AnalyseLib.AnalyseBase.MatchMode.TextMatching:
-                        if type(InputData[fieldCheckRule['FieldName']]) == str:
-                            # 忽略大小写的文本匹配
-                            targetData = targetData.lower()
-                            matchContent = matchContent.lower()
-                        matchResult = (targetData in matchContent)
-                    else:
-                        #忽略其他匹配类型
-                        continue
-                    # 将匹配结果写入原数据，新增匹配结果字段
-                    InputData[matchResultFieldName] = ((fieldCheckRule['MatchCode'] < 0) ^ matchResult) # 负数代码结果取反，这个写法有点反直觉
-                    # 最后修改规则，使其对应匹配结果真值字段
-                    fieldCheckRule.pop('SliceFrom')
-                    if 'SliceTo' in fieldCheckRule:
-                        fieldCheckRule.pop('SliceTo')
-                    fieldCheckRule['MatchContent'] = True # 其实也可以让Result一直为True，真正结果写到这个字段。但那就太反直觉了
-                    fieldCheckRule['MatchCode'] = 1
-                    fieldCheckRule['FieldName'] = matchResultFieldName
-                    i += 1
-                except:
-                    continue
-        rtn = super()._DefaultAnalyseSingleData(InputData, InputRule)
-        return rtn
+        # 输入数据{'name': 'John Doe'}，实际匹配运算内容：(InputData['name'][-3:] == 'Doe')
+        # 切片匹配项在首次使用时编译成SliceMatcher，按内容缓存，之后直接复用
+        # 规则和数据都不会被修改，多个线程可以共享同一组规则
+        if not self._AnalyseBase._DefaultRuleFieldCheck(InputData, InputRule, self.SliceFieldCheck):
+            return (False, None)
+        return self._AnalyseBase._DefaultPrevFlagCheck(InputData, InputRule)
 
     @property
     def PluginInstructions(self):
         '插件介绍文字'
-        return "切片比较，仅支持相等比较和文本比较（包含）两种比较运算。对于二进制数据需要将比较内容写成Base64串。"
+        return "切片比较，支持全部比较运算，长度比较的对象是切片长度。对于二进制数据，相等比较和文本比较需要将比较内容写成Base64串。"
 
     @property
     def ExtraRuleFields(self):
@@ -0,0 +1,137 @@
+import sys, os, time
+from collections import OrderedDict
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import AnalyseLib
+
+class AnalysePlugin(AnalyseLib.AnalyseBase.PluginBase):
+    '滑动时间窗口计数插件，实现“T秒内命中N次”这类规则'
+    # 每个Flag键对应一个环形分桶计数器，窗口被平均分成WindowBuckets个桶，
+    # 计数精度为一个桶的宽度，每个键占用的内存固定。窗口推进时只清空经过的桶，均摊O(1)
+    # 计数器按最后命中时间排序，每次调用顺带回收已经空闲超过一个窗口的键
+    # 计数器按规则内容分组（见PluginBase._RuleStateKey()），最多保留_MaxRules条规则的计数器，超过时淘汰最久未命中的规则
+
+    class WindowCounter(object):
+        '环形分桶滑动窗口计数器'
+        __slots__ = ('Buckets', 'Total', 'Head', 'LastTime')
+
+        def __init__(self, BucketCount):
+            self.Buckets = [0] * BucketCount
+            self.Total = 0 # 窗口内总计数
+            self.Head = None # 最新的桶编号（时间/桶宽度，取整）
+            self.LastTime = 0 # 最后一次计数的时间
+
+        def Add(self, BucketIndex, InputTime):
+            '在指定桶里计数1次，返回窗口内总计数'
+            buckets = self.Buckets
+            bucketCount = len(buckets)
+            if self.Head is None:
+                self.Head = BucketIndex
+            elif BucketIndex > self.Head:
+                # 窗口向前推进，清空经过的桶
+                if BucketIndex - self.Head >= bucketCount:
+                    buckets[:] = [0] * bucketCount
+                    self.Total = 0
+                else:
+                    for i in range(self.Head + 1, BucketIndex + 1):
+                        self.Total -= buckets[i % bucketCount]
+                        buckets[i % bucketCount] = 0
+                self.Head = BucketIndex
+            elif self.Head - BucketIndex >= bucketCount:
+                # 迟到超过一个窗口的数据，不计数
+                return self.Total
+            buckets[BucketIndex % bucketCount] += 1
+            self.Total += 1
+            if InputTime > self.LastTime:
+                self.LastTime = InputTime
+            return self.Total
+
+    _ExtraRuleFields = {
+        "WindowSeconds": (
+            "滑动窗口长度，单位是秒，浮点数",
+            float
+        ),
+        "WindowThreshold": (
+            "窗口内同一个Flag键至少命中多少次，规则才算命中",
+            int
+        ),
+        "WindowBuckets": (
+            "窗口分桶数量，决定计数的时间精度和每个键占用的内存。默认值10",
+            int
+        ),
+        "WindowTimeField": (
+            "数据中的时间戳字段名（秒，数字），为空时使用本机单调时钟",
+            str
+        ),
+        "WindowKey": (
+            "计数键的Flag模板，为空时使用规则的CurrentFlag",
+            str
+        )
+    }
+
+    _PluginFilePath = os.path.abspath(__file__)
+    _CurrentPluginName = os.path.splitext(os.path.basename(_PluginFilePath))[0]
+    _windows = OrderedDict() # 规则内容键-(计数键-WindowCounter有序字典)映射，按规则最后命中时间排序
+    _MaxRules = 4096
+    _ReclaimPerCall = 2 # 每次调用最多回收的空闲键数量
+
+    def LoadSetting(self):
+        pass
+
+    def AnalyseSingleData(self, InputData, InputRule):
+        return self._AnalyseSingleData(InputData, InputRule)
+
+    def WindowCount(self, InputRule, InputKey):
+        '查询规则下某个计数键当前的窗口内计数，不计数也不推进窗口'
+        counters = self._windows.get(self._RuleStateKey(InputRule))
+        counter = counters.get(InputKey) if counters is not None else None
+        return counter.Total if counter else 0
+
+    def _AnalyseSingleData(self, InputData, InputRule):
+        '插件数据分析方法用户函数，接收被分析的dict()类型数据和规则作为参考数据，由用户函数判定是否满足规则。返回值定义同_DefaultSingleRuleTest()函数'
+        hitResult, hitItem = self._DefaultAnalyseSingleData(InputData, InputRule)
+        if not hitResult:
+            return False, None
+        windowSeconds = InputRule.get('WindowSeconds', 0)
+        if not windowSeconds:
+            # 没有设置窗口，功能同普通规则
+            return hitResult, hitItem
+        key = self._AnalyseBase.FlagGenerator(InputData, InputRule.get('WindowKey') or InputRule.get('CurrentFlag'))
+        timeField = InputRule.get('WindowTimeField')
+        now = InputData.get(timeField, 0) if timeField else time.monotonic()
+        bucketCount = InputRule.get('WindowBuckets') or 10
+
+        ruleKey = self._RuleStateKey(InputRule)
+        counters = self._windows.get(ruleKey)
+        if counters is None:
+            counters = self._windows[ruleKey] = OrderedDict()
+            while len(self._windows) > self._MaxRules:
+                self._windows.popitem(last=False)
+        else:
+            self._windows.move_to_end(ruleKey)
+        counter = counters.get(key)
+        if counter is None:
+            counter = counters[key] = self.WindowCounter(bucketCount)
+        else:
+            counters.move_to_end(key)
+        count = counter.Add(int(now * bucketCount // windowSeconds), now)
+
+        # 回收空闲超过一个窗口的键，最早命中的键在最前面
+        for _ in range(self._ReclaimPerCall):
+            oldestKey = next(iter(counters))
+            if counters[oldestKey].LastTime >= now - windowSeconds:
+                break
+            del counters[oldestKey]
+
+        if count >= InputRule.get('WindowThreshold', 1):
+            return True, hitItem
+        return False, None
+
+    @property
+    def PluginInstructions(self):
+        '插件介绍文字'
+        return "滑动时间窗口计数插件，窗口内命中次数达到门槛时规则才命中。"
+
+    @property
+    def ExtraRuleFields(self):
+        '插件独有的扩展规则字段，应返回一个dict()，其中key是字段名称，value是说明文字。无扩展字段可返回None'
+        return self._ExtraRuleFields
\ No newline at end of file
@@ -116,6 +116,34 @@ class AnalysePlugin(AnalyseLib.AnalyseBase.PluginBase):
     def AnalyseSingleData(self, InputData, InputRule):
         return self._AnalyseSingleData(InputData, InputRule)
 
+    def AnalyseBatchData(self, InputBatch, InputRule):
+        '批量版_AnalyseSingleData()，生成器，InputBatch中的数据已通过字段匹配。规则字段只解析一次，逐条数据检查Flag、更新缓存并产出结果'
+        analyseBase = self._AnalyseBase
+        flagGenerator = analyseBase.FlagGenerator
+        flags = analyseBase._flags
+        flagMissing = analyseBase._FlagMissing
+        prevFlagTemplate = InputRule.get('PrevFlag')
+        currentFlagTemplate = InputRule.get('CurrentFlag')
+        threshold = InputRule.get("Threshold", 0)
+        lifetime = InputRule.get("Lifetime", 0)
+        managed = (threshold or lifetime) and analyseBase.FlagConsumable(currentFlagTemplate)
+        for inputData in InputBatch:
+            if prevFlagTemplate:
+                # 同_DefaultPrevFlagCheck()，Flag可能被批内前面数据的命中删除，逐条查询
+                prevFlag = flagGenerator(inputData, prevFlagTemplate)
+                # 命中的数据对象要在FlagCheck()之前取出，生存期耗尽时FlagCheck()会删除Flag
+                hitItem = flags.get(prevFlag, flagMissing)
+                if hitItem is flagMissing or not self.FlagCheck(prevFlag):
+                    yield False, None
+                    continue
+            else:
+                hitItem = None
+            if managed:
+                currentFlag = flagGenerator(inputData, currentFlagTemplate)
+                if currentFlag not in self._cache:
+                    self._cache[currentFlag] = self.CacheItem(currentFlag, threshold, lifetime)
+            yield True, hitItem
+
     def FlagPeek(self, InputFlag):
         '默认Flag偷窥函数，检查Flag是否有效，但并不会触发Threshold或Lifetime消耗，也不进行映射管理。对于Threshold不为0的Flag也返回缓存对象'
         if not InputFlag: #hitResult为True且前序Flag为空，为入口点规则
@@ -144,9 +172,12 @@ class AnalysePlugin(AnalyseLib.AnalyseBase.PluginBase):
 
     def RemoveFlag(self, InputFlag):
         # 删除过期/无效的Flag，包括Flag-CacheItem映射和算法对象中的Flag
-        self._cache.pop(InputFlag)
+        # Flag-CacheItem映射由算法对象通过OnFlagRemoved()通知删除
         self._AnalyseBase.RemoveFlag(InputFlag)
 
+    def OnFlagRemoved(self, InputFlag):
+        self._cache.pop(InputFlag, None)
+
     def _AnalyseSingleData(self, InputData, InputRule):
         '插件数据分析方法用户函数，接收被分析的dict()类型数据和规则作为参考数据，由用户函数判定是否满足规则。返回值定义同_DefaultSingleRuleTest()函数'
         # 0、先调用默认的单规则匹配函数，获得当前规则/flag在基础算法中的匹配结果
@@ -159,8 +190,8 @@ class AnalysePlugin(AnalyseLib.AnalyseBase.PluginBase):
         # 因此可以在插件层对Flag进行“拦截”
         if hitResult and self.FlagCheck(self._AnalyseBase.FlagGenerator(InputData, InputRule.get('PrevFlag'))):
             # 在插件内构造Flag-CacheItem映射
-            if InputRule.get("Threshold", 0) or InputRule.get("Lifetime", 0):
-                # Threshold和Lifetime至少有一个不为0才进行Flag映射和管理
+            if (InputRule.get("Threshold", 0) or InputRule.get("Lifetime", 0)) and self._AnalyseBase.FlagConsumable(InputRule.get('CurrentFlag')):
+                # Threshold和Lifetime至少有一个不为0才进行Flag映射和管理，没有规则会用到的Flag不做管理
                 currentFlag = self._AnalyseBase.FlagGenerator(InputData, InputRule.get('CurrentFlag'))
                 if currentFlag not in self._cache: # 判断生成的currentFlag是否已经存在
                     newCacheItem = self.CacheItem( # 防止覆盖
@@ -35,16 +35,74 @@ class AnalysePlugin(AnalyseLib.AnalyseBase.PluginBase):
                 args=[InputFlag]
             ).start()
 
+    def __delayBatchFunc(self, InputFlags, ExpireSec):
+        # 批量版延迟生效计时器函数，一批Flag共用一个计时器
+        self._liveFlags.update(InputFlags)
+        if ExpireSec:
+            threading.Timer(
+                interval=ExpireSec,
+                function=self.__expireBatchFunc,
+                args=[InputFlags]
+            ).start()
+
+    def __expireBatchFunc(self, InputFlags):
+        for flag in InputFlags:
+            self.__expireFunc(flag)
+
     def __expireFunc(self, InputFlag):
         # 过期计时器函数，将Flag从插件缓存以及分析器对象缓存中删除
-        if InputFlag in self._liveFlags:
-            self._liveFlags.remove(InputFlag)
+        # 插件缓存由分析器对象通过OnFlagRemoved()通知删除
         self._AnalyseBase.RemoveFlag(InputFlag)
-        pass
+
+    def OnFlagRemoved(self, InputFlag):
+        self._liveFlags.discard(InputFlag)
     
     def AnalyseSingleData(self, InputData, InputRule):
         return self._AnalyseSingleData(InputData, InputRule)
 
+    def AnalyseBatchData(self, InputBatch, InputRule):
+        '''批量版_AnalyseSingleData()，生成器，InputBatch中的数据已通过字段匹配。规则字段只解析一次，逐条数据检查Flag并产出结果，
+        同一批数据生成的Flag共用一个延迟计时器和一个过期计时器，不再每个Flag启动一个线程'''
+        analyseBase = self._AnalyseBase
+        flagGenerator = analyseBase.FlagGenerator
+        flags = analyseBase._flags
+        flagMissing = analyseBase._FlagMissing
+        prevFlagTemplate = InputRule.get('PrevFlag')
+        currentFlagTemplate = InputRule.get('CurrentFlag')
+        delaySec = InputRule.get("Delay", 0)
+        expireSec = InputRule.get("Expire", 0)
+        timed = {type(delaySec),type(expireSec)}.issubset({int, float}) and (delaySec or expireSec)
+        newFlags = dict() # 本批新生成的Flag，保持顺序并去重
+        for inputData in InputBatch:
+            prevFlag = flagGenerator(inputData, prevFlagTemplate)
+            # 同_DefaultPrevFlagCheck()和_AnalyseSingleData()的Flag检查
+            hitItem = flags.get(prevFlag, flagMissing) if prevFlag else None
+            if prevFlag and (hitItem is flagMissing or prevFlag not in self._liveFlags):
+                yield False, None
+                continue
+            if timed:
+                currentFlag = flagGenerator(inputData, currentFlagTemplate)
+                if currentFlag not in self._liveFlags:
+                    newFlags[currentFlag] = None
+                    if not delaySec:
+                        # 没有延迟的Flag立即生效，批内后面的数据即可接续
+                        self._liveFlags.add(currentFlag)
+            yield True, hitItem
+        if newFlags:
+            newFlags = list(newFlags)
+            if delaySec:
+                threading.Timer(
+                    interval=delaySec,
+                    function=self.__delayBatchFunc,
+                    args=[newFlags, expireSec]
+                ).start()
+            else:
+                threading.Timer(
+                    interval=expireSec,
+                    function=self.__expireBatchFunc,
+                    args=[newFlags]
+                ).start()
+
     def _AnalyseSingleData(self, InputData, InputRule):
         '插件数据分析方法用户函数，接收被分析的dict()类型数据和规则作为参考数据，由用户函数判定是否满足规则。返回值定义同_DefaultSingleRuleTest()函数'
         hitResult, hitItem = super()._DefaultAnalyseSingleData(InputData, InputRule)
@@ -13,7 +13,7 @@ FieldRuleA2 = {
 }
 
 rule1 = {
-    'Operator': 0,
+    'Operator': 1,
     'PrevFlag': '',
     'CurrentFlag': 'test1:{test}',
     'FlagThrehold': 1,
@@ -69,9 +69,9 @@ def check(InputData, Rule, HitItem, CurrentFlag):
 
 if __name__ == '__main__':
     
-    testAnalyse = AnalyseLib.AnalyseBase(rules)
-    testAnalyse.AnalyseMain(testData1, check) # hit rule1, generate new cache obj with 1 threhold and 1 lifetime
-    testAnalyse.AnalyseMain(testData2, check) # hit the cache obj which rule1 generated, but the threhold prevent it from hit
-    testAnalyse.AnalyseMain(testData2, check) # hit the cache obj again, this time the threhold is comsumed and the cache is vaild
-    testAnalyse.AnalyseMain(testData3, check) 
-    testAnalyse.AnalyseMain(testData3, check)
+    testAnalyse = AnalyseLib.AnalyseBase()
+    print(testAnalyse.AnalyseMain(testData1, check, rules)) # hit rule1, generate flag test1:test1
+    print(testAnalyse.AnalyseMain(testData2, check, rules)) # hit the flag which rule1 generated, generate flag test2:test1
+    print(testAnalyse.AnalyseMain(testData2, check, rules)) # flag test2:test1 already exists, ActionFunc is not called again
+    print(testAnalyse.AnalyseMain(testData3, check, rules))
+    print(testAnalyse.AnalyseMain(testData3, check, rules))
@@ -0,0 +1,47 @@
+import os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AnalyseLib import AnalyseBase
+
+
+@pytest.fixture(autouse=True)
+def ClearFlags():
+    # _flags和_plugins是类属性，所有分析算法对象共享，每个用例前后清空
+    AnalyseBase._flags = dict()
+    yield
+    AnalyseBase._flags = dict()
+
+
+@pytest.fixture
+def Analyser():
+    return AnalyseBase()
+
+
+@pytest.fixture
+def Hits():
+    '记录ActionFunc调用的(规则ID, 本级Flag)，返回(ActionFunc, 调用记录list)'
+    calls = []
+
+    def ActionFunc(InputData, InputRule, HitItem, CurrentFlag):
+        calls.append((InputRule.get('Id'), CurrentFlag))
+        return CurrentFlag
+
+    return ActionFunc, calls
+
+
+def MakeRule(Id, FieldCheckList=(), PrevFlag='', CurrentFlag='', RemoveFlag='', Operator=1, **Extra):
+    rule = {
+        'Id': Id,
+        'Operator': Operator,
+        'PrevFlag': PrevFlag,
+        'CurrentFlag': CurrentFlag,
+        'RemoveFlag': RemoveFlag,
+        'FieldCheckList': [
+            {'FieldName': name, 'MatchContent': content, 'MatchCode': code} for name, content, code in FieldCheckList
+        ]
+    }
+    rule.update(Extra)
+    return rule
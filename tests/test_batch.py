@@ -0,0 +1,150 @@
+import random, threading
+
+import pytest
+
+from AnalyseLib import AnalyseBase
+from conftest import MakeRule
+from plugins import AnalyzerPluginThresholdLifetime, AnalyzerPluginTimedFlag
+
+
+class IdleTimer(object):
+    '代替threading.Timer，不启动线程'
+
+    def __init__(self, interval, function, args=None, kwargs=None):
+        self.args = args
+
+    def start(self):
+        pass
+
+
+def ClearPluginStores():
+    AnalyzerPluginThresholdLifetime.AnalysePlugin._cache.clear()
+    AnalyzerPluginTimedFlag.AnalysePlugin._liveFlags.clear()
+
+
+@pytest.fixture(autouse=True)
+def ResetPlugins(monkeypatch):
+    # 插件缓存是类属性，用例前后清空；过期计时器不启动线程
+    monkeypatch.setattr(threading, 'Timer', IdleTimer)
+    ClearPluginStores()
+    yield
+    ClearPluginStores()
+
+
+PluginSettings = {
+    'AnalyzerPluginThresholdLifetime': {'Lifetime': 5},
+    'AnalyzerPluginTimedFlag': {'Expire': 60},
+    'AnalyzerPluginMultiflag': {}
+}
+
+
+def ChainRules(PluginName):
+    return {
+        'login': MakeRule('login', [('event', 'login', 1)], CurrentFlag='a:{ip}', PluginNames=PluginName, **PluginSettings[PluginName]),
+        'dl': MakeRule('dl', [('event', 'dl', 1)], PrevFlag='a:{ip}', RemoveFlag='a:{ip}', CurrentFlag='b:{ip}:{n}', PluginNames=PluginName)
+    }
+
+
+def Sequential(Analyser, Rules, Batches, ActionFunc):
+    Analyser.LoadRules(Rules)
+    return [[Analyser.AnalyseMain(x, ActionFunc) for x in batch] for batch in Batches]
+
+
+def Batched(Analyser, Rules, Batches, ActionFunc):
+    Analyser.LoadRules(Rules)
+    return [Analyser.AnalyseMainBatch(batch, ActionFunc, Ordered=False) for batch in Batches]
+
+
+def Ordered(Analyser, Rules, Batches, ActionFunc):
+    Analyser.LoadRules(Rules)
+    return [Analyser.AnalyseMainBatch(batch, ActionFunc) for batch in Batches]
+
+
+@pytest.mark.parametrize('PluginName', sorted(PluginSettings))
+@pytest.mark.parametrize('Runner', [Sequential, Batched, Ordered])
+def test_remove_flag_seen_by_next_event(Analyser, Hits, PluginName, Runner):
+    actionFunc, calls = Hits
+    events = [{'event': 'login', 'ip': '1'}, {'event': 'dl', 'ip': '1', 'n': 1}, {'event': 'dl', 'ip': '1', 'n': 2}]
+    Runner(Analyser, ChainRules(PluginName), [events], actionFunc)
+    assert calls == [('login', 'a:1'), ('dl', 'b:1:1')]
+
+
+def test_threshold_consumed_in_order(Analyser, Hits):
+    actionFunc, calls = Hits
+    rules = ChainRules('AnalyzerPluginThresholdLifetime')
+    rules['login'].update(Threshold=1, Lifetime=2)
+    rules['dl']['RemoveFlag'] = ''
+    events = [{'event': 'login', 'ip': '1'}] + [{'event': 'dl', 'ip': '1', 'n': i} for i in range(5)]
+    Batched(Analyser, rules, [events], actionFunc)
+    # Threshold为1时第二次检查才生效，Lifetime为2时生效后只能再用2次
+    assert calls == [('login', 'a:1'), ('dl', 'b:1:1'), ('dl', 'b:1:2')]
+
+
+def RunAll(Rules, Batches, Runners=(Sequential, Batched)):
+    results = []
+    # 插件对象绑定最后一个创建的分析算法对象，逐个创建、逐个运行
+    for runner in Runners:
+        calls = []
+
+        def ActionFunc(InputData, InputRule, HitItem, CurrentFlag):
+            calls.append((InputRule['Id'], CurrentFlag, HitItem))
+            return CurrentFlag
+
+        ClearPluginStores()
+        analyser = AnalyseBase()
+        analyser._flags = dict()
+        rtn = runner(analyser, Rules, Batches, ActionFunc)
+        results.append((rtn, calls, dict(analyser._flags)))
+    return results
+
+
+def test_batch_matches_sequential():
+    rand = random.Random(1)
+    chains = 0
+    for _ in range(12):
+        pluginNames = ';'.join(rand.sample(sorted(PluginSettings), rand.randint(1, 3)))
+        rules = {
+            'login': MakeRule(
+                'login', [('event', 'login', 1)], CurrentFlag='a:{ip}', PluginNames=pluginNames,
+                Threshold=rand.randint(0, 1), Lifetime=rand.randint(0, 3), Expire=60
+            ),
+            'dl': MakeRule(
+                'dl', [('event', 'dl', 1)], PrevFlag='a:{ip}', RemoveFlag=rand.choice(('a:{ip}', '')),
+                CurrentFlag='b:{ip}:{n}', PluginNames=pluginNames
+            )
+        }
+        logins = [{'event': 'login', 'ip': rand.choice('123')} for _ in range(10)]
+        downloads = [{'event': 'dl', 'ip': rand.choice('1234'), 'n': i} for i in range(30)]
+        sequential, batched = RunAll(rules, [logins, downloads])
+        assert batched == sequential, pluginNames
+        chains += sum(1 for x in sequential[1] if x[0] == 'dl')
+    assert chains
+
+
+def test_unordered_batch_reorders_within_batch(Analyser, Hits):
+    actionFunc, calls = Hits
+    rules = ChainRules('AnalyzerPluginMultiflag')
+    # dl先于login到达：逐条分析时dl没有前序Flag，乱序批量分析时login规则先作用于整批数据
+    events = [{'event': 'dl', 'ip': '1', 'n': 1}, {'event': 'login', 'ip': '1'}]
+    assert Ordered(Analyser, rules, [events], actionFunc) == [[set(), {'a:1'}]]
+    assert calls == [('login', 'a:1')]
+    calls.clear()
+    Analyser._flags.clear()
+    assert Batched(Analyser, rules, [events], actionFunc) == [[{'b:1:1'}, {'a:1'}]]
+    assert calls == [('login', 'a:1'), ('dl', 'b:1:1')]
+
+
+def test_ordered_batch_matches_sequential():
+    rand = random.Random(2)
+    for _ in range(12):
+        pluginNames = ';'.join(rand.sample(sorted(PluginSettings), rand.randint(1, 3)))
+        rules = ChainRules('AnalyzerPluginMultiflag')
+        for rule in rules.values():
+            rule.update(PluginNames=pluginNames, Threshold=rand.randint(0, 1), Lifetime=rand.randint(0, 3), Expire=60)
+        # login和dl混在同一批里，结果和到达顺序有关
+        events = [
+            {'event': rand.choice(('login', 'dl')), 'ip': rand.choice('123'), 'n': i} for i in range(40)
+        ]
+        batches = [events[i:i + 8] for i in range(0, len(events), 8)]
+        sequential, ordered = RunAll(rules, batches, (Sequential, Ordered))
+        assert ordered == sequential, pluginNames
@@ -0,0 +1,97 @@
+import os, threading
+
+import pytest
+
+import AnalyseCluster
+from AnalyseCluster import HashRing, ClusterClient, StartLocalNode
+
+Rules = [
+    {
+        'Operator': 1, 'PrevFlag': '', 'CurrentFlag': 'login:{src_ip}',
+        'FieldCheckList': [{'FieldName': 'event', 'MatchContent': 'login', 'MatchCode': 1}]
+    },
+    {
+        'Operator': 1, 'PrevFlag': 'login:{src_ip}', 'CurrentFlag': 'download:{src_ip}',
+        'FieldCheckList': [{'FieldName': 'event', 'MatchContent': 'download', 'MatchCode': 1}]
+    }
+]
+
+
+def PayloadActionFunc(InputData, InputRule, HitItem, CurrentFlag):
+    return (CurrentFlag, InputData.get('payload'))
+
+
+@pytest.fixture
+def Nodes(tmp_path):
+    addresses = {'node%s' % i: str(tmp_path / ('node%s.sock' % i)) for i in range(3)}
+    processes = [StartLocalNode(address, Rules, PayloadActionFunc) for address in addresses.values()]
+    yield addresses
+    for process in processes:
+        process.terminate()
+        process.join()
+
+
+def RunWithTimeout(Target, Timeout=60):
+    rtn = []
+    thread = threading.Thread(target=lambda: rtn.append(Target()), daemon=True)
+    thread.start()
+    thread.join(Timeout)
+    assert not thread.is_alive(), 'client deadlocked'
+    return rtn[0]
+
+
+def Hits(Results):
+    return sorted(x[0] for seq, hits in Results for x in hits)
+
+
+def test_hash_ring_stable_and_balanced():
+    ring = HashRing()
+    for nodeId in ('a', 'b', 'c'):
+        ring.AddNode(nodeId)
+    owners = [ring.GetNode(i) for i in range(3000)]
+    assert set(owners) == {'a', 'b', 'c'}
+    assert min(owners.count(x) for x in 'abc') > 500
+    ring.AddNode('d')
+    # 新节点只接管一部分关联键，其余关联键归属不变
+    moved = sum(1 for i in range(3000) if ring.GetNode(i) != owners[i])
+    assert 0 < moved < 1500
+    assert all(ring.GetNode(i) in ('d', owners[i]) for i in range(3000))
+
+
+def test_chains_survive_rebalance(Nodes):
+    client = ClusterClient('src_ip', BatchSize=16)
+    client.AddNode('node0', Nodes['node0'])
+    client.AddNode('node1', Nodes['node1'])
+    for i in range(200):
+        client.Submit({'event': 'login', 'src_ip': '10.0.0.%s' % i})
+    assert len(client.Flush()) == 200
+    client.AddNode('node2', Nodes['node2'])
+    stats = client.Stats()
+    assert sum(x['Flags'] for x in stats.values()) == 200
+    assert all(x['Flags'] for x in stats.values())
+    for i in range(200):
+        client.Submit({'event': 'download', 'src_ip': '10.0.0.%s' % i})
+    assert Hits(client.Flush()) == sorted('download:10.0.0.%s' % i for i in range(200))
+    assert sum(x['Flags'] for x in client.Stats().values()) == 400
+    client.RemoveNode('node0')
+    stats = client.Stats()
+    assert set(stats) == {'node1', 'node2'}
+    assert sum(x['Flags'] for x in stats.values()) == 400
+    client.Close(StopNodes=True)
+
+
+def test_large_replies_do_not_deadlock(Nodes):
+    # 请求和回复都远大于socket缓冲区，客户端发送时必须同时读取回复
+    client = ClusterClient('src_ip', BatchSize=8, MaxInFlight=8)
+    client.AddNode('node0', Nodes['node0'])
+    payload = 'x' * (256 << 10)
+
+    def Run():
+        for i in range(128):
+            client.Submit({'event': 'login', 'src_ip': '10.0.0.%s' % i, 'payload': payload})
+        return client.Flush()
+
+    results = RunWithTimeout(Run)
+    assert len(results) == 128
+    assert all(hits[0][1] == payload for seq, hits in results)
+    client.Close(StopNodes=True)
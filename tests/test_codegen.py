@@ -0,0 +1,123 @@
+import copy, base64, random
+
+import pytest
+
+from AnalyseLib import AnalyseBase
+from AnalyseCodegen import CodegenAnalyse
+
+StrValues = ['abc', 'ABC', 'xyzabc', '12', 'a.c', '', '^a', 'YWJj', '[']
+IntValues = [0, 5, 12, 100, -3]
+FloatValues = [0.5, 5.0, 12.5]
+BytesValues = [b'abc', b'\x00\x01', b'12', b'xyzabc']
+MatchContents = [x for x in StrValues if x != '['] + IntValues + FloatValues + ['a.', base64.b64encode(b'\x00\x01').decode(), '5', 5.5]
+
+
+def RandomValue(Random):
+    pool = Random.choice((StrValues, IntValues, FloatValues, BytesValues))
+    return Random.choice(pool)
+
+
+def RandomRules(Random, Count=16, Plugins=False):
+    rules = []
+    for i in range(Count):
+        fieldCheckList = [
+            {
+                'FieldName': Random.choice('abcd'),
+                'MatchContent': Random.choice(MatchContents),
+                'MatchCode': Random.choice((1, 2, 3, 4, 5, 6, 7, 8, 9)) * Random.choice((1, -1))
+            } for _ in range(Random.randint(0, 3))
+        ]
+        rule = {
+            'Id': i,
+            'Operator': Random.choice((1, 2, -1, -2)),
+            'PrevFlag': 'r%d:{k}' % Random.randrange(i) if i and Random.random() < 0.4 else '',
+            'CurrentFlag': 'r%d:{k}' % i if Random.random() < 0.8 else 'r%d:{k}' % Random.randrange(i + 1),
+            'RemoveFlag': 'r%d:{k}' % Random.randrange(i) if i and Random.random() < 0.2 else '',
+            'FieldCheckList': fieldCheckList
+        }
+        if Plugins and Random.random() < 0.2:
+            rule['PluginNames'] = 'AnalyzerPluginMultiflag'
+            rule['PrevFlags'] = ['r%d:{k}' % Random.randrange(Count) for _ in range(2)]
+            rule['MultiFlagOperator'] = Random.choice((1, 2))
+        rules.append(rule)
+    return rules
+
+
+def RandomEvents(Random, Count=400):
+    events = []
+    for _ in range(Count):
+        event = {'k': Random.choice('123')}
+        for fieldName in 'abcd':
+            if Random.random() < 0.8:
+                event[fieldName] = RandomValue(Random)
+        events.append(event)
+    return events
+
+
+def Run(Analyser, Events, Rules=None):
+    '逐条分析，返回每条数据的ActionFunc调用记录和最终的Flag'
+    calls = []
+
+    def ActionFunc(InputData, InputRule, HitItem, CurrentFlag):
+        calls.append((InputRule['Id'], CurrentFlag, HitItem))
+        return 'item:%s:%s' % (InputRule['Id'], CurrentFlag)
+
+    Analyser._flags = dict()
+    rtn = []
+    for event in copy.deepcopy(Events):
+        hits = Analyser.AnalyseMain(event, ActionFunc, Rules)
+        rtn.append((sorted(hits), list(calls)))
+        calls.clear()
+    return rtn, dict(Analyser._flags)
+
+
+def Managed(Analyser, Rules, CachedFields=()):
+    Analyser.LoadRules({x['Id']: x for x in Rules})
+    for fieldName in CachedFields:
+        Analyser.EnableFieldCache(fieldName)
+    return Analyser
+
+
+@pytest.mark.parametrize('Seed', range(12))
+def test_codegen_matches_interpreted(Seed):
+    rand = random.Random(Seed)
+    rules = RandomRules(rand, Plugins=Seed % 3 == 0)
+    events = RandomEvents(rand)
+    # 插件对象绑定最后一个创建的分析算法对象，逐个创建、逐个运行
+    expected = Run(AnalyseBase(), events, rules)
+    assert any(calls for hits, calls in expected[0])
+    assert Run(Managed(AnalyseBase(), rules), events) == expected
+    assert Run(Managed(CodegenAnalyse(), rules), events) == expected
+    assert Run(Managed(CodegenAnalyse(), rules, CachedFields='ab'), events) == expected
+
+
+def test_codegen_bytes_fallback():
+    rules = [
+        {'Id': 'a', 'Operator': 1, 'PrevFlag': '', 'CurrentFlag': 'a:{k}', 'FieldCheckList': [{'FieldName': 'd', 'MatchContent': 'YWJj', 'MatchCode': 1}]},
+        {'Id': 'b', 'Operator': 1, 'PrevFlag': 'a:{k}', 'CurrentFlag': 'b:{k}', 'FieldCheckList': [{'FieldName': 'e', 'MatchContent': 'x', 'MatchCode': 1}]}
+    ]
+    # k是bytes，默认Flag生成函数按UTF-16解码
+    events = [{'k': 'z'.encode('utf-16'), 'd': b'abc'}, {'k': 'z'.encode('utf-16'), 'e': 'x'}]
+    expected = Run(Managed(AnalyseBase(), rules), events)
+    assert expected[0][1][1] == [('b', 'b:z', 'item:a:a:z')]
+    assert Run(Managed(CodegenAnalyse(), rules), events) == expected
+
+
+def test_codegen_prev_flag_chain_and_remove():
+    rules = [
+        {'Id': 'login', 'Operator': 1, 'PrevFlag': '', 'CurrentFlag': 'login:{k}', 'FieldCheckList': [{'FieldName': 'e', 'MatchContent': 'login', 'MatchCode': 1}]},
+        {'Id': 'dl', 'Operator': 1, 'PrevFlag': 'login:{k}', 'RemoveFlag': 'login:{k}', 'CurrentFlag': 'dl:{k}', 'FieldCheckList': [{'FieldName': 'e', 'MatchContent': 'dl', 'MatchCode': 1}]}
+    ]
+    events = [{'e': 'dl', 'k': '1'}, {'e': 'login', 'k': '1'}, {'e': 'dl', 'k': '1'}, {'e': 'dl', 'k': '1'}]
+    analyser = Managed(CodegenAnalyse(), rules)
+    results, flags = Run(analyser, events)
+    assert [x[1] for x in results] == [[], [('login', 'login:1', None)], [('dl', 'dl:1', 'item:login:login:1')], []]
+    assert 'login:1' not in flags
+    assert 'flags.get(' in analyser.Source
+
+
+def test_codegen_source_regenerated_on_rule_change():
+    analyser = Managed(CodegenAnalyse(), RandomRules(random.Random(1), Count=3))
+    source = analyser.Source
+    analyser.AddRule(99, {'Id': 99, 'Operator': 1, 'PrevFlag': '', 'CurrentFlag': 'x', 'FieldCheckList': []})
+    assert analyser.Source != source and 'RuleId: 99' in analyser.Source
@@ -0,0 +1,151 @@
+from AnalyseLib import AnalyseBase
+from conftest import MakeRule
+
+
+def LoginRules():
+    return {'login': MakeRule('login', [('event', 'login', 1)], CurrentFlag='login:{ip}')}
+
+
+def Counter():
+    calls = []
+
+    def ActionFunc(InputData, InputRule, HitItem, CurrentFlag):
+        calls.append(CurrentFlag)
+        return '%s#%d' % (CurrentFlag, len(calls))
+
+    return ActionFunc, calls
+
+
+def Login(Analyser, ActionFunc, Ip='1', **Extra):
+    return Analyser.AnalyseMain(dict(event='login', ip=Ip, **Extra), ActionFunc)
+
+
+def test_skip_is_default(Analyser):
+    actionFunc, calls = Counter()
+    Analyser.LoadRules(LoginRules())
+    assert Analyser.ConflictPolicy == AnalyseBase.ConflictPolicyCode.Skip
+    assert Login(Analyser, actionFunc) == {'login:1#1'}
+    assert Login(Analyser, actionFunc) == set()
+    assert calls == ['login:1']
+    assert Analyser.ConflictStats == {'Conflicts': 1, 'Suppressed': 0}
+
+
+def test_always_keeps_first_item(Analyser):
+    actionFunc, calls = Counter()
+    Analyser.LoadRules(LoginRules())
+    Analyser.ConflictPolicy = AnalyseBase.ConflictPolicyCode.Always
+    Login(Analyser, actionFunc)
+    assert Login(Analyser, actionFunc) == set()
+    assert calls == ['login:1', 'login:1']
+    assert Analyser._flags['login:1'] == 'login:1#1'
+
+
+def test_update_replaces_item_in_place(Analyser):
+    actionFunc, calls = Counter()
+    Analyser.LoadRules(LoginRules())
+    Analyser.EnableFlagIndex('ip')
+    Analyser.ConflictPolicy = AnalyseBase.ConflictPolicyCode.Update
+    Login(Analyser, actionFunc)
+    assert Login(Analyser, actionFunc) == {'login:1#2'}
+    assert Analyser._flags['login:1'] == 'login:1#2'
+    assert Analyser.FlagQuery('ip', '1') == [('login:1', 'login:1#2')]
+
+
+def test_hook_replaces_action(Analyser):
+    class HookAnalyse(AnalyseBase):
+        def OnDuplicate(self, InputData, InputRule, HitItem, CurrentFlag, ExistingItem):
+            duplicates.append((CurrentFlag, ExistingItem))
+            return 'dup:' + ExistingItem
+
+    duplicates = []
+    actionFunc, calls = Counter()
+    analyser = HookAnalyse()
+    analyser.LoadRules(LoginRules())
+    analyser.ConflictPolicy = AnalyseBase.ConflictPolicyCode.Hook
+    Login(analyser, actionFunc)
+    assert Login(analyser, actionFunc) == {'dup:login:1#1'}
+    assert calls == ['login:1']
+    assert duplicates == [('login:1', 'login:1#1')]
+
+
+def test_suppression_interval(Analyser):
+    actionFunc, calls = Counter()
+    Analyser.LoadRules(LoginRules())
+    Analyser.ConflictPolicy = AnalyseBase.ConflictPolicyCode.Always
+    Analyser.SetSuppression(10, TimeField='ts')
+    for ts in (0, 3, 9):
+        Login(Analyser, actionFunc, ts=ts)
+    Login(Analyser, actionFunc, Ip='2', ts=9)
+    Login(Analyser, actionFunc, ts=10)
+    # 同一(规则, Flag)在10秒内只触发一次，不同的Flag互不影响
+    assert calls == ['login:1', 'login:2', 'login:1']
+    assert Analyser.ConflictStats['Suppressed'] == 2
+    Analyser.SetSuppression(0)
+    Login(Analyser, actionFunc, ts=11)
+    assert len(calls) == 4
+
+
+def test_suppression_is_bounded(Analyser):
+    actionFunc, calls = Counter()
+    Analyser.LoadRules(LoginRules())
+    Analyser.ConflictPolicy = AnalyseBase.ConflictPolicyCode.Always
+    Analyser.SetSuppression(100, MaxSize=3, TimeField='ts')
+    for ip in '12345':
+        Login(Analyser, actionFunc, Ip=ip, ts=0)
+    assert len(Analyser._suppression) == 3
+    # 最早的记录被淘汰，login:1再次触发
+    Login(Analyser, actionFunc, Ip='1', ts=1)
+    Login(Analyser, actionFunc, Ip='5', ts=1)
+    assert calls == ['login:%s' % x for x in '123451']
+
+
+def test_removed_rule_drops_suppression_records(Analyser):
+    actionFunc, calls = Counter()
+    Analyser.LoadRules(LoginRules())
+    Analyser.SetSuppression(100, TimeField='ts')
+    Login(Analyser, actionFunc, ts=0)
+    Analyser.AddRule('other', MakeRule('other', [('event', 'x', 1)], CurrentFlag='x'))
+    assert len(Analyser._suppression) == 1
+    Analyser.RemoveRule('login')
+    assert len(Analyser._suppression) == 0
+
+
+def test_suppression_timestamp_fallback(Analyser, monkeypatch):
+    actionFunc, calls = Counter()
+    Analyser.LoadRules(LoginRules())
+    Analyser.ConflictPolicy = AnalyseBase.ConflictPolicyCode.Always
+    Analyser.SetSuppression(10, TimeField='ts')
+    # 字符串时间戳按数字处理（例如CSV回放）
+    for ts in ('0', '5', '10.5'):
+        Login(Analyser, actionFunc, ts=ts)
+    assert calls == ['login:1', 'login:1']
+    # 没有时间戳或者时间戳无效时使用单调时钟，不会永久抑制
+    clock = [1000.0]
+    monkeypatch.setattr('AnalyseLib.time.monotonic', lambda: clock[0])
+    Login(Analyser, actionFunc, Ip='2')
+    Login(Analyser, actionFunc, Ip='2', ts='bad')
+    clock[0] += 11
+    Login(Analyser, actionFunc, Ip='2', ts=None)
+    Login(Analyser, actionFunc, Ip='2', ts=float('nan'))
+    assert calls == ['login:1', 'login:1', 'login:2', 'login:2']
+
+
+def test_suppression_keyed_by_rule(Analyser):
+    actionFunc, calls = Counter()
+    Analyser.ConflictPolicy = AnalyseBase.ConflictPolicyCode.Always
+    Analyser.SetSuppression(100, TimeField='ts')
+    # 受管规则按规则ID记录，同ID的新规则对象沿用原来的记录
+    Analyser.LoadRules(LoginRules())
+    Login(Analyser, actionFunc, ts=0)
+    Analyser.ReplaceRule('login', LoginRules()['login'])
+    Login(Analyser, actionFunc, ts=1)
+    assert calls == ['login:1']
+    # 非受管规则：新的规则对象即使复用了原来的id也不继承记录
+    rules = list(LoginRules().values())
+    Analyser.AnalyseMain({'event': 'login', 'ip': '3', 'ts': 0}, actionFunc, rules)
+    key = next(k for k in Analyser._suppression if not k[0])
+    assert Analyser._suppression[key][1] is rules[0]
+    # 模拟id被已经释放的另一个规则对象占用过
+    Analyser._suppression[key] = (0, {'Id': 'other'})
+    Analyser.AnalyseMain({'event': 'login', 'ip': '3', 'ts': 1}, actionFunc, rules)
+    assert calls == ['login:1', 'login:3', 'login:3']
@@ -0,0 +1,90 @@
+import pytest
+
+from conftest import MakeRule
+
+from AnalyseLib import AnalyseBase
+from AnalyseCodegen import CodegenAnalyse
+
+
+def UaRules():
+    return {
+        'chrome': MakeRule('chrome', [('ua', 'Chrome', 2)], CurrentFlag='chrome:{n}'),
+        'bot': MakeRule('bot', [('ua', r'.*bot', 3), ('ua', 'Chrome', 2)], Operator=-2, CurrentFlag='bot:{n}'),
+        'curl': MakeRule('curl', [('ua', 'curl', 2)], CurrentFlag='curl:{n}')
+    }
+
+
+def Run(Analyser, Events):
+    Analyser._flags.clear()
+    calls = []
+    ActionFunc = lambda InputData, InputRule, HitItem, CurrentFlag: calls.append(CurrentFlag) or CurrentFlag
+    for n, ua in enumerate(Events):
+        Analyser.AnalyseMain({'ua': ua, 'n': n}, ActionFunc)
+    return calls
+
+
+@pytest.mark.parametrize('Engine', [AnalyseBase, CodegenAnalyse])
+def test_cache_results_match_uncached(Engine):
+    events = ['Mozilla Chrome', 'curl/8', 'Googlebot', 'Mozilla Chrome', 'curl/8', 'Safari'] * 20
+    plain = Engine()
+    plain.LoadRules(UaRules())
+    expected = Run(plain, events)
+    cached = Engine()
+    cached.EnableFieldCache('ua', MaxSize=2)
+    cached.LoadRules(UaRules())
+    assert Run(cached, events) == expected
+    stats = cached.FieldCacheStats()['ua']
+    assert stats['Hits'] and stats['Misses'] and stats['Size'] <= 2
+
+
+def test_cache_belongs_to_snapshot(Analyser):
+    Analyser.EnableFieldCache('a')
+    oldRules = {
+        'go': MakeRule('go', [('t', 'go', 1)], CurrentFlag='go:{n}'),
+        'x': MakeRule('x', [('a', 'x', 1)], CurrentFlag='x:{n}'),
+        'y': MakeRule('y', [('a', 'y', 1)], CurrentFlag='y:{n}')
+    }
+    newRules = {
+        'y': MakeRule('y', [('a', 'y', 1)], CurrentFlag='y:{n}'),
+        'z': MakeRule('z', [('a', 'z', 1)], CurrentFlag='z:{n}')
+    }
+    calls = []
+
+    def ActionFunc(InputData, InputRule, HitItem, CurrentFlag):
+        calls.append(CurrentFlag)
+        if InputRule['Id'] == 'go':
+            # 分析过程中切换规则集，本条数据后面的规则仍按旧快照和旧快照的位图布局执行
+            Analyser.LoadRules(newRules)
+        return CurrentFlag
+
+    Analyser.LoadRules(oldRules)
+    oldRuleSet = Analyser._ruleSet
+    Analyser.AnalyseMain({'t': 'go', 'a': 'y', 'n': 0}, ActionFunc)
+    assert calls == ['go:0', 'y:0']
+    assert oldRuleSet.FieldCaches['a'].Misses == 1
+    Analyser.AnalyseMain({'a': 'y', 'n': 1}, ActionFunc)
+    assert calls == ['go:0', 'y:0', 'y:1']
+    assert Analyser._ruleSet.FieldCaches['a'].Misses == 1
+
+
+def test_enable_disable_on_loaded_rules(Analyser):
+    Analyser.LoadRules(UaRules())
+    expected = Run(Analyser, ['curl/8', 'Chrome'])
+    Analyser.EnableFieldCache('ua')
+    assert Run(Analyser, ['curl/8', 'Chrome']) == expected
+    assert Analyser.FieldCacheStats()['ua']['Misses'] == 2
+    Analyser.AddRule('safari', MakeRule('safari', [('ua', 'Safari', 2)], CurrentFlag='safari:{n}'))
+    assert Analyser.FieldCacheStats()['ua']['Size'] == 0
+    Analyser.DisableFieldCache('ua')
+    assert Analyser.FieldCacheStats() == {}
+    assert Run(Analyser, ['curl/8', 'Safari']) == ['bot:0', 'curl:0', 'bot:1', 'safari:1']
+
+
+def test_disabled_cache_does_not_break_old_snapshot(Analyser):
+    # 旧快照上的结果位图查询在缓存停用后直接计算
+    Analyser.EnableFieldCache('ua')
+    Analyser.LoadRules(UaRules())
+    ruleSet = Analyser._ruleSet
+    Analyser.DisableFieldCache('ua')
+    bits = Analyser._FieldCacheBits(ruleSet, 'ua', 'curl/8')
+    assert bits == AnalyseBase.FieldResultCache.Evaluate('curl/8', ruleSet.FieldMatchers['ua'])
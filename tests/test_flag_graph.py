@@ -0,0 +1,139 @@
+import random, time
+
+import pytest
+
+from AnalyseLib import AnalyseBase
+from conftest import MakeRule
+
+
+def GraphRules():
+    return {
+        'login': MakeRule('login', [('event', 'login', 1)], CurrentFlag='login:{ip}'),
+        'download': MakeRule('download', [('event', 'download', 1)], PrevFlag='login:{ip}', CurrentFlag='download:{ip}'),
+        'alert': MakeRule('alert', [('event', 'upload', 1)], PrevFlag='down{x}', CurrentFlag='alert')
+    }
+
+
+def BruteForceEdges(InputRuleSet):
+    return {
+        x.CurrentFlag: frozenset(
+            y.RuleId for y in InputRuleSet.Rules for template in y.ConsumedTemplates
+            if AnalyseBase.RuleSet.TemplatesMayCollide(x.CurrentFlag, template)
+        )
+        for x in InputRuleSet.Rules if x.CurrentFlag
+    }
+
+
+def test_graph_edges_and_dead_templates(Analyser):
+    Analyser.LoadRules(GraphRules())
+    graph = Analyser._ruleSet.FlagGraph
+    assert graph.Edges == {'login:{ip}': {'download'}, 'download:{ip}': {'alert'}, 'alert': frozenset()}
+    assert Analyser._ruleSet.DeadTemplates == {'alert'}
+    assert not Analyser.FlagConsumable('alert')
+    assert Analyser.FlagConsumable('login:{ip}')
+
+
+def test_incremental_graph_matches_rebuild(Analyser):
+    rng = random.Random(7)
+    templates = ['a:{ip}', 'a:{ip}:{port}', 'ab', 'a{x}b', '{ip}:a', 'b:{ip}', 'b:1', 'x{ip}', '']
+    rules = dict()
+    Analyser.LoadRules(rules)
+    for step in range(300):
+        ruleId = 'r%d' % rng.randrange(40)
+        if ruleId in rules and rng.random() < 0.4:
+            del rules[ruleId]
+            Analyser.RemoveRule(ruleId)
+        else:
+            rule = MakeRule(
+                ruleId, PrevFlag=rng.choice(templates), CurrentFlag=rng.choice(templates),
+                RemoveFlag=rng.choice(templates), PluginNames='AnalyzerPluginMultiflag', PrevFlags=rng.sample(templates, 2)
+            )
+            rules[ruleId] = rule
+            Analyser.UpdateRules({ruleId: rule})
+        ruleSet = Analyser._ruleSet
+        rebuilt = AnalyseBase.RuleSet(ruleSet.Rules)
+        assert ruleSet.FlagGraph.Edges == rebuilt.FlagGraph.Edges == BruteForceEdges(ruleSet)
+        assert ruleSet.DeadTemplates == rebuilt.DeadTemplates == {k for k, v in rebuilt.FlagGraph.Edges.items() if not v}
+
+
+def test_old_snapshot_graph_unchanged(Analyser):
+    Analyser.LoadRules(GraphRules())
+    oldRuleSet = Analyser._ruleSet
+    Analyser.AddRule('audit', MakeRule('audit', PrevFlag='alert', CurrentFlag='audit'))
+    assert 'alert' in oldRuleSet.DeadTemplates
+    assert oldRuleSet.FlagGraph.Edges['alert'] == frozenset()
+    assert 'alert' not in Analyser._ruleSet.DeadTemplates
+    assert Analyser._ruleSet.FlagGraph.Edges['alert'] == {'audit'}
+
+
+def test_rule_edits_stay_incremental(Analyser):
+    rules = {
+        'r%d' % i: MakeRule('r%d' % i, [('f', str(i), 1)], PrevFlag='s%d:{ip}' % (i - 1) if i % 3 else '', CurrentFlag='s%d:{ip}' % i)
+        for i in range(1000)
+    }
+    start = time.perf_counter()
+    Analyser.LoadRules(rules)
+    loadTime = time.perf_counter() - start
+    start = time.perf_counter()
+    Analyser.AddRule('new', MakeRule('new', PrevFlag='s5:{ip}', CurrentFlag='new:{ip}'))
+    Analyser.RemoveRule('r10')
+    editTime = time.perf_counter() - start
+    # 全量重建依赖图时两条规则变更需要数秒
+    assert loadTime < 1
+    assert editTime < 0.2
+    assert Analyser._ruleSet.FlagGraph.Edges == BruteForceEdges(Analyser._ruleSet)
+
+
+@pytest.mark.parametrize('Managed', [False, True])
+def test_terminal_rule_hits_are_deduplicated(Analyser, Hits, Managed):
+    actionFunc, calls = Hits
+    rules = {'login': MakeRule('login', [('event', 'login', 1)], CurrentFlag='login:{ip}')}
+    if Managed:
+        Analyser.LoadRules(rules)
+        assert 'login:{ip}' in Analyser._ruleSet.DeadTemplates
+    for i in range(3):
+        Analyser.AnalyseMain({'event': 'login', 'ip': '1'}, actionFunc, None if Managed else list(rules.values()))
+    assert calls == [('login', 'login:1')]
+    assert Analyser._flags == {'login:1': 'login:1'}
+
+
+def test_flag_query_sees_terminal_flags(Analyser, Hits):
+    actionFunc, calls = Hits
+    Analyser.LoadRules({'login': MakeRule('login', [('event', 'login', 1)], CurrentFlag='login:{ip}')})
+    Analyser.EnableFlagIndex('ip')
+    Analyser.AnalyseMain({'event': 'login', 'ip': '1'}, actionFunc)
+    assert Analyser.FlagQuery('ip', '1') == [('login:1', 'login:1')]
+
+
+def test_dead_flags_are_bounded(Analyser, Hits):
+    actionFunc, calls = Hits
+    Analyser.LoadRules(GraphRules())
+    Analyser.AddRule('report', MakeRule('report', [('event', 'report', 1)], CurrentFlag='report:{ip}'))
+    Analyser.DeadFlagLimit = 2
+    for ip in '1234':
+        Analyser.AnalyseMain({'event': 'login', 'ip': ip}, actionFunc)
+    for ip in '1231':
+        Analyser.AnalyseMain({'event': 'report', 'ip': ip}, actionFunc)
+    # 没有规则会用到的Flag只保留最近写入的2个，被回收的Flag再次命中时重新触发ActionFunc()，可被使用的Flag不受影响
+    assert [x for x in calls if x[0] == 'report'] == [('report', 'report:1'), ('report', 'report:2'), ('report', 'report:3'), ('report', 'report:1')]
+    assert sorted(x for x in Analyser._flags if x.startswith('report')) == ['report:1', 'report:3']
+    assert all('login:%s' % ip in Analyser._flags for ip in '1234')
+
+
+def test_flag_removed_hooks(Analyser, Hits):
+    actionFunc, calls = Hits
+    Analyser.LoadRules({
+        'login': MakeRule('login', [('event', 'login', 1)], CurrentFlag='login:{ip}', PluginNames='AnalyzerPluginThresholdLifetime', Threshold=1),
+        'download': MakeRule('download', [('event', 'download', 1)], PrevFlag='login:{ip}', CurrentFlag='download:{ip}')
+    })
+    thresholdPlugin = Analyser._plugins['AnalyzerPluginThresholdLifetime']
+    timedPlugin = Analyser._plugins['AnalyzerPluginTimedFlag']
+    Analyser.AnalyseMain({'event': 'login', 'ip': '1'}, actionFunc)
+    assert 'login:1' in thresholdPlugin._cache
+    timedPlugin._liveFlags.add('login:1')
+    Analyser.RemoveFlag('login:1')
+    assert 'login:1' not in thresholdPlugin._cache
+    assert 'login:1' not in timedPlugin._liveFlags
+    Analyser.AnalyseMain({'event': 'login', 'ip': '2'}, actionFunc)
+    Analyser.ClearCache()
+    assert 'login:2' not in thresholdPlugin._cache
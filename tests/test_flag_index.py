@@ -0,0 +1,89 @@
+import threading
+
+import pytest
+
+from conftest import MakeRule
+
+
+def ChainRules():
+    return {
+        'login': MakeRule('login', [('event', 'login', 1)], CurrentFlag='login:{src_ip}:{user}'),
+        'download': MakeRule(
+            'download', [('event', 'download', 1)], PrevFlag='login:{src_ip}:{user}', CurrentFlag='download:{src_ip}', RemoveFlag='login:{src_ip}:{user}'
+        )
+    }
+
+
+def test_query_follows_flag_changes(Analyser, Hits):
+    actionFunc, calls = Hits
+    Analyser.LoadRules(ChainRules())
+    Analyser.EnableFlagIndex('src_ip')
+    Analyser.EnableFlagIndex('user')
+    Analyser.AnalyseMain({'event': 'login', 'src_ip': '10.1.2.3', 'user': 'alice'}, actionFunc)
+    Analyser.AnalyseMain({'event': 'login', 'src_ip': '10.1.2.3', 'user': 'bob'}, actionFunc)
+    Analyser.AnalyseMain({'event': 'login', 'src_ip': '10.9.9.9', 'user': 'alice'}, actionFunc)
+    assert sorted(Analyser.FlagQuery('src_ip', '10.1.2.3')) == [
+        ('login:10.1.2.3:alice', 'login:10.1.2.3:alice'), ('login:10.1.2.3:bob', 'login:10.1.2.3:bob')
+    ]
+    assert sorted(x[0] for x in Analyser.FlagQuery('user', 'alice')) == ['login:10.1.2.3:alice', 'login:10.9.9.9:alice']
+    # RemoveFlag把前序Flag移出索引，本级Flag只有src_ip占位符
+    Analyser.AnalyseMain({'event': 'download', 'src_ip': '10.1.2.3', 'user': 'alice'}, actionFunc)
+    assert sorted(x[0] for x in Analyser.FlagQuery('src_ip', '10.1.2.3')) == ['download:10.1.2.3', 'login:10.1.2.3:bob']
+    assert [x[0] for x in Analyser.FlagQuery('user', 'alice')] == ['login:10.9.9.9:alice']
+    assert Analyser.FlagQuery('src_ip', '10.0.0.0') == []
+    Analyser.ClearCache()
+    assert Analyser.FlagQuery('src_ip', '10.1.2.3') == []
+    assert not Analyser._flagIndexKeys
+
+
+def test_enable_index_backfills_existing_flags(Analyser, Hits):
+    actionFunc, calls = Hits
+    Analyser.LoadRules(ChainRules())
+    Analyser.AnalyseMain({'event': 'login', 'src_ip': '10.1.2.3', 'user': 'a:b'}, actionFunc)
+    with pytest.raises(KeyError):
+        Analyser.FlagQuery('src_ip', '10.1.2.3')
+    Analyser.EnableFlagIndex('user')
+    Analyser.EnableFlagIndex('src_ip')
+    assert Analyser.FlagQuery('src_ip', '10.1.2.3') == [('login:10.1.2.3:a:b', 'login:10.1.2.3:a:b')]
+    assert Analyser.FlagQuery('user', 'a:b') == [('login:10.1.2.3:a:b', 'login:10.1.2.3:a:b')]
+    Analyser.DisableFlagIndex('user')
+    with pytest.raises(KeyError):
+        Analyser.FlagQuery('user', 'a:b')
+    Analyser.RemoveFlag('login:10.1.2.3:a:b')
+    assert Analyser.FlagQuery('src_ip', '10.1.2.3') == []
+    assert not Analyser._flagIndexes['src_ip']
+
+
+def test_query_values_are_strings(Analyser, Hits):
+    actionFunc, calls = Hits
+    Analyser.LoadRules({'port': MakeRule('port', [('event', 'scan', 1)], CurrentFlag='port:{port}')})
+    Analyser.EnableFlagIndex('port')
+    Analyser.AnalyseMain({'event': 'scan', 'port': 22}, actionFunc)
+    assert Analyser.FlagQuery('port', 22) == Analyser.FlagQuery('port', '22') == [('port:22', 'port:22')]
+
+
+def test_query_during_analysis(Analyser, Hits):
+    actionFunc, calls = Hits
+    Analyser.LoadRules(ChainRules())
+    Analyser.EnableFlagIndex('src_ip')
+    errors = []
+    done = threading.Event()
+
+    def Query():
+        try:
+            while not done.is_set():
+                for flag, item in Analyser.FlagQuery('src_ip', '10.0.0.1'):
+                    assert flag.endswith(':10.0.0.1') or flag.startswith('login:10.0.0.1:')
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=Query)
+    thread.start()
+    for i in range(3000):
+        event = 'login' if i % 2 == 0 else 'download'
+        Analyser.AnalyseMain({'event': event, 'src_ip': '10.0.0.1', 'user': str(i // 2 % 50)}, actionFunc)
+        if i % 500 == 499:
+            Analyser.ClearCache()
+    done.set()
+    thread.join()
+    assert errors == []
@@ -0,0 +1,79 @@
+import pytest
+
+from AnalyseLib import AnalyseBase
+from AnalyseCodegen import CodegenAnalyse
+from conftest import MakeRule
+
+
+def Rules():
+    return {
+        'scan': MakeRule('scan', [('event', 'scan', 1)], CurrentFlag='scan:{ip}', Priority=0),
+        'login': MakeRule('login', [('event', 'login', 1)], CurrentFlag='login:{ip}', Priority=5),
+        'download': MakeRule('download', [('event', 'download', 1)], PrevFlag='login:{ip}', CurrentFlag='download:{ip}')
+    }
+
+
+def test_shedder_levels():
+    shedder = AnalyseBase.LoadShedder(LatencyBudget=0.01, Smoothing=1, Step=0.5)
+    ruleSet = AnalyseBase.RuleSet([AnalyseBase.CompiledRule(k, v, {}) for k, v in Rules().items()])
+    shedder.SetRuleSet(ruleSet)
+    scan, login, download = ruleSet.Rules
+    for _ in range(10):
+        shedder.Observe(1)
+    # 两档入口点规则，Level不超过档数
+    assert shedder.Level == 2
+    assert shedder.ShouldShed(scan) and shedder.ShouldShed(login)
+    assert not shedder.ShouldShed(download)
+    shedder.Observe(0)
+    assert shedder.Level == 1.5
+    assert shedder.ShouldShed(scan)
+    shedder.Observe(0)
+    shedder.Observe(0)
+    shedder.Observe(0)
+    assert shedder.Level == 0
+    assert not shedder.ShouldShed(scan)
+    assert shedder.Stats['Shed'] == 3
+    assert shedder.Stats['ShedByRule'] == {'scan': 2, 'login': 1}
+
+
+def test_shedder_backlog():
+    shedder = AnalyseBase.LoadShedder(LatencyBudget=10, MaxBacklog=5, Step=1)
+    shedder.SetRuleSet(AnalyseBase.RuleSet([AnalyseBase.CompiledRule(k, v, {}) for k, v in Rules().items()]))
+    shedder.Observe(0)
+    assert shedder.Level == 0
+    shedder.Backlog = 6
+    shedder.Observe(0)
+    assert shedder.Level == 1
+
+
+@pytest.mark.parametrize('AnalyserType', [AnalyseBase, CodegenAnalyse])
+def test_entry_rules_shed_by_priority(AnalyserType, Hits):
+    actionFunc, calls = Hits
+    analyser = AnalyserType()
+    analyser.LoadRules(Rules())
+    # 预算为0，每条数据都超出预算，每条数据之后Level增加1
+    analyser.SetLoadShedding(0, Step=1)
+    analyser.AnalyseMain({'event': 'login', 'ip': '1'}, actionFunc)
+    analyser.AnalyseMain({'event': 'scan', 'ip': '1'}, actionFunc)
+    analyser.AnalyseMain({'event': 'login', 'ip': '2'}, actionFunc)
+    analyser.AnalyseMain({'event': 'download', 'ip': '1'}, actionFunc)
+    # 入口点规则全部跳过，已有的时序链仍然可以完成
+    assert calls == [('login', 'login:1'), ('download', 'download:1')]
+    # 跳过的是规则检查，每条数据上每条被跳过的入口点规则计一次
+    stats = analyser.LoadSheddingStats()
+    assert stats['Shed'] == 5
+    assert stats['ShedByRule'] == {'scan': 3, 'login': 2}
+    analyser.SetLoadShedding(None)
+    assert analyser.LoadSheddingStats() is None
+    analyser.AnalyseMain({'event': 'scan', 'ip': '1'}, actionFunc)
+    assert calls[-1] == ('scan', 'scan:1')
+
+
+def test_unmanaged_rules_are_not_shed(Analyser, Hits):
+    actionFunc, calls = Hits
+    Analyser.LoadRules(Rules())
+    Analyser.SetLoadShedding(0, Step=1)
+    for _ in range(3):
+        Analyser.AnalyseMain({'event': 'login', 'ip': '9'}, actionFunc)
+    Analyser.AnalyseMain({'event': 'scan', 'ip': '9'}, actionFunc, list(Rules().values()))
+    assert ('scan', 'scan:9') in calls
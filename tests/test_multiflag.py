@@ -0,0 +1,60 @@
+import copy
+
+from conftest import MakeRule
+
+PluginName = 'AnalyzerPluginMultiflag'
+
+
+def FlagRule(Id, Prefix):
+    return MakeRule(Id, [('type', Id, 1)], CurrentFlag=Prefix + ':{ip}')
+
+
+def CorrelationRule(**Extra):
+    return MakeRule('alert', [('type', 'alert', 1)], CurrentFlag='alert:{ip}', PluginNames=PluginName, PrevFlags=['a:{ip}', 'b:{ip}', 'c:{ip}'], **Extra)
+
+
+def Run(Analyser, Hits, Rules, Types):
+    actionFunc, calls = Hits
+    for eventType in Types:
+        Analyser.AnalyseMain({'type': eventType, 'ip': '1.1.1.1'}, actionFunc, Rules)
+    return [x for x in calls if x[0] == 'alert']
+
+
+def test_and_requires_all_prev_flags(Analyser, Hits):
+    rules = [FlagRule('a', 'a'), FlagRule('b', 'b'), FlagRule('c', 'c'), CorrelationRule()]
+    assert Run(Analyser, Hits, rules, ['a', 'b', 'alert']) == []
+    assert Run(Analyser, Hits, rules, ['c', 'alert']) == [('alert', 'alert:1.1.1.1')]
+
+
+def test_or_requires_any_prev_flag(Analyser, Hits):
+    rules = [FlagRule('b', 'b'), CorrelationRule(MultiFlagOperator=2)]
+    assert Run(Analyser, Hits, rules, ['alert']) == []
+    assert Run(Analyser, Hits, rules, ['b', 'alert']) == [('alert', 'alert:1.1.1.1')]
+
+
+def test_k_of_n_threshold(Analyser, Hits):
+    rules = [FlagRule('a', 'a'), FlagRule('c', 'c'), CorrelationRule(MultiFlagThreshold=2)]
+    assert Run(Analyser, Hits, rules, ['a', 'alert']) == []
+    assert Run(Analyser, Hits, rules, ['c', 'alert']) == [('alert', 'alert:1.1.1.1')]
+
+
+def test_negated_operator_matches_when_flags_missing(Analyser, Hits):
+    rules = [FlagRule('a', 'a'), CorrelationRule(MultiFlagOperator=-2)]
+    assert Run(Analyser, Hits, rules, ['alert']) == [('alert', 'alert:1.1.1.1')]
+
+
+def test_multiple_hit_items_returned_as_tuple(Analyser):
+    Analyser.AddFlag('a:1.1.1.1', 'itemA')
+    Analyser.AddFlag('b:1.1.1.1', 'itemB')
+    plugin = Analyser._plugins[PluginName]
+    assert plugin.MultiPrevFlagCheck(['a:1.1.1.1', 'b:1.1.1.1'], 1) == (True, ('itemA', 'itemB'))
+    assert plugin.MultiPrevFlagCheck(['a:1.1.1.1', 'x:1.1.1.1'], 1) == (False, None)
+    assert plugin.MultiPrevFlagCheck(['a:1.1.1.1', 'x:1.1.1.1'], 2) == (True, 'itemA')
+
+
+def test_remove_flags_and_rule_not_mutated(Analyser, Hits):
+    rules = [FlagRule('a', 'a'), FlagRule('b', 'b'), CorrelationRule(MultiFlagOperator=2, RemoveFlag='a:{ip}', RemoveFlags=['b:{ip}'])]
+    snapshot = copy.deepcopy(rules)
+    Run(Analyser, Hits, rules, ['a', 'b', 'alert', 'alert'])
+    assert 'a:1.1.1.1' not in Analyser._flags and 'b:1.1.1.1' not in Analyser._flags
+    assert rules == snapshot
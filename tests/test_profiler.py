@@ -0,0 +1,103 @@
+import json, random
+
+import pytest
+
+from AnalyseLib import AnalyseBase
+from AnalyseCodegen import CodegenAnalyse
+from AnalyseProfiler import EventProfiler
+from conftest import MakeRule
+from test_codegen import RandomRules, RandomEvents, Run, Managed
+
+
+def Profiled(Analyser, SampleRate):
+    profiler = EventProfiler(SampleRate=SampleRate, MaxOverhead=None, Seed=0)
+    Analyser.SetProfiler(profiler)
+    return Analyser, profiler
+
+
+@pytest.mark.parametrize('Seed', range(8))
+def test_traced_matches_untraced(Seed):
+    rand = random.Random(Seed)
+    rules = RandomRules(rand, Plugins=Seed % 2 == 0)
+    events = RandomEvents(rand)
+    # 插件对象绑定最后一个创建的分析算法对象，逐个创建、逐个运行
+    expected = Run(Managed(AnalyseBase(), rules), events)
+    assert any(calls for hits, calls in expected[0])
+    analyser, profiler = Profiled(Managed(AnalyseBase(), rules), 1)
+    assert Run(analyser, events) == expected
+    assert profiler.Stats()['Sampled'] == len(events)
+    analyser, profiler = Profiled(Managed(AnalyseBase(), rules, CachedFields='ab'), 0)
+    assert Run(analyser, events) == expected
+    assert profiler.Stats()['Sampled'] == 0
+    # 抽中的数据不经过匹配结果缓存，部分抽样时结果仍然相同
+    analyser, profiler = Profiled(Managed(AnalyseBase(), rules, CachedFields='ab'), 0.5)
+    assert Run(analyser, events) == expected
+    assert 0 < profiler.Stats()['Sampled'] < len(events)
+    analyser, profiler = Profiled(Managed(CodegenAnalyse(), rules), 1)
+    assert Run(analyser, events) == expected
+    # 非受管规则
+    expected = Run(AnalyseBase(), events, rules)
+    analyser, profiler = Profiled(AnalyseBase(), 1)
+    assert Run(analyser, events, rules) == expected
+
+
+def ChainRules():
+    return {
+        'login': MakeRule('login', [('event', 'login', 1)], CurrentFlag='login:{ip}'),
+        'download': MakeRule(
+            'download', [('event', 'download', 1)], PrevFlag='login:{ip}', CurrentFlag='download:{ip}', PluginNames='AnalyzerPluginMultiflag'
+        ),
+        'scan': MakeRule('scan', [('event', 'scan', 1)], PrevFlag='login:{ip}', CurrentFlag='scan:{ip}')
+    }
+
+
+def test_trace_spans(Analyser, Hits, tmp_path):
+    actionFunc, calls = Hits
+    Analyser.LoadRules(ChainRules())
+    Analyser, profiler = Profiled(Analyser, 1)
+    Analyser.AnalyseMain({'event': 'login', 'ip': '1'}, actionFunc)
+    Analyser.AnalyseMain({'event': 'scan', 'ip': '1'}, actionFunc)
+    assert calls == [('login', 'login:1'), ('scan', 'scan:1')]
+
+    stacks = {x.rsplit(' ', 1)[0] for x in profiler.CollapsedStacks().splitlines()}
+    assert 'AnalyseMain;Rule:login;FieldCheck:event' in stacks
+    assert 'AnalyseMain;Rule:login;RuleHit;ActionFunc' in stacks
+    assert 'AnalyseMain;Rule:download;Plugin:AnalyzerPluginMultiflag' in stacks
+    assert 'AnalyseMain;Rule:scan;FlagLookup' in stacks
+
+    traces = profiler.Traces()
+    assert [x['Sequence'] for x in traces] == [1, 2]
+    rule = traces[1]['Children'][2]
+    assert rule['Name'] == 'Rule:scan'
+    assert [x['Name'] for x in rule['Children']] == ['FieldCheck:event', 'FlagGenerator', 'FlagLookup', 'RuleHit']
+    assert rule['Children'][0]['Args'] == {'MatchCode': 1}
+
+    profiler.WriteTrace(str(tmp_path / 'trace.json'))
+    with open(str(tmp_path / 'trace.json'), encoding='utf-8') as f:
+        events = json.load(f)['traceEvents']
+    assert {x['tid'] for x in events} == {1, 2}
+    assert all(x['ph'] == 'X' and x['dur'] >= 0 for x in events)
+    profiler.Clear()
+    assert profiler.Stats()['Sampled'] == 0 and profiler.CollapsedStacks() == ''
+
+
+def test_sample_rate():
+    profiler = EventProfiler(SampleRate=0.1, MaxOverhead=None, Seed=1)
+    sampled = sum(profiler.Sample() for _ in range(10000))
+    assert 800 < sampled < 1200
+    assert not any(EventProfiler(SampleRate=0).Sample() for _ in range(100))
+    with pytest.raises(ValueError):
+        EventProfiler(SampleRate=2)
+
+
+def test_overhead_budget(Analyser, Hits):
+    actionFunc, calls = Hits
+    Analyser.LoadRules(ChainRules())
+    profiler = EventProfiler(SampleRate=1, MaxOverhead=0)
+    Analyser.SetProfiler(profiler)
+    for _ in range(5):
+        Analyser.AnalyseMain({'event': 'login', 'ip': '1'}, actionFunc)
+    # 第一次抽样之后耗时超出预算，之后的抽样全部跳过
+    stats = profiler.Stats()
+    assert stats['Sampled'] == 1 and stats['Skipped'] == 4 and stats['Seen'] == 5
+    Analyser.SetProfiler(None)
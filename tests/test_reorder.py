@@ -0,0 +1,95 @@
+import pytest
+
+from AnalyseReorder import ReorderBuffer
+from conftest import MakeRule
+
+
+def Rules():
+    return {
+        'login': MakeRule('login', [('event', 'login', 1)], CurrentFlag='login:{ip}'),
+        'download': MakeRule('download', [('event', 'download', 1)], PrevFlag='login:{ip}', CurrentFlag='download:{ip}')
+    }
+
+
+def Event(Name, Time, Ip='1'):
+    return {'event': Name, 'ip': Ip, 'ts': Time}
+
+
+def test_chain_survives_out_of_order_arrival(Analyser, Hits):
+    actionFunc, calls = Hits
+    Analyser.LoadRules(Rules())
+    buffer = ReorderBuffer(Analyser, actionFunc, 'ts', MaxLateness=5)
+    # download先到达，但事件时间晚于login
+    assert buffer.Push(Event('download', 12)) == []
+    assert buffer.Push(Event('login', 10)) == []
+    assert calls == []
+    released = buffer.Push(Event('other', 17))
+    assert [x[0]['event'] for x in released] == ['login', 'download']
+    assert calls == [('login', 'login:1'), ('download', 'download:1')]
+    assert buffer.Watermark == 12
+    assert buffer.Depth == 1
+    stats = buffer.Stats()
+    assert stats['OutOfOrder'] == 1
+    assert stats['MaxLateness'] == 2
+    assert stats['Released'] == 2
+
+
+def test_release_order_and_flush(Analyser, Hits):
+    actionFunc, calls = Hits
+    buffer = ReorderBuffer(Analyser, actionFunc, 'ts', MaxLateness=100)
+    for i, t in enumerate([5, 3, 5, 1, 4]):
+        buffer.Push({'ts': t, 'seq': i})
+    assert [x[0]['seq'] for x in buffer.AdvanceWatermark(102)] == [3]
+    released = buffer.Flush()
+    # 事件时间相同的数据按到达顺序释放
+    assert [x[0]['seq'] for x in released] == [1, 4, 0, 2]
+    assert buffer.Depth == 0
+
+
+def test_buffer_is_bounded(Analyser, Hits):
+    actionFunc, calls = Hits
+    buffer = ReorderBuffer(Analyser, actionFunc, 'ts', MaxLateness=1000, MaxBuffered=3)
+    for t in range(10, 20):
+        buffer.Push({'ts': t})
+        assert buffer.Depth <= 3
+    stats = buffer.Stats()
+    assert stats['ForcedReleases'] == 7
+    assert stats['MaxDepth'] == 4
+    assert buffer.Watermark == 16
+    # 水位线被强制推进之后，更早的数据按迟到处理
+    buffer.Push({'ts': 12})
+    assert buffer.Stats()['Late'] == 1
+
+
+@pytest.mark.parametrize('Policy', list(ReorderBuffer.LatePolicyCode))
+def test_late_policies(Analyser, Hits, Policy):
+    actionFunc, calls = Hits
+    Analyser.LoadRules(Rules())
+    late = []
+    buffer = ReorderBuffer(Analyser, actionFunc, 'ts', MaxLateness=1, LatePolicy=Policy, LateHandler=lambda data, lateness: late.append((data['event'], lateness)))
+    buffer.Push(Event('download', 10))
+    released = buffer.Push(Event('login', 5))
+    stats = buffer.Stats()
+    assert stats['Late'] == 1
+    if Policy == ReorderBuffer.LatePolicyCode.Drop:
+        assert released == [] and stats['LateDropped'] == 1 and calls == []
+    elif Policy == ReorderBuffer.LatePolicyCode.Callback:
+        assert released == [] and late == [('login', 5)] and calls == []
+    else:
+        assert [x[0]['event'] for x in released] == ['login']
+        assert calls == [('login', 'login:1')]
+
+
+def test_callback_policy_requires_handler(Analyser):
+    with pytest.raises(ValueError):
+        ReorderBuffer(Analyser, None, 'ts', 1, LatePolicy=ReorderBuffer.LatePolicyCode.Callback)
+
+
+def test_untimed_events_pass_through(Analyser, Hits):
+    actionFunc, calls = Hits
+    Analyser.LoadRules(Rules())
+    buffer = ReorderBuffer(Analyser, actionFunc, 'ts', MaxLateness=5)
+    released = buffer.Push({'event': 'login', 'ip': '2', 'ts': 'yesterday'})
+    assert [x[0]['ip'] for x in released] == ['2']
+    assert buffer.Stats()['Untimed'] == 1
+    assert calls == [('login', 'login:2')]
@@ -0,0 +1,157 @@
+import json
+
+import pytest
+
+import AnalyseReplay
+from AnalyseReorder import ReorderBuffer
+
+Rules = [
+    {'RuleId': 'login', 'Operator': 1, 'PrevFlag': '', 'CurrentFlag': 'login:{ip}', 'FieldCheckList': [{'FieldName': 'event', 'MatchContent': 'login', 'MatchCode': 1}]},
+    {'RuleId': 'dl', 'Operator': 1, 'PrevFlag': 'login:{ip}', 'CurrentFlag': 'dl:{ip}', 'FieldCheckList': [{'FieldName': 'event', 'MatchContent': 'dl', 'MatchCode': 1}]}
+]
+
+
+def WriteEvents(Path, Events):
+    with open(Path, 'w', encoding='utf-8') as f:
+        for event in Events:
+            f.write(event if type(event) == str else json.dumps(event))
+            f.write('\n')
+    return str(Path)
+
+
+def ReadHits(Path):
+    with open(Path, encoding='utf-8') as f:
+        return [json.loads(x) for x in f]
+
+
+def ChainEvents(Count):
+    events = []
+    for i in range(Count):
+        events.append({'event': 'login', 'ip': i, 'ts': 2 * i})
+        events.append({'event': 'dl', 'ip': i, 'ts': 2 * i + 1})
+    return events
+
+
+@pytest.mark.parametrize('Workers', [0, 2])
+def test_replay_jsonl(tmp_path, Workers):
+    inputPath = WriteEvents(tmp_path / 'events.jsonl', ChainEvents(500) + ['not json', '[1]'])
+    stats = AnalyseReplay.Replay(Rules, inputPath, str(tmp_path / 'hits.jsonl'), Workers=Workers, ChunkSize=1024)
+    assert stats['Events'] == 1000 and stats['ParseErrors'] == 2
+    assert stats['HitCounts'] == {'login': 500, 'dl': 500}
+    hits = ReadHits(tmp_path / 'hits.jsonl')
+    assert [x['Event'] for x in hits] == list(range(1000))
+    assert hits[1] == {'Event': 1, 'RuleId': 'dl', 'CurrentFlag': 'dl:0'}
+
+
+def test_replay_csv(tmp_path):
+    path = tmp_path / 'events.csv'
+    path.write_text('event,ip\nlogin,1\ndl,1\nbroken\ndl,2\n', encoding='utf-8')
+    stats = AnalyseReplay.Replay(Rules, str(path), Workers=0)
+    assert stats['Events'] == 3 and stats['ParseErrors'] == 1
+    assert stats['HitCounts'] == {'login': 1, 'dl': 1}
+
+
+class RecordingPool(object):
+    '记录提交次数的进程池替身，apply_async同步执行'
+
+    class Result(object):
+        def __init__(self, Value):
+            self.Value = Value
+
+        def get(self):
+            return self.Value
+
+    def __init__(self):
+        self.Submitted = 0
+
+    def apply_async(self, Func, Args):
+        self.Submitted += 1
+        return self.Result(Func(*Args))
+
+
+def test_parse_chunks_bounded(tmp_path):
+    inputPath = WriteEvents(tmp_path / 'events.jsonl', ChainEvents(100))
+    tasks = [(inputPath, start, end, 'jsonl', None) for start, end in AnalyseReplay.SplitChunks(inputPath, 256)]
+    assert len(tasks) > 10
+    pool = RecordingPool()
+    consumed = 0
+    for chunkEvents, chunkErrors in AnalyseReplay.ParseChunks(pool, tasks, 3):
+        consumed += 1
+        # 已提交未取走结果的块不超过3个
+        assert pool.Submitted - consumed <= 3
+    assert consumed == pool.Submitted == len(tasks)
+
+
+def test_replay_reorder_indexes(tmp_path):
+    events = ChainEvents(50)
+    # 每对事件交换顺序，dl先于login到达
+    for i in range(0, len(events), 2):
+        events[i], events[i + 1] = events[i + 1], events[i]
+    inputPath = WriteEvents(tmp_path / 'events.jsonl', events)
+    stats = AnalyseReplay.Replay(Rules, inputPath, str(tmp_path / 'hits.jsonl'), Workers=0, ReorderField='ts', MaxLateness=5)
+    assert stats['HitCounts'] == {'login': 50, 'dl': 50}
+    hits = ReadHits(tmp_path / 'hits.jsonl')
+    assert all(events[x['Event']]['event'] == x['RuleId'] for x in hits)
+
+
+@pytest.mark.parametrize('LatePolicy', [ReorderBuffer.LatePolicyCode.Drop, ReorderBuffer.LatePolicyCode.Callback])
+def test_replay_late_events(tmp_path, LatePolicy):
+    events = ChainEvents(50)
+    # 每10对中的login推迟到100秒之后到达，超出允许延迟
+    late = [events.pop(i) for i in range(80, -1, -20)]
+    events.extend(late)
+    lateEvents = []
+    inputPath = WriteEvents(tmp_path / 'events.jsonl', events)
+    stats = AnalyseReplay.Replay(
+        Rules, inputPath, str(tmp_path / 'hits.jsonl'), Workers=0, ReorderField='ts', MaxLateness=5,
+        LatePolicy=LatePolicy, LateHandler=lambda InputData, Lateness: lateEvents.append(InputData)
+    )
+    assert stats['Reorder']['Late'] == 5
+    assert stats['HitCounts'] == {'login': 45, 'dl': 45}
+    hits = ReadHits(tmp_path / 'hits.jsonl')
+    assert all(events[x['Event']]['event'] == x['RuleId'] and events[x['Event']]['ip'] == int(x['CurrentFlag'].split(':')[1]) for x in hits)
+    assert len(lateEvents) == (5 if LatePolicy == ReorderBuffer.LatePolicyCode.Callback else 0)
+
+
+def test_cli(tmp_path, capsys):
+    rulePath = tmp_path / 'rules.json'
+    rulePath.write_text(json.dumps(Rules), encoding='utf-8')
+    inputPath = WriteEvents(tmp_path / 'events.jsonl', ChainEvents(10))
+    assert AnalyseReplay.Main([str(rulePath), inputPath, '-w', '0', '--reorder-field', 'ts', '--drop-late', '--max-pending-chunks', '2']) == 0
+    assert 'events: 20' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('Workers', [0, 2])
+def test_replay_jsonl_line_separators(tmp_path, Workers):
+    # 只按\n分行：字段值里的U+2028、\x85等字符不是行分隔符，\r\n的\r一并去掉
+    events = [{'event': 'login', 'ip': 'a b\x85c\x1e'}, {'event': 'dl', 'ip': 'a b\x85c\x1e'}]
+    path = tmp_path / 'events.jsonl'
+    path.write_bytes(b''.join(json.dumps(x, ensure_ascii=False).encode('utf-8') + b'\r\n' for x in events * 20))
+    stats = AnalyseReplay.Replay(Rules, str(path), str(tmp_path / 'hits.jsonl'), Workers=Workers, ChunkSize=64)
+    assert stats['Events'] == 40 and stats['ParseErrors'] == 0
+    assert ReadHits(tmp_path / 'hits.jsonl')[1]['CurrentFlag'] == 'dl:a b\x85c\x1e'
+
+
+def test_replay_csv_quoted_newlines(tmp_path):
+    rows = ''.join('login,"%d\nx "\r\ndl,"%d\nx "\r\n' % (i, i) for i in range(50))
+    path = tmp_path / 'events.csv'
+    path.write_bytes(('event,ip\r\n' + rows).encode('utf-8'))
+    # 块很小，切分点必须避开引号内的换行
+    chunks = AnalyseReplay.SplitChunks(str(path), 16, len(b'event,ip\r\n'), b'"')
+    assert len(chunks) > 10
+    events = []
+    for start, end in chunks:
+        chunkEvents, chunkErrors = AnalyseReplay.ParseChunk((str(path), start, end, 'csv', ['event', 'ip']))
+        assert chunkErrors == 0
+        events.extend(chunkEvents)
+    assert events[1] == {'event': 'dl', 'ip': '0\nx '}
+    stats = AnalyseReplay.Replay(Rules, str(path), str(tmp_path / 'hits.jsonl'), Workers=0, ChunkSize=16)
+    assert stats['Events'] == 100 and stats['ParseErrors'] == 0
+    assert stats['HitCounts'] == {'login': 50, 'dl': 50}
+
+
+def test_replay_empty_csv(tmp_path):
+    path = tmp_path / 'events.csv'
+    path.write_text('', encoding='utf-8')
+    with pytest.raises(ValueError, match='no header'):
+        AnalyseReplay.Replay(Rules, str(path), Workers=0)
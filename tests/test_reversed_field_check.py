@@ -0,0 +1,94 @@
+import copy, threading
+
+import pytest
+
+from AnalyseLib import AnalyseBase
+from conftest import MakeRule
+from plugins import AnalyzerPluginReversedFieldCheck
+
+PluginName = 'AnalyzerPluginReversedFieldCheck'
+ReversedPlugin = AnalyzerPluginReversedFieldCheck.AnalysePlugin
+
+
+def Check(Value, Content, MatchCode):
+    fieldCheck = {'FieldName': 'f', 'MatchContent': Content, 'MatchCode': MatchCode}
+    rtn = AnalyseBase._DefaultFieldCheck(Value, fieldCheck)
+    # 编译后的字段匹配项和解释执行结果相同
+    assert AnalyseBase.FieldMatcher(fieldCheck)(Value) == rtn
+    return rtn
+
+
+@pytest.mark.parametrize('Value, Content, MatchCode, Expected', [
+    ('abc', 'xabcx', 7, True),
+    ('xabcx', 'abc', 7, False),
+    ('xabcx', 'abc', -7, True),
+    (b'\x00\x01', 'AAEC', 7, True),
+    ('a.c', 'abc', 8, True),
+    ('abc', 'a.c', 8, False),
+    ('[', 'abc', 8, False),
+    (5, 3, 9, True),
+    (3, 5, 9, False),
+    ('5', '3', 9, True),
+    (5, 3, -9, False)
+])
+def test_reversed_match_codes(Value, Content, MatchCode, Expected):
+    assert Check(Value, Content, MatchCode) == Expected
+
+
+def test_reverse_rule_maps_codes():
+    rule = MakeRule('r', [('a', 'x', 2), ('b', 'x', -3), ('c', 1, 4), ('d', 'x', 1), ('e', 3, 5)])
+    original = copy.deepcopy(rule)
+    reversedRule = ReversedPlugin.ReverseRule(rule)
+    assert [x['MatchCode'] for x in reversedRule['FieldCheckList']] == [7, -8, 9, 1, 5]
+    assert rule == original
+
+
+def test_plugin_matches_reversed_codes(Analyser, Hits):
+    actionFunc, calls = Hits
+    rules = [
+        MakeRule('plugin', [('url', 'http://a.example/x?q=1', 2)], CurrentFlag='p:{url}', PluginNames=PluginName),
+        MakeRule('code', [('url', 'http://a.example/x?q=1', 7)], CurrentFlag='c:{url}')
+    ]
+    original = copy.deepcopy(rules)
+    for url in ('a.example', 'b.example', '/x?q'):
+        Analyser.AnalyseMain({'url': url}, actionFunc, rules)
+    assert calls == [('plugin', 'p:a.example'), ('code', 'c:a.example'), ('plugin', 'p:/x?q'), ('code', 'c:/x?q')]
+    # 插件不修改规则，也不替换分析算法对象的FieldCheck()
+    assert rules == original
+    assert Analyser.FieldCheck == AnalyseBase.FieldCheck
+
+
+def test_plugin_is_reentrant(Analyser):
+    rules = [
+        MakeRule('plugin', [('v', 10, 4)], CurrentFlag='p:{n}', PluginNames=PluginName),
+        MakeRule('plain', [('v', 10, 4)], CurrentFlag='q:{n}')
+    ]
+    errors = []
+
+    def Worker(Offset):
+        for i in range(300):
+            n = Offset + i
+            value = 5 if n % 2 else 15
+            hits = Analyser.AnalyseMain({'v': value, 'n': n}, lambda *x: x[3], rules)
+            # 大于10的数据只命中插件规则，小于10的数据只命中普通规则
+            expected = {'q:%d' % n} if value == 5 else {'p:%d' % n}
+            if hits != expected:
+                errors.append((n, hits))
+
+    threads = [threading.Thread(target=Worker, args=(x * 1000,)) for x in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_rule_edits_take_effect(Analyser, Hits):
+    actionFunc, calls = Hits
+    rule = MakeRule('plugin', [('v', 'abc', 2)], CurrentFlag='p:{v}', PluginNames=PluginName)
+    Analyser.AnalyseMain({'v': 'b'}, actionFunc, [rule])
+    # 就地修改的规则立即生效，插件不保存按规则缓存的状态
+    rule['FieldCheckList'][0]['MatchContent'] = 'xyz'
+    Analyser.AnalyseMain({'v': 'b'}, actionFunc, [rule])
+    Analyser.AnalyseMain({'v': 'y'}, actionFunc, [rule])
+    assert calls == [('plugin', 'p:b'), ('plugin', 'p:y')]
@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+from AnalyseLib import AnalyseBase
+from conftest import MakeRule
+
+
+def Rules():
+    return {
+        'login': MakeRule('login', [('event', 'log.n', 3), ('ua', 'curl', 2)], CurrentFlag='login:{ip}'),
+        'download': MakeRule(
+            'download', [('event', 'download', 1)], PrevFlag='login:{ip}', CurrentFlag='download:{ip}', PluginNames='AnalyzerPluginMultiflag'
+        )
+    }
+
+
+def Events():
+    return [
+        {'event': 'login', 'ua': 'curl/8', 'ip': '1'},
+        {'event': 'download', 'ip': '1'},
+        {'event': 'download', 'ip': '2'}
+    ]
+
+
+def Run(Analyser, Hits):
+    actionFunc, calls = Hits
+    Analyser._flags.clear()
+    calls.clear()
+    for event in Events():
+        Analyser.AnalyseMain(event, actionFunc)
+    return list(calls)
+
+
+def NoCompile(*args):
+    raise AssertionError('rules compiled although the cache is valid')
+
+
+def test_cache_roundtrip(Analyser, Hits, tmp_path, monkeypatch):
+    cachePath = str(tmp_path / 'rules.cache')
+    Analyser.LoadRules(Rules(), CachePath=cachePath)
+    assert os.path.exists(cachePath)
+    expected = Run(Analyser, Hits)
+    assert expected == [('login', 'login:1'), ('download', 'download:1')]
+    compiled = Analyser._ruleSet
+    monkeypatch.setattr(Analyser, '_CompileRule', NoCompile)
+    rules = Rules()
+    Analyser.LoadRules(rules, CachePath=cachePath)
+    ruleSet = Analyser._ruleSet
+    assert ruleSet is not compiled
+    # 原规则和插件对象重新绑定，索引和依赖图随缓存加载
+    assert ruleSet.RuleMap['download'].Rule is rules['download']
+    assert ruleSet.RuleMap['download'].Plugins == (Analyser._plugins['AnalyzerPluginMultiflag'],)
+    assert ruleSet.FlagGraph.Edges == compiled.FlagGraph.Edges
+    assert ruleSet.MatcherBits.keys() == {id(x) for r in ruleSet.Rules for x in r.FieldMatchers}
+    assert Run(Analyser, Hits) == expected
+    Analyser.EnableFieldCache('event')
+    assert Run(Analyser, Hits) == expected
+
+
+def test_changed_rules_recompile(Analyser, Hits, tmp_path):
+    cachePath = str(tmp_path / 'rules.cache')
+    Analyser.LoadRules(Rules(), CachePath=cachePath)
+    with open(cachePath, 'rb') as f:
+        header = f.read(40)
+    rules = Rules()
+    rules['login']['CurrentFlag'] = 'user:{ip}'
+    rules['download']['PrevFlag'] = 'user:{ip}'
+    Analyser.LoadRules(rules, CachePath=cachePath)
+    assert Analyser._ruleSet.RuleMap['login'].CurrentFlag == 'user:{ip}'
+    with open(cachePath, 'rb') as f:
+        assert f.read(40) != header
+    # 输入格式也是缓存键的一部分
+    Analyser.SetSchema({'ip': str})
+    key = Analyser._RuleSetCacheKey(list(rules.items()))
+    Analyser.SetSchema(None)
+    assert Analyser._RuleSetCacheKey(list(rules.items())) != key
+
+
+@pytest.mark.parametrize('Content', [b'', b'AFRC', b'garbage' * 20])
+def test_invalid_cache_falls_back_to_compile(Analyser, Hits, tmp_path, Content):
+    cachePath = tmp_path / 'rules.cache'
+    cachePath.write_bytes(Content)
+    Analyser.LoadRules(Rules(), CachePath=str(cachePath))
+    assert Run(Analyser, Hits) == [('login', 'login:1'), ('download', 'download:1')]
+    # 无效的缓存文件被重新写入
+    assert cachePath.read_bytes().startswith(AnalyseBase._RuleSetCacheMagic)
+
+
+def test_truncated_cache_falls_back_to_compile(Analyser, Hits, tmp_path):
+    cachePath = tmp_path / 'rules.cache'
+    Analyser.LoadRules(Rules(), CachePath=str(cachePath))
+    cachePath.write_bytes(cachePath.read_bytes()[:-10])
+    Analyser.LoadRules(Rules(), CachePath=str(cachePath))
+    assert Run(Analyser, Hits) == [('login', 'login:1'), ('download', 'download:1')]
+
+
+def test_unwritable_cache_path(Analyser, Hits, tmp_path):
+    Analyser.LoadRules(Rules(), CachePath=str(tmp_path / 'missing' / 'rules.cache'))
+    assert Analyser.RuleIds == ['login', 'download']
+    assert not os.listdir(tmp_path)
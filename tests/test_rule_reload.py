@@ -0,0 +1,125 @@
+import pytest
+
+from conftest import MakeRule
+
+
+def LoginRules():
+    return {
+        'login': MakeRule('login', [('event', 'login', 1)], CurrentFlag='login:{ip}'),
+        'download': MakeRule('download', [('event', 'download', 1)], PrevFlag='login:{ip}', CurrentFlag='download:{ip}')
+    }
+
+
+def test_managed_rules_analyse(Analyser, Hits):
+    actionFunc, calls = Hits
+    Analyser.LoadRules(LoginRules())
+    assert Analyser.RuleIds == ['login', 'download']
+    Analyser.AnalyseMain({'event': 'download', 'ip': '1'}, actionFunc)
+    Analyser.AnalyseMain({'event': 'login', 'ip': '1'}, actionFunc)
+    Analyser.AnalyseMain({'event': 'download', 'ip': '1'}, actionFunc)
+    assert calls == [('login', 'login:1'), ('download', 'download:1')]
+
+
+def test_no_managed_rules_returns_none(Analyser):
+    assert Analyser.AnalyseMain({'event': 'login'}, None) is None
+
+
+def test_list_rules_use_rule_id_or_index(Analyser):
+    Analyser.LoadRules([MakeRule('a', RuleId='first'), MakeRule('b')])
+    assert Analyser.RuleIds == ['first', 1]
+    with pytest.raises(KeyError):
+        Analyser.LoadRules([MakeRule('a', RuleId=1), MakeRule('b')])
+
+
+def test_edits_only_compile_changed_rules(Analyser):
+    Analyser.LoadRules(LoginRules())
+    login = Analyser._ruleSet.RuleMap['login']
+    Analyser.AddRule('logout', MakeRule('logout', [('event', 'logout', 1)], CurrentFlag='logout:{ip}'))
+    Analyser.ReplaceRule('download', MakeRule('download', [('event', 'get', 1)], PrevFlag='login:{ip}', CurrentFlag='download:{ip}'))
+    assert Analyser.RuleIds == ['login', 'download', 'logout']
+    assert Analyser._ruleSet.RuleMap['login'] is login
+    assert Analyser._ruleSet.RuleMap['download'].FieldMatchers[0].MatchContent == 'get'
+    with pytest.raises(KeyError):
+        Analyser.AddRule('login', MakeRule('login'))
+    with pytest.raises(KeyError):
+        Analyser.ReplaceRule('missing', MakeRule('missing'))
+    with pytest.raises(KeyError):
+        Analyser.RemoveRule('missing')
+
+
+def test_update_rules_is_atomic(Analyser):
+    Analyser.LoadRules(LoginRules())
+    oldRuleSet = Analyser._ruleSet
+    with pytest.raises(KeyError):
+        Analyser.UpdateRules({'new': MakeRule('new')}, RemoveRuleIds=['missing'])
+    assert Analyser._ruleSet is oldRuleSet
+    Analyser.UpdateRules({'new': MakeRule('new')}, RemoveRuleIds=['download'])
+    assert Analyser.RuleIds == ['login', 'new']
+
+
+def test_remove_rule_reclaims_orphan_flags(Analyser, Hits):
+    actionFunc, calls = Hits
+    rules = LoginRules()
+    rules['login2'] = MakeRule('login2', [('event', 'sso', 1)], CurrentFlag='login:{ip}')
+    Analyser.LoadRules(rules)
+    Analyser.AnalyseMain({'event': 'login', 'ip': '1'}, actionFunc)
+    Analyser.RemoveRule('login')
+    # 还有login2引用login:{ip}模板，Flag保留
+    assert 'login:1' in Analyser._flags
+    Analyser.RemoveRule('login2')
+    assert 'login:1' not in Analyser._flags
+
+
+def test_running_analysis_keeps_its_snapshot(Analyser):
+    # ActionFunc里移除后续规则，本条数据仍按开始分析时的快照执行
+    calls = []
+
+    def ActionFunc(InputData, InputRule, HitItem, CurrentFlag):
+        calls.append(InputRule['Id'])
+        if InputRule['Id'] == 'a' and 'b' in Analyser.RuleIds:
+            Analyser.RemoveRule('b')
+        return CurrentFlag
+
+    Analyser.LoadRules({'a': MakeRule('a', CurrentFlag='a:{ip}'), 'b': MakeRule('b', CurrentFlag='b:{ip}')})
+    Analyser.AnalyseMain({'ip': '1'}, ActionFunc)
+    assert calls == ['a', 'b']
+    Analyser.AnalyseMain({'ip': '2'}, ActionFunc)
+    assert calls == ['a', 'b', 'a']
+
+
+def test_plugins_notified_of_removed_rules(Analyser, monkeypatch):
+    removed = []
+    plugin = Analyser._plugins['AnalyzerPluginMultiflag']
+    monkeypatch.setattr(plugin, 'OnRuleRemoved', lambda InputRule: removed.append(InputRule['Id']))
+    rules = LoginRules()
+    for rule in rules.values():
+        rule['PluginNames'] = 'AnalyzerPluginMultiflag'
+    Analyser.LoadRules(rules)
+    Analyser.ReplaceRule('login', MakeRule('login'))
+    Analyser.RemoveRule('download')
+    assert removed == ['login', 'download']
+
+
+def test_concurrent_reload_and_analyse(Analyser):
+    import threading
+    Analyser.LoadRules(LoginRules())
+    errors = []
+    stop = threading.Event()
+
+    def Reload():
+        i = 0
+        while not stop.is_set():
+            Analyser.UpdateRules({'extra%d' % (i % 5): MakeRule('extra', [('event', 'x%d' % i, 1)], CurrentFlag='x:{ip}')})
+            i += 1
+
+    thread = threading.Thread(target=Reload)
+    thread.start()
+    try:
+        for i in range(2000):
+            Analyser.AnalyseMain({'event': ('login', 'download')[i % 2], 'ip': str(i % 50)}, None)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        stop.set()
+        thread.join()
+    assert errors == []
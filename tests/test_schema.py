@@ -0,0 +1,125 @@
+import random
+
+import pytest
+
+from AnalyseLib import AnalyseBase
+from AnalyseCodegen import CodegenAnalyse
+from conftest import MakeRule
+from test_codegen import Run, Managed
+
+FieldValues = {
+    str: ['', 'abc', 'ABC', 'xyzabc', '5', '05', '1.5', 'a.c', '^a', '['],
+    int: [-3, -1, 0, 1, 2, 5, 12, 100],
+    float: [-2.5, -0.5, 0.0, 0.5, 1.0, 1.5, 5.0, 5.5, 12.5],
+    bytes: [b'', b'abc', b'\x00\x01', b'12', b'xyzabc']
+}
+MatchContents = ['abc', 'a.', '5', '05', '1.5', 'YWJj', 'AAE=', '!!', 0, 1, 5, 12, -1, 0.5, 1.5, 5.0, -0.5, True, b'YWJj', [1, 2]]
+OffTypeValues = ['5', 5, 5.0, b'5', None]
+
+
+def Matcher(Content, MatchCode, FieldType=None):
+    return AnalyseBase.FieldMatcher({'FieldName': 'f', 'MatchContent': Content, 'MatchCode': MatchCode}, FieldType)
+
+
+@pytest.mark.parametrize('FieldType', sorted(FieldValues, key=lambda x: x.__name__))
+def test_typed_matches_untyped(FieldType):
+    checked = 0
+    for mode in AnalyseBase.FieldMatcher._TypedModes[FieldType]:
+        for content in MatchContents:
+            for matchCode in (mode, -mode):
+                untyped = Matcher(content, matchCode)
+                try:
+                    typed = Matcher(content, matchCode, FieldType)
+                except TypeError:
+                    # 只有不可能匹配该类型任何值的匹配项在加载时报错
+                    assert {untyped(x) for x in FieldValues[FieldType]} == {matchCode < 0}, (mode, content)
+                    continue
+                for value in FieldValues[FieldType] + OffTypeValues:
+                    assert typed(value) == untyped(value), (matchCode, content, value)
+                checked += 1
+    assert checked > 20
+
+
+def test_numeric_threshold_keeps_type():
+    # int字段的float阈值不取整，大于比较和不声明类型时一致
+    matcher = Matcher(1.5, 4, int)
+    assert matcher._typed and matcher._typedContent == 1.5
+    assert [matcher(x) for x in (1, 2)] == [True, False]
+    matcher = Matcher(1.5, 9, int)
+    assert [matcher(x) for x in (1, 2)] == [False, True]
+    assert Matcher(5, 4, float)._typedContent == 5
+    assert Matcher('5', 4, int)._typedContent == 5
+    # float字段和字符串阈值按截断取整比较，没有等价的专用比较，使用通用比较函数
+    matcher = Matcher('0', 4, float)
+    assert not matcher._typed
+    assert matcher(-0.5) == Matcher('0', 4)(-0.5) == False
+
+
+def test_load_time_errors(Analyser):
+    Analyser.SetSchema({'n': 'int', 's': str})
+    rules = {
+        'threshold': MakeRule('threshold', [('n', 1.5, 4)], CurrentFlag='t'),
+        'regex': MakeRule('regex', [('n', 'a.', 3)], CurrentFlag='r'),
+        'equal': MakeRule('equal', [('n', 5.5, 1)], CurrentFlag='e'),
+        'length': MakeRule('length', [('s', 5, 5)], CurrentFlag='l')
+    }
+    with pytest.raises(TypeError) as e:
+        Analyser.LoadRules(rules)
+    message = str(e.value)
+    assert message.startswith('3 rule(s)')
+    assert "Rule 'regex'" in message and "Rule 'equal'" in message and "Rule 'length'" in message
+    del rules['regex'], rules['equal'], rules['length']
+    Analyser.LoadRules(rules)
+    # 重新编译失败时保持原输入格式
+    Analyser.AddRule('text', MakeRule('text', [('s', 'abc', 2)], CurrentFlag='x'))
+    with pytest.raises(TypeError):
+        Analyser.SetSchema({'s': int})
+    assert Analyser._schema == {'n': int, 's': str}
+    with pytest.raises(TypeError):
+        Analyser.SetSchema({'n': list})
+
+
+def RandomRules(Random, Schema, Count=24):
+    rules = []
+    for i in range(Count):
+        fieldCheckList = []
+        for _ in range(Random.randint(1, 2)):
+            fieldName = Random.choice(sorted(Schema))
+            mode = Random.choice(AnalyseBase.FieldMatcher._TypedModes[Schema[fieldName]])
+            fieldCheckList.append((fieldName, Random.choice(MatchContents), mode * Random.choice((1, -1))))
+        rule = MakeRule(
+            i, fieldCheckList, Operator=Random.choice((1, 2, -1, -2)),
+            PrevFlag='r%d:{k}' % Random.randrange(i) if i and Random.random() < 0.3 else '',
+            CurrentFlag='r%d:{k}' % i
+        )
+        try:
+            for fieldName, content, matchCode in fieldCheckList:
+                Matcher(content, matchCode, Schema[fieldName])
+        except TypeError:
+            continue
+        rules.append(rule)
+    return rules
+
+
+@pytest.mark.parametrize('Seed', range(6))
+def test_schema_results_unchanged(Seed):
+    rand = random.Random(Seed)
+    schema = {'s': str, 'n': int, 'x': float, 'b': bytes}
+    rules = RandomRules(rand, schema)
+    events = []
+    for _ in range(300):
+        event = {'k': rand.choice('123')}
+        for fieldName, fieldType in schema.items():
+            if rand.random() < 0.8:
+                # 少量数据的字段值不是声明的类型
+                event[fieldName] = rand.choice(FieldValues[fieldType] if rand.random() < 0.9 else OffTypeValues)
+        events.append(event)
+    expected = Run(Managed(AnalyseBase(), rules), events)
+    assert any(calls for hits, calls in expected[0])
+    for analyserType in (AnalyseBase, CodegenAnalyse):
+        analyser = analyserType()
+        analyser.SetSchema(schema)
+        assert Run(Managed(analyser, rules), events) == expected
+        analyser = analyserType()
+        analyser.SetSchema(schema)
+        assert Run(Managed(analyser, rules, CachedFields='sn'), events) == expected
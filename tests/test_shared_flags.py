@@ -0,0 +1,168 @@
+import os, time, random, multiprocessing
+
+import pytest
+
+from AnalyseLib import AnalyseBase
+from AnalyseSharedFlags import SharedFlagStore
+from conftest import MakeRule
+
+
+@pytest.fixture
+def Store():
+    store = SharedFlagStore(Slots=256, ArenaBytes=64 << 10, Shards=4)
+    yield store
+    store.Close()
+    store.Unlink()
+
+
+def ChainRules():
+    return {
+        'login': MakeRule('login', [('event', 'login', 1)], CurrentFlag='login:{ip}'),
+        'download': MakeRule('download', [('event', 'download', 1)], PrevFlag='login:{ip}', CurrentFlag='download:{ip}')
+    }
+
+
+def ActionFunc(InputData, InputRule, HitItem, CurrentFlag):
+    return (CurrentFlag, HitItem)
+
+
+def DownloadWorker(InputStore, InputQueue):
+    analyser = AnalyseBase()
+    analyser.LoadRules(ChainRules())
+    analyser.SetFlagStore(InputStore)
+    hits = analyser.AnalyseMain({'event': 'download', 'ip': '10.0.0.1'}, ActionFunc)
+    InputQueue.put(hits)
+
+
+def SlowActionFunc(InputData, InputRule, HitItem, CurrentFlag):
+    # 所有进程都在ActionFunc()期间，Flag冲突检查时都看不到其他进程的Flag
+    time.sleep(0.2)
+    return (CurrentFlag, os.getpid())
+
+
+def LoginWorker(InputStore, InputBarrier, InputQueue):
+    analyser = AnalyseBase()
+    analyser.LoadRules(ChainRules())
+    analyser.SetFlagStore(InputStore)
+    InputBarrier.wait()
+    hits = analyser.AnalyseMain({'event': 'login', 'ip': '10.0.0.2'}, SlowActionFunc)
+    InputQueue.put((hits, analyser.ConflictStats['Conflicts']))
+
+
+def OverwriteWorker(InputStore, Seconds):
+    deadline = time.time() + Seconds
+    n = 0
+    while time.time() < deadline:
+        for i in range(40):
+            InputStore['key%d' % i] = 'key%d:%d' % (i, n)
+        n += 1
+
+
+def test_random_operations_match_dict(Store):
+    rand = random.Random(3)
+    expected = dict()
+    for step in range(5000):
+        key = 'flag:%d' % rand.randrange(150)
+        op = rand.random()
+        if op < 0.55:
+            value = (key, step, 'x' * rand.randrange(200))
+            Store[key] = value
+            expected[key] = value
+        elif op < 0.8:
+            assert Store.pop(key, None) == expected.pop(key, None)
+        else:
+            assert (key in Store) == (key in expected)
+            assert Store.get(key) == expected.get(key)
+        if step % 500 == 0:
+            assert len(Store) == len(expected)
+            assert dict(Store.items()) == expected
+    assert sorted(Store) == sorted(expected)
+    assert Store.Stats()['Flags'] == len(expected)
+    with pytest.raises(KeyError):
+        del Store['missing']
+    Store.clear()
+    assert len(Store) == 0 and list(Store) == []
+
+
+def test_ttl_and_copy_semantics(Store):
+    Store.Set('short', 1, TTL=0.05)
+    Store['item'] = {'count': 1}
+    assert 'short' in Store
+    time.sleep(0.1)
+    assert 'short' not in Store
+    # 按值保存，就地修改读到的对象不会写回
+    item = Store['item']
+    item['count'] += 1
+    assert Store['item'] == {'count': 1}
+
+
+def test_open_by_name_is_read_only(Store):
+    Store['a'] = 1
+    reader = SharedFlagStore(Store.Name, Create=False)
+    try:
+        assert reader['a'] == 1
+        with pytest.raises(PermissionError):
+            reader['b'] = 2
+    finally:
+        reader.Close()
+
+
+def test_chain_across_processes(Store, Analyser):
+    Analyser.LoadRules(ChainRules())
+    Analyser.SetFlagStore(Store)
+    Analyser.AnalyseMain({'event': 'login', 'ip': '10.0.0.1'}, ActionFunc)
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=DownloadWorker, args=(Store, queue))
+    process.start()
+    hits = queue.get(timeout=60)
+    process.join(60)
+    assert hits == {('download:10.0.0.1', ('login:10.0.0.1', None))}
+    # 子进程写入的Flag在本进程可见
+    assert Store['download:10.0.0.1'] == ('download:10.0.0.1', ('login:10.0.0.1', None))
+
+
+def test_reads_never_fail_during_compaction(Store):
+    process = multiprocessing.Process(target=OverwriteWorker, args=(Store, 1.5))
+    process.start()
+    reads = 0
+    try:
+        deadline = time.time() + 1.5
+        while time.time() < deadline:
+            for i in range(40):
+                key = 'key%d' % i
+                value = Store.get(key)
+                assert value is None or value.startswith(key + ':')
+                reads += 1
+    finally:
+        process.join(10)
+    assert process.exitcode == 0
+    assert reads > 1000
+
+
+def test_set_if_absent(Store):
+    assert Store.SetIfAbsent('a', 1) == (True, None)
+    assert Store.SetIfAbsent('a', 2) == (False, 1)
+    assert Store['a'] == 1
+    assert Store.setdefault('a', 3) == 1
+    assert Store.setdefault('b', 4) == 4 and Store['b'] == 4
+    # 过期的Flag视为不存在
+    Store.Set('c', 1, TTL=0.05)
+    time.sleep(0.1)
+    assert Store.SetIfAbsent('c', 2) == (True, None)
+    assert Store['c'] == 2 and len(Store) == 3
+
+
+def test_concurrent_hits_deduplicated(Store):
+    barrier = multiprocessing.Barrier(4)
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=LoginWorker, args=(Store, barrier, queue)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    results = [queue.get(timeout=60) for _ in processes]
+    for process in processes:
+        process.join(60)
+    # 四个进程同时命中，只有一个写入Flag并返回用户数据对象，其他进程按冲突跳过
+    hits = [x[0] for x in results if x[0]]
+    assert len(hits) == 1
+    assert sum(x[1] for x in results) == 3
+    assert {Store['login:10.0.0.2']} == hits[0]
@@ -0,0 +1,101 @@
+import tracemalloc
+
+import pytest
+
+from conftest import MakeRule
+from plugins import AnalyzerPluginSketch
+
+PluginName = 'AnalyzerPluginSketch'
+SketchPlugin = AnalyzerPluginSketch.AnalysePlugin
+
+
+@pytest.fixture(autouse=True)
+def ClearSketches():
+    # 计数状态按规则内容保存在类属性里，内容相同的规则共用，用例前后清空
+    SketchPlugin._sketches.clear()
+    yield
+    SketchPlugin._sketches.clear()
+
+
+def Plugin(Analyser):
+    return Analyser._plugins[PluginName]
+
+
+def SketchRule(**Extra):
+    return MakeRule('s', [('event', 'conn', 1)], CurrentFlag='s:{src}', PluginNames=PluginName, SketchTimeField='ts', **Extra)
+
+
+def Results(Analyser, Rule, Events):
+    plugin = Plugin(Analyser)
+    return [plugin.AnalyseSingleData(dict(event='conn', ts=0, **x), Rule)[0] for x in Events]
+
+
+def test_frequency_threshold(Analyser):
+    rule = SketchRule(SketchThreshold=3)
+    assert Results(Analyser, rule, [{'src': 'a'}, {'src': 'b'}, {'src': 'a'}, {'src': 'a'}]) == [False, False, False, True]
+
+
+def test_frequency_window_decay(Analyser):
+    rule = SketchRule(SketchThreshold=2, SketchWindow=10, SketchDecay=0)
+    plugin = Plugin(Analyser)
+    assert plugin.AnalyseSingleData({'event': 'conn', 'src': 'a', 'ts': 0}, rule)[0] is False
+    assert plugin.AnalyseSingleData({'event': 'conn', 'src': 'a', 'ts': 11}, rule)[0] is False
+    assert plugin.AnalyseSingleData({'event': 'conn', 'src': 'a', 'ts': 12}, rule)[0] is True
+
+
+def test_distinct_threshold(Analyser):
+    rule = SketchRule(SketchMode=2, SketchItem='{dst}', SketchThreshold=50)
+    events = [{'src': 'a', 'dst': i % 40} for i in range(200)] + [{'src': 'a', 'dst': i} for i in range(40, 60)]
+    results = Results(Analyser, rule, events)
+    assert not any(results[:200])
+    assert results[-1]
+
+
+def test_hll_sparse_matches_dense():
+    HyperLogLog = __import__('plugins.AnalyzerPluginSketch', fromlist=['AnalysePlugin']).AnalysePlugin.HyperLogLog
+    for count in (1, 10, 200, 300, 5000, 50000):
+        sparse, dense = HyperLogLog(14), HyperLogLog(14)
+        dense._ToDense()
+        for i in range(count):
+            sparse.Add(i)
+            dense.Add(i)
+        assert sparse.Estimate() == dense.Estimate()
+        assert abs(sparse.Estimate() - count) <= max(2, count * 0.03)
+        assert sparse.Sparse == (count <= 256)
+        if not sparse.Sparse:
+            assert bytes(sparse.Registers) == bytes(dense.Registers)
+
+
+def test_small_keys_stay_small(Analyser):
+    rule = SketchRule(SketchMode=2, SketchItem='{dst}', SketchThreshold=10 ** 9)
+    events = [{'src': i, 'dst': j} for i in range(1000) for j in range(3)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    Results(Analyser, rule, events)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    # 稠密表示需要1000*16KB
+    assert used < 2 << 20
+
+
+def test_max_keys_evicts_oldest(Analyser):
+    rule = SketchRule(SketchMode=2, SketchItem='{dst}', SketchMaxKeys=10)
+    Results(Analyser, rule, [{'src': i, 'dst': 0} for i in range(25)])
+    state = SketchPlugin._sketches[SketchPlugin._RuleStateKey(rule)]
+    assert list(state.Sketch) == ['s:%d' % i for i in range(15, 25)]
+
+
+
+def test_invalid_mode_rejected(Analyser):
+    with pytest.raises(ValueError, match='SketchMode'):
+        Results(Analyser, SketchRule(SketchMode=3), [{'src': 1}])
+    assert not SketchPlugin._sketches
+
+
+def test_rule_states_bounded(Analyser, monkeypatch):
+    monkeypatch.setattr(SketchPlugin, '_MaxRules', 3)
+    for i in range(10):
+        Results(Analyser, SketchRule(SketchThreshold=2, SketchKey='k%d' % i), [{'src': 1}])
+    assert len(SketchPlugin._sketches) == 3
+    # 重新构造的同样的规则沿用计数状态
+    assert Results(Analyser, SketchRule(SketchThreshold=2, SketchKey='k9'), [{'src': 1}]) == [True]
@@ -0,0 +1,78 @@
+import base64
+
+import pytest
+
+from conftest import MakeRule
+
+PluginName = 'AnalyzerPluginSlicer'
+
+
+def SliceCheck(Analyser, TargetData, MatchContent, MatchCode, SliceFrom, SliceTo=None):
+    plugin = Analyser._plugins[PluginName]
+    return plugin.SliceFieldCheck(TargetData, {
+        'FieldName': 'f', 'MatchContent': MatchContent, 'MatchCode': MatchCode, 'SliceFrom': SliceFrom, 'SliceTo': SliceTo
+    })
+
+
+@pytest.mark.parametrize('TargetData, MatchContent, MatchCode, SliceFrom, SliceTo, Expected', [
+    ('John Doe', 'Doe', 1, -3, None, True),
+    ('John Doe', 'Do', 1, -3, None, False),
+    ('John Doe', 'oh', 2, 0, 4, True),
+    ('John Doe', 'Doe', 2, 0, 4, False),
+    ('John Doe', r'J\w+$', 3, 0, 4, True),
+    ('port=8080', 9000, 4, 5, None, True),
+    ('port=8080', 3, 5, 0, 4, False),
+    ('port=8080', 3, 6, 0, 5, True),
+    # 翻转匹配
+    ('John Doe', 'Doe Smith', 7, -3, None, True),
+    ('John Doe', 'Smith', 7, -3, None, False),
+    ('id=a.c', 'abc', 8, 3, None, True),
+    ('id=a.c', 'xbc', 8, 3, None, False),
+    ('id=(', '(', 8, 3, None, False),
+    ('port=8080', 8000, 9, 5, None, True),
+    ('port=8080', 9000, 9, 5, None, False),
+])
+def test_slice_match_codes(Analyser, TargetData, MatchContent, MatchCode, SliceFrom, SliceTo, Expected):
+    assert SliceCheck(Analyser, TargetData, MatchContent, MatchCode, SliceFrom, SliceTo) is Expected
+    assert SliceCheck(Analyser, TargetData, MatchContent, -MatchCode, SliceFrom, SliceTo) is (not Expected)
+
+
+@pytest.mark.parametrize('MatchContent, MatchCode, Expected', [
+    (base64.b64encode(b'\x01\x02').decode(), 1, True),
+    (base64.b64encode(b'\x00\x01\x02\x03').decode(), 7, True),
+    (base64.b64encode(b'\x03\x04').decode(), 7, False),
+    ('\x01\x02xyz', 8, True),
+    ('xyz', 8, False),
+    (0, 9, False),
+])
+def test_slice_binary_data(Analyser, MatchContent, MatchCode, Expected):
+    targetData = b'\xff\x01\x02'
+    assert SliceCheck(Analyser, targetData, MatchContent, MatchCode, 1) is Expected
+    assert SliceCheck(Analyser, targetData, MatchContent, -MatchCode, 1) is (not Expected)
+
+
+def test_slice_rule_through_plugin(Analyser, Hits):
+    actionFunc, calls = Hits
+    rule = MakeRule('r', [('name', 'Doe Smith', 7)], CurrentFlag='r:{name}', PluginNames=PluginName)
+    rule['FieldCheckList'][0]['SliceFrom'] = -3
+    Analyser.AnalyseMain({'name': 'John Doe'}, actionFunc, [rule])
+    Analyser.AnalyseMain({'name': 'John Roe'}, actionFunc, [rule])
+    assert calls == [('r', 'r:John Doe')]
+
+
+def test_matcher_cache_bounded_across_rebuilt_rules(Analyser):
+    plugin = Analyser._plugins[PluginName]
+    plugin._CompileSliceMatcher.cache_clear()
+    for i in range(1000):
+        # 每次重建规则dict，内容相同的字段匹配项共用一个匹配器
+        assert SliceCheck(Analyser, 'John Doe', 'Doe', 1, -3)
+    assert plugin._CompileSliceMatcher.cache_info().currsize == 1
+    for i in range(5000):
+        SliceCheck(Analyser, 'John Doe', 'Doe%d' % i, 1, -3)
+    assert plugin._CompileSliceMatcher.cache_info().currsize <= plugin._CompileSliceMatcher.cache_info().maxsize
+
+
+def test_matcher_cache_distinguishes_content_type(Analyser):
+    assert SliceCheck(Analyser, 'a1', 1, 1, 1)
+    assert SliceCheck(Analyser, 'aTrue', True, 1, 1)
+    assert SliceCheck(Analyser, 'a1.0', 1.0, 1, 1)
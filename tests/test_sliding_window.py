@@ -0,0 +1,88 @@
+import pytest
+
+from conftest import MakeRule
+from plugins import AnalyzerPluginSlidingWindow
+
+PluginName = 'AnalyzerPluginSlidingWindow'
+WindowPlugin = AnalyzerPluginSlidingWindow.AnalysePlugin
+
+
+@pytest.fixture(autouse=True)
+def ClearWindows():
+    # 计数器按规则内容保存在类属性里，内容相同的规则共用，用例前后清空
+    WindowPlugin._windows.clear()
+    yield
+    WindowPlugin._windows.clear()
+
+
+def WindowRule(**Extra):
+    return MakeRule('w', [('event', 'fail', 1)], CurrentFlag='w:{ip}', PluginNames=PluginName, WindowTimeField='ts', **Extra)
+
+
+def Results(Analyser, Rule, Events):
+    plugin = Analyser._plugins[PluginName]
+    return [plugin.AnalyseSingleData(dict(event='fail', ip=ip, ts=ts), Rule)[0] for ip, ts in Events]
+
+
+def test_threshold_within_window(Analyser):
+    rule = WindowRule(WindowSeconds=10, WindowThreshold=3)
+    assert Results(Analyser, rule, [('1', 0), ('1', 1), ('1', 2), ('1', 3)]) == [False, False, True, True]
+
+
+def test_counts_are_per_key(Analyser):
+    rule = WindowRule(WindowSeconds=10, WindowThreshold=2)
+    assert Results(Analyser, rule, [('1', 0), ('2', 1), ('1', 2), ('2', 3)]) == [False, False, True, True]
+
+
+def test_old_hits_slide_out(Analyser):
+    rule = WindowRule(WindowSeconds=10, WindowThreshold=3, WindowBuckets=10)
+    assert Results(Analyser, rule, [('1', 0), ('1', 1), ('1', 15), ('1', 16), ('1', 17)]) == [False, False, False, False, True]
+    plugin = Analyser._plugins[PluginName]
+    assert plugin.WindowCount(rule, 'w:1') == 3
+
+
+def test_late_data_outside_window_not_counted(Analyser):
+    rule = WindowRule(WindowSeconds=10, WindowThreshold=2)
+    assert Results(Analyser, rule, [('1', 100), ('1', 50)]) == [False, False]
+
+
+def test_idle_keys_reclaimed(Analyser):
+    rule = WindowRule(WindowSeconds=10, WindowThreshold=2)
+    plugin = Analyser._plugins[PluginName]
+    Results(Analyser, rule, [(str(i), 0) for i in range(100)])
+    Results(Analyser, rule, [('x', 100 + i) for i in range(100)])
+    assert len(plugin._windows[plugin._RuleStateKey(rule)]) < 10
+
+
+def test_no_window_behaves_like_plain_rule(Analyser):
+    assert Results(Analyser, WindowRule(), [('1', 0)]) == [True]
+
+
+def test_window_rule_through_analyse_main(Analyser, Hits):
+    actionFunc, calls = Hits
+    rule = WindowRule(WindowSeconds=60, WindowThreshold=3)
+    for ts in range(5):
+        Analyser.AnalyseMain({'event': 'fail', 'ip': '1', 'ts': ts}, actionFunc, [rule])
+    assert calls == [('w', 'w:1')]
+
+
+def test_state_keyed_by_rule_content(Analyser):
+    rule = WindowRule(WindowSeconds=10, WindowThreshold=3)
+    # 重新构造的同样的规则沿用计数器
+    assert Results(Analyser, rule, [('1', 0), ('1', 1)]) == [False, False]
+    assert Results(Analyser, WindowRule(WindowSeconds=10, WindowThreshold=3), [('1', 2)]) == [True]
+    # 就地修改后的规则使用新的计数器
+    rule['WindowThreshold'] = 2
+    assert Results(Analyser, rule, [('1', 3), ('1', 4)]) == [False, True]
+
+
+def test_rule_states_bounded(Analyser, monkeypatch):
+    monkeypatch.setattr(WindowPlugin, '_MaxRules', 5)
+    rules = [WindowRule(WindowSeconds=10, WindowThreshold=2, WindowKey='k%d:{ip}' % i) for i in range(20)]
+    for rule in rules:
+        Results(Analyser, rule, [('1', 0)])
+    # 非受管规则不触发OnRuleRemoved()，状态表仍有上限，淘汰最久未命中的规则
+    assert len(WindowPlugin._windows) == 5
+    plugin = Analyser._plugins[PluginName]
+    assert plugin.WindowCount(rules[-1], 'k19:1') == 1
+    assert plugin.WindowCount(rules[0], 'k0:1') == 0